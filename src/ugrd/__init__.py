@@ -1,6 +1,26 @@
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .exceptions import AutodetectError, ValidationError
-from .initramfs_config import InitramfsConfig
-from .initramfs_generator import InitramfsGenerator
-from .initramfs_protocol import InitramfsProtocol
+
+if TYPE_CHECKING:
+    from .initramfs_config import InitramfsConfig
+    from .initramfs_generator import InitramfsGenerator
+    from .initramfs_protocol import InitramfsProtocol
 
 __all__ = ["InitramfsConfig", "InitramfsProtocol", "InitramfsGenerator", "AutodetectError", "ValidationError"]
+
+# The config and generator are imported when first used, so the CLI can start without them
+_LAZY_IMPORTS = {
+    "InitramfsConfig": ".initramfs_config",
+    "InitramfsGenerator": ".initramfs_generator",
+    "InitramfsProtocol": ".initramfs_protocol",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if module_name := _LAZY_IMPORTS.get(name):
+        value = getattr(import_module(module_name, __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
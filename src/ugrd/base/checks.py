@@ -1,8 +1,9 @@
-__version__ = "0.4.2"
+__version__ = "0.5.1"
 
 from pathlib import Path
 
 from ugrd.exceptions import ValidationError
+from ugrd.import_order import find_order_violation, get_order_edges, get_order_rule
 from zenlib.util import contains
 
 
@@ -24,12 +25,10 @@ def check_in_file(self):
 
 def _check_in_file(self, file, lines):
     """Checks that all lines are in the file."""
-    file = self._get_build_path(file)
-    if not file.exists():
-        raise FileNotFoundError("File '%s' does not exist" % file)
+    if not self._build_path_exists(file):
+        raise FileNotFoundError("File '%s' does not exist" % self._get_build_path(file))
 
-    with open(file, "r") as f:
-        file_lines = f.readlines()
+    file_lines = self._read_build_file(file).splitlines(keepends=True)
 
     stripped_lines = [line.strip() for line in file_lines]
 
@@ -83,25 +82,8 @@ def check_init_order(self):
         if hook == "custom_init":
             continue  # Only one function should be in herE
         hook_funcs = [func.__name__ for func in hook_funcs]
-        a = self["import_order"].get("after", {})
-        after = {k: v for k, v in a.items() if k in hook_funcs and any(subv in hook_funcs for subv in v)}
-        b = self["import_order"].get("before", {})
-        before = {k: v for k, v in b.items() if k in hook_funcs and any(subv in hook_funcs for subv in v)}
-        for func, targets in before.items():
-            for target in targets:
-                func_index = hook_funcs.index(func)
-                try:
-                    target_index = hook_funcs.index(target)
-                except ValueError:
-                    continue  # Ignore targets that are not imported
-                if func_index > target_index:
-                    raise ValidationError("[%s] Function must be before: %s" % (func, target))
-        for func, targets in after.items():
-            for target in targets:
-                func_index = hook_funcs.index(func)
-                try:
-                    target_index = hook_funcs.index(target)
-                except ValueError:
-                    continue  # Ignore targets that are not imported
-                if func_index < target_index:
-                    raise ValidationError("[%s] Function must be after: %s" % (func, target))
+        if violation := find_order_violation(hook_funcs, get_order_edges(hook_funcs, self["import_order"])):
+            order_type, function, target = get_order_rule(violation, self["import_order"])
+            raise ValidationError(
+                "[%s] Function '%s' must be %s: %s (import_order.%s)" % (hook, function, order_type, target, order_type)
+            )
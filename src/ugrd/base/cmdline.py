@@ -1,7 +1,6 @@
 __author__ = "desultory"
-__version__ = "4.2.1"
+__version__ = "4.2.2"
 
-from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 from re import search
 
@@ -160,6 +159,8 @@ def export_exports(self) -> list[str]:
     Sets 'exported' to 1 once done.
     If 'exported' is set, returns early.
     """
+    from importlib.metadata import PackageNotFoundError, version
+
     try:
         self["exports"]["VERSION"] = version(__package__.split(".")[0])
     except PackageNotFoundError:
@@ -1,19 +1,36 @@
 __author__ = "desultory"
-__version__ = "4.8.0"
+__version__ = "4.19.0"
 
+from concurrent.futures import ThreadPoolExecutor
 from os import environ, fsdecode, makedev, mknod, uname
 from pathlib import Path
-from shutil import rmtree, which
+from shutil import copyfileobj, rmtree, which
 from stat import S_IFCHR
-from subprocess import run
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
 from ugrd import InitramfsProtocol
+from ugrd.build_manifest import BuildManifest
+from ugrd.elf_helpers import (
+    ET_DYN,
+    LD_SO_CACHE_FLAG_ARCH_MASK,
+    LD_SO_CACHE_FLAG_ELF_LIBC6,
+    ELFError,
+    get_elf_dependencies,
+    get_elf_info,
+    get_ld_so_cache_flags,
+    make_ld_so_cache,
+    prefetch_elf_dependencies,
+    read_ld_so_cache,
+    update_elf_info_cache,
+)
 from ugrd.exceptions import AutodetectError, ValidationError
 from zenlib.types import NoDupFlatList
 from zenlib.util import colorize as c_
 from zenlib.util import contains, unset
 
+if TYPE_CHECKING:  # Imported when decompress_cache is used
+    from ugrd.decompressed_store import DecompressedStore
+
 # Use the default PATH environment variable, split into a list, as the default binary search paths.
 # Use a hardcoded list of common binary paths if PATH is not set or empty, to ensure there are always some search paths available.
 _DEFAULT_BINARY_SEARCH_PATHS = environ.get("PATH", "").split(":") or [
@@ -24,6 +41,7 @@ _DEFAULT_BINARY_SEARCH_PATHS = environ.get("PATH", "").split(":") or [
     "/usr/local/bin",
     "/usr/local/sbin",
 ]
+_DECOMPRESS_BUFFER_SIZE = 2**20  # 1 MiB, the maximum amount of decompressed data held in memory per file
 
 
 def _has_zstd() -> bool:
@@ -74,9 +92,12 @@ def get_shell(self) -> None:
 
 
 @contains("clean", "Skipping cleaning build directory", log_level=30)
+@unset("direct_cpio", "direct_cpio is enabled, the build directory is not used.")
 def clean_build_dir(self) -> None:
     """Cleans the build directory.
     Ensures there are no active mounts in the build directory.
+
+    If incremental_build is enabled, files which were deployed from unchanged sources are kept.
     """
     build_dir = self._get_build_path("/")
 
@@ -85,13 +106,46 @@ def clean_build_dir(self) -> None:
         self.logger.critical("Active mounts: %s" % self["_mounts"])
         exit(1)
 
-    if build_dir.is_dir():
+    if self["incremental_build"]:
+        self.build_manifest = BuildManifest(build_dir, _get_build_manifest_file(self))
+        if not build_dir.is_dir():
+            return self.logger.info("Build directory does not exist, starting incremental build: %s" % build_dir)
+        kept, removed = self.build_manifest.clean()
+        self.logger.warning(
+            "Cleaning build directory incrementally, kept %s unchanged files and removed %s: %s"
+            % (c_(kept, "green"), c_(removed, "yellow"), c_(build_dir, "yellow"))
+        )
+    elif build_dir.is_dir():
         self.logger.warning("Cleaning build directory: %s" % c_(build_dir, "yellow"))
         rmtree(build_dir)
     else:
         self.logger.info("Build directory does not exist, skipping cleaning: %s" % build_dir)
 
 
+def _get_build_manifest_file(self) -> Path:
+    """Returns the path of the build manifest, which is stored next to the build directory so it is not packed."""
+    build_dir = self._get_build_path("/")
+    return build_dir.with_name(build_dir.name + ".manifest.json")
+
+
+def prune_build_dir(self) -> None:
+    """Removes files kept from the previous incremental build which were not deployed in this build.
+    Saves the build manifest so unchanged files can be kept by the next build.
+    Runs before files are generated from the build directory contents, such as the ld.so.cache."""
+    if not self.build_manifest:
+        return self.logger.debug("Incremental build is not enabled, skipping build directory pruning.")
+
+    for name in self.build_manifest.prune():
+        self.logger.info("Removed stale file from the build directory: %s" % c_(name, "yellow"))
+
+    try:
+        self.build_manifest.save()
+        manifest = self.build_manifest
+        self.logger.debug("Saved build manifest with %d entries: %s" % (len(manifest), manifest.manifest_file))
+    except OSError as e:
+        self.logger.warning("Unable to write build manifest: %s" % e)
+
+
 def generate_structure(self) -> None:
     """Generates the initramfs directory structure."""
     for subdir in set(self["paths"]):
@@ -132,10 +186,11 @@ def get_conditional_dependencies(self: InitramfsProtocol) -> None:
 
 
 def _determine_interpreter(self, binary: Path) -> str | None:
-    """Checks the shebang of a file, returning the interpreter if it exists."""
+    """Checks the shebang of a file, returning the interpreter if it exists.
+    Only reads up to the maximum shebang length of 256 bytes."""
     with binary.open("rb") as f:
         try:
-            first_line = f.readline().decode("utf-8").strip()
+            first_line = f.readline(256).decode("utf-8").strip()
         except UnicodeDecodeError:
             self.logger.debug(f"Binary is not a text file, skipping shebang check: {c_(binary, 'yellow')}")
             return None
@@ -149,12 +204,20 @@ def _determine_interpreter(self, binary: Path) -> str | None:
             return None
 
 
-def _get_lddtree_deps(self, binary_path: Union[str, Path]) -> list[Path]:
-    """Gets dependencies using lddtree."""
+def _get_lddtree_deps(self, binary_path: Union[str, Path], elf_error: Exception | None = None) -> list[Path]:
+    """Gets dependencies using lddtree.
+    Raises an AutodetectError if lddtree is not installed, including the ELF error which caused the fallback."""
     binary_path = str(binary_path)
 
     self.logger.debug(f"Calculating dependencies for: {c_(binary_path, 'blue')}")
-    dependencies = run(["lddtree", "-l", binary_path], capture_output=True)
+    try:
+        dependencies = self._run(["lddtree", "-l", binary_path], fail_silent=True, fail_hard=False)
+    except FileNotFoundError as e:
+        raise AutodetectError(
+            "Unable to resolve dependencies for: %s, lddtree is not installed. ELF error: %s" % (binary_path, elf_error)
+        ) from e
+    except RuntimeError as e:
+        raise AutodetectError("Unable to resolve dependencies for: %s" % binary_path) from e
 
     if dependencies.returncode != 0:
         # If there is a magic number error, the python version of lddtree is not looking at a binary file
@@ -177,8 +240,25 @@ def _get_lddtree_deps(self, binary_path: Union[str, Path]) -> list[Path]:
     return dependency_paths
 
 
+def _get_elf_deps(self, binary_path: Union[str, Path]) -> list[Path]:
+    """Gets dependencies by reading the ELF dynamic section, resolving libraries with the ld.so.cache and library_paths.
+    Results are cached for each file, until the file is changed.
+
+    Falls back to lddtree if dependencies can't be resolved.
+    """
+    self.logger.debug(f"Calculating dependencies for: {c_(binary_path, 'blue')}")
+    try:
+        dependency_paths = get_elf_dependencies(binary_path, tuple(self["library_paths"]))
+    except (ELFError, OSError) as e:
+        self.logger.warning(f"[{c_(binary_path, 'yellow')}] Unable to resolve ELF dependencies, using lddtree: {e}")
+        return _get_lddtree_deps(self, binary_path, e)
+
+    self.logger.debug(f"[{c_(binary_path, 'blue')}] Calculated dependencies: {c_(dependency_paths, 'cyan')}")
+    return dependency_paths
+
+
 def calculate_dependencies(self, binary: str) -> list[Path]:
-    """Calculates the dependencies of a binary using lddtree.
+    """Calculates the dependencies of a binary by reading its ELF dynamic section.
 
     Additionally, pulls the interpreter if defined in the binary's shebang.
 
@@ -201,13 +281,39 @@ def calculate_dependencies(self, binary: str) -> list[Path]:
         else:
             self.logger.debug(f"Interpreter already in binaries list, skipping: {c_(interpreter, 'yellow')}")
 
-    return _get_lddtree_deps(self, binary_path)
+    return _get_elf_deps(self, binary_path)
+
+
+def _get_ld_so_cache(self) -> dict[str, list[tuple[int, str]]]:
+    """Returns the library names and (flags, path) entries from /etc/ld.so.cache.
+    The cache is only parsed once unless it changes.
+    Returns an empty dict if it does not exist or can't be read, such as on musl libc systems.
+    """
+    if self["musl_libc"]:
+        return {}
+    try:
+        return read_ld_so_cache()
+    except (ELFError, OSError) as e:
+        self.logger.warning(f"Unable to read ld.so.cache: {c_(e, 'yellow')}")
+        return {}
+
+
+def _get_ld_so_cache_entries(self, library: str) -> list[str]:
+    """Returns the paths for a library name in the ld.so.cache.
+    Entries with an architecture flag, such as x86-64, are listed first."""
+    entries = _get_ld_so_cache(self).get(library, [])
+    return [path for flags, path in sorted(entries, key=lambda entry: not entry[0] & LD_SO_CACHE_FLAG_ARCH_MASK)]
 
 
 def find_library(self, library: str) -> Path:
-    """Given a library file name, searches for it in the library paths, adds it to the dependencies list.
+    """Given a library file name, searches for it in the ld.so.cache, then the library paths.
     Returns the library path if found, otherwise raises an AutodetectError
     """
+    for lib_path in _get_ld_so_cache_entries(self, library):
+        if Path(lib_path).exists():
+            self.logger.info(f"[{c_(library, 'blue')}] Found library file in ld.so.cache: {c_(lib_path, 'cyan')}")
+            return Path(lib_path)
+
     search_paths: NoDupFlatList[Path] = NoDupFlatList(self["library_paths"], logger=self.logger)
     search_paths.append(["/lib64", "/lib", "/usr/lib64", "/usr/lib"])
 
@@ -249,7 +355,8 @@ def handle_usr_symlinks(self) -> None:
 
 
 def deploy_dependencies(self) -> None:
-    """Copies all dependencies to the build directory."""
+    """Copies all dependencies to the build directory, using a thread pool."""
+    dependencies = []
     for dependency in self["dependencies"]:
         if dependency.is_symlink():
             if self["symlinks"].get(f"_auto_{dependency.name}"):
@@ -258,15 +365,39 @@ def deploy_dependencies(self) -> None:
             else:
                 raise ValueError("Dependency is a symlink and not in the symlinks list: %s" % dependency)
 
-        self._copy(dependency)
+        dependencies.append((dependency, None))
+    self._copy_many(dependencies)
+
+
+def _get_decompressed_store(self) -> "DecompressedStore | None":
+    """Returns the decompressed file store under cache_dir, or None if decompress_cache is disabled or unset.
+    The store is shared by all compression types in a build, so files used by the build are not evicted."""
+    if not self.get("decompress_cache") or not self.get("cache_dir"):
+        return None
+    if not self.decompressed_store:
+        from ugrd.decompressed_store import DecompressedStore
+
+        store_dir = self["cache_dir"] / "decompressed"
+        self.decompressed_store = DecompressedStore(store_dir, self["decompress_cache_size"] * 2**20)
+    return self.decompressed_store
 
 
 def _deploy_compressed(self, compression_type: str, decompressor, compression_extensions=None) -> None:
     """Decompresses all dependencies of the specified compression type into the build directory.
     Remove the compression extension if there is a match between compression_extensions and the file name.
+
+    The decompressor takes the compressed file object and returns a file object for the decompressed data.
+    Data is streamed to the destination in bounded chunks, files are decompressed concurrently in a thread pool.
+    For incremental builds, files decompressed from an unchanged source are kept.
+    If decompress_cache is enabled, decompressed files are stored under cache_dir, and reflinked or hardlinked from it.
+
+    If direct_cpio is enabled, files are added to the virtual tree, and decompressed when the archive is written.
+    With decompress_cache, they are decompressed into the store, and read from it when the archive is written.
     """
     compression_extensions = compression_extensions or [f".{compression_type}"]
+    store = _get_decompressed_store(self)
 
+    decompressions = []
     for dependency in self[f"{compression_type}_dependencies"]:
         self.logger.debug(f"[{compression_type}] Decompressing: {dependency}")
 
@@ -279,29 +410,76 @@ def _deploy_compressed(self, compression_type: str, decompressor, compression_ex
 
         self.logger.debug(f"[{compression_type}] Found compressed file: {dependency}")
         # Replace the extension, do nothing if there is no match
+        if (virtual_path := self._get_virtual_path(str(dependency).replace(extension, ""))) is not None:
+            if store:
+                decompressions.append((dependency, virtual_path))
+                continue
+            virtual_path = self.virtual_tree.add_decompressed(virtual_path, dependency, decompressor)
+            self.logger.info(
+                f"[{c_(compression_type, 'green', bright=True)}] Added {c_(dependency, 'blue')} -> {c_(virtual_path, 'green')}"
+            )
+            continue
+
         out_path = self._get_build_path(str(dependency).replace(extension, ""))
         if not out_path.parent.is_dir():
             self.logger.debug(f"Creating parent directory: {out_path.parent}")
             self._mkdir(out_path.parent, resolve_build=False)
+        decompressions.append((dependency, out_path))
 
+    def decompress(dependency: Path, out_path: Path | str) -> Path | None:
+        """Decompresses a dependency, returns the stored path for virtual paths, which are added after decompression."""
         try:
-            data = decompressor(dependency.read_bytes())
+            if isinstance(out_path, str):  # Virtual paths are only decompressed when the store is used
+                stored_path, stored = store.get_path(dependency, decompressor)  # type: ignore[union-attr]
+                self.logger.debug(f"[{compression_type}] {'Found' if stored else 'Stored'} {dependency}: {stored_path}")
+                return stored_path
+            if self.build_manifest and self.build_manifest.is_current(out_path, dependency):
+                return self.logger.debug(f"[{compression_type}] Source is unchanged, keeping: {out_path}")
+
+            out_path.unlink(missing_ok=True)  # Never write through a hardlink to the store
+            if store:
+                stored, method = store.deploy(dependency, out_path, decompressor)
+                method = f"{'Found in' if stored else 'Decompressed to'} store, {method}"
+            else:
+                with dependency.open("rb") as compressed_file, decompressor(compressed_file) as decompressed_file:
+                    with out_path.open("wb") as out_file:
+                        copyfileobj(decompressed_file, out_file, _DECOMPRESS_BUFFER_SIZE)
+                method = "Decompressed"
         except Exception as e:
             raise DecompressorError(f"[{compression_type}] Unable to decompress dependency: {dependency} ({e})")
+        if self.build_manifest:
+            self.build_manifest.record(out_path, dependency)
+        self.logger.info(
+            f"[{c_(compression_type, 'green', bright=True)}] {method} {c_(dependency, 'blue')} -> {c_(out_path, 'green')}"
+        )
 
-        with out_path.open("wb") as out_file:
-            out_file.write(data)
-            self.logger.info(
-                f"[{c_(compression_type, 'green', bright=True)}] Decompressed {c_(dependency, 'blue')} -> {c_(out_path, 'green')}"
-            )
+    if not decompressions:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(self._get_max_workers(), len(decompressions))) as executor:
+        futures = [executor.submit(decompress, dependency, out_path) for dependency, out_path in decompressions]
+        for (dependency, out_path), future in zip(decompressions, futures):
+            if stored_path := future.result():  # Raise any exceptions
+                virtual_path = self.virtual_tree.add_file(out_path, stored_path, 0o644)
+                self.logger.info(
+                    f"[{c_(compression_type, 'green', bright=True)}] Added {c_(dependency, 'blue')} -> {c_(virtual_path, 'green')}"
+                )
+
+    if store:
+        try:
+            if evicted := store.save():
+                self.logger.info("Removed %d least recently used files from the decompressed store" % len(evicted))
+        except OSError as e:
+            self.logger.warning("Unable to write decompressed store index: %s" % e)
+            self.logger.info(f"Set {c_('decompress_cache', 'blue')}=false to disable the decompressed store.")
 
 
 @contains("xz_dependencies", "No xz dependencies defined, skipping.", log_level=10)
 def deploy_xz_dependencies(self) -> None:
     """Decompresses all xz dependencies into the build directory."""
-    from lzma import decompress
+    from lzma import open as xz_open
 
-    _deploy_compressed(self, "xz", decompress)
+    _deploy_compressed(self, "xz", xz_open)
 
 
 @contains("zstd_dependencies", "No zstd dependencies defined, skipping.", log_level=10)
@@ -309,24 +487,30 @@ def deploy_zstd_dependencies(self) -> None:
     """Decompresses all zstd dependencies into the build directory.
     Entries should only be added to zstd_dependencies if the zstandard library is available.
     """
-    from zstandard import decompress  # type: ignore
+    from zstandard import ZstdDecompressor  # type: ignore
+
+    def zstd_open(compressed_file):
+        # Decompressor instances are not thread safe, use one per file
+        return ZstdDecompressor().stream_reader(compressed_file)
 
-    _deploy_compressed(self, "zstd", decompress, compression_extensions=[".zst", ".zstd"])
+    _deploy_compressed(self, "zstd", zstd_open, compression_extensions=[".zst", ".zstd"])
 
 
 @contains("gz_dependencies", "No gz dependencies defined, skipping.", log_level=10)
 def deploy_gz_dependencies(self) -> None:
     """Decompresses all gzip dependencies into the build directory."""
-    from gzip import decompress
+    from gzip import open as gz_open
 
-    _deploy_compressed(self, "gz", decompress)
+    _deploy_compressed(self, "gz", gz_open)
 
 
 def deploy_copies(self) -> None:
     """Copies everything from self['copies'] into the build directory."""
+    copies = []
     for copy_name, copy_parameters in self["copies"].items():
         self.logger.debug("[%s] Copying: %s" % (copy_name, copy_parameters))
-        self._copy(copy_parameters["source"], copy_parameters["destination"])
+        copies.append((copy_parameters["source"], copy_parameters["destination"]))
+    self._copy_many(copies)
 
 
 def deploy_symlinks(self) -> None:
@@ -338,6 +522,7 @@ def deploy_symlinks(self) -> None:
 
 @contains("nodes", "Skipping device node creation, no nodes are defined.")
 @contains("make_nodes", "Skipping real device node creation with mknod, as make_nodes is not specified.", log_level=20)
+@unset("direct_cpio", "direct_cpio is enabled, device nodes are created in the CPIO archive.", log_level=30)
 def deploy_nodes(self) -> None:
     """Generates specified device nodes."""
     for node, config in self["nodes"].items():
@@ -382,7 +567,23 @@ def _get_ldconfig(self) -> list:
 def autodetect_libgcc(self) -> None:
     """Finds libgcc.so, adds a 'dependencies' item for it.
     Adds the parent directory to 'library_paths'
+
+    Uses the ld.so.cache if it can be read, otherwise uses ldconfig -p.
     """
+    libgcc_entries = [
+        (flags, lib_path)
+        for name, entries in _get_ld_so_cache(self).items()
+        if "libgcc_s" in name
+        for flags, lib_path in entries
+        if flags & ~LD_SO_CACHE_FLAG_ARCH_MASK == LD_SO_CACHE_FLAG_ELF_LIBC6
+    ]
+    if libgcc_entries:
+        # Prefer the multiarch version if it exists, otherwise use the 32 bit version
+        flags, lib_path = sorted(libgcc_entries, key=lambda entry: not entry[0] & LD_SO_CACHE_FLAG_ARCH_MASK)[0]
+        if not flags & LD_SO_CACHE_FLAG_ARCH_MASK:
+            self.logger.warning("Using 32-bit libgcc_s version, multiarch version not found.")
+        return _add_libgcc(self, Path(lib_path))
+
     try:
         ldconfig = _get_ldconfig(self)
     except LDConfigError:
@@ -408,7 +609,11 @@ def autodetect_libgcc(self) -> None:
     else:
         raise AutodetectError("No suitable libgcc_s version found in ldconfig output")
 
-    source_path = Path(libgcc.partition("=> ")[-1])
+    _add_libgcc(self, Path(libgcc.partition("=> ")[-1]))
+
+
+def _add_libgcc(self, source_path: Path) -> None:
+    """Adds libgcc_s to the dependencies, and its parent directory to the library paths."""
     self.logger.info(f"Source path for libgcc_s: {c_(source_path, 'green')}")
 
     self["dependencies"] = source_path
@@ -428,22 +633,66 @@ def autodetect_musl(self) -> None:
         raise AutodetectError("Musl libc is enabled, but the musl search path was not found: %s" % musl_path)
 
 
+def _get_ld_so_cache_libraries(self) -> tuple[dict[str, tuple[int, str]], str] | None:
+    """Gets the ld.so.cache entries for the libraries in the initramfs, and the byte order of the libraries.
+    Uses dependencies and symlinks which are shared libraries in the library paths, in library_paths order.
+    Libraries are listed by soname, or file name if they have no soname.
+
+    Returns None if the ld.so.cache flags for a library architecture are not known.
+    """
+    library_files: dict[str, list[Path]] = {}
+    for library in [*self["dependencies"], *[Path(symlink["target"]) for symlink in self["symlinks"].values()]]:
+        if ".so" in library.name:
+            library_files.setdefault(str(library.parent), []).append(library)
+
+    libraries: dict[str, tuple[int, str]] = {}
+    byte_order = "<"
+    for library_path in self["library_paths"]:
+        for library in library_files.get(str(library_path), []):
+            try:
+                info = get_elf_info(library)
+            except (ELFError, OSError) as e:
+                self.logger.debug(f"Unable to read library, skipping ld.so.cache entry: {c_(library, 'yellow')}: {e}")
+                continue
+            if not info or info.type != ET_DYN:
+                continue
+            if (flags := get_ld_so_cache_flags(info)) is None:
+                self.logger.warning(f"Unknown ld.so.cache flags for library architecture: {c_(library, 'yellow')}")
+                return None
+            byte_order = info.byte_order
+            libraries.setdefault(info.soname or library.name, (flags, str(library)))
+    return libraries, byte_order
+
+
 @unset("musl_libc", "Skipping ld.so.cache regeneration, musl_libc is enabled.", log_level=30)
 def regen_ld_so_cache(self) -> None:
     """
-    Checks if a 'real' ldconfig is available, if so, regenerates the ld.so.cache file in the build dir.
+    Writes the ld.so.cache file in the build dir, using the libraries which were added to the initramfs.
     Uses defined library paths to generate the config file.
 
+    If the library architecture is not known, regenerates it with ldconfig -r, if a 'real' ldconfig is available.
     If ldconfig is not available, _get_ldconfig will warn about setting `musl_libc` to true.
     Here, warn about this and that this is a fatal error if glibc is being used.
     """
+    self._write("etc/ld.so.conf", self["library_paths"])
+    if ld_so_cache_libraries := _get_ld_so_cache_libraries(self):
+        libraries, byte_order = ld_so_cache_libraries
+        self.logger.info("Writing ld.so.cache with %s libraries" % c_(len(libraries), "cyan"))
+        self._write_bytes("etc/ld.so.cache", make_ld_so_cache(libraries, byte_order))
+        self["check_included_or_mounted"] = "etc/ld.so.cache"
+        return
+
     try:
         _get_ldconfig(self)
     except LDConfigError:
         return self.logger.warning("Unable to run ldconfig -p, if glibc is being used, this is fatal!")
 
+    if self["direct_cpio"]:
+        return self.logger.warning(
+            "ldconfig -r requires a build directory, unable to regenerate ld.so.cache with direct_cpio."
+        )
+
     self.logger.info("Regenerating ld.so.cache")
-    self._write("etc/ld.so.conf", self["library_paths"])
     build_path = self._get_build_path("/")
     self._run(["ldconfig", "-r", str(build_path)])
     self["check_included_or_mounted"] = "etc/ld.so.cache"
@@ -511,7 +760,7 @@ def _process_libraries_multi(self, library: Union[str]) -> None:
     self["libraries"].append(library)
     self["dependencies"] = library_path
     self["library_paths"] = str(library_path.parent)
-    self["libraries"] = _get_lddtree_deps(self, library_path)
+    self["libraries"] = _get_elf_deps(self, library_path)
 
 
 def _process_binary_search_paths_multi(self, path: Union[Path, str]) -> None:
@@ -531,6 +780,41 @@ def _process_binary_search_paths_multi(self, path: Union[Path, str]) -> None:
     self["binary_search_paths"].append(str(path))
 
 
+def _prefetch_binaries(self, binaries: list) -> None:
+    """Calculates the dependencies of queued binaries concurrently, before they are processed in order.
+    ELF parsing is CPU bound, so dependencies are resolved in forked worker processes,
+    and the ELF info read by each worker is added to the memoized ELF info of this process.
+    Processing each binary afterwards reuses the results.
+
+    Errors are ignored here, they are raised when the binary is processed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+    from multiprocessing import get_context
+
+    search_paths = ":".join(self["binary_search_paths"] or _DEFAULT_BINARY_SEARCH_PATHS)
+    binary_paths = {}
+    for binary in binaries:
+        for name in binary if isinstance(binary, (list, tuple)) else [binary]:
+            if name in self["binaries"] or name in binary_paths:
+                continue
+            if binary_path := which(name, path=search_paths):
+                binary_paths[name] = binary_path
+
+    max_workers = min(self._get_max_workers(), len(binary_paths))
+    if max_workers < 2:
+        return
+
+    library_paths = tuple(self["library_paths"])
+    self.logger.debug(f"Prefetching dependencies for {len(binary_paths)} binaries using {max_workers} processes")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("fork")) as executor:
+        results = executor.map(prefetch_elf_dependencies, binary_paths.values(), repeat(library_paths))
+        for binary, (elf_info, error) in zip(binary_paths, results):
+            update_elf_info_cache(elf_info)
+            if error:
+                self.logger.debug(f"[{c_(binary, 'yellow')}] Unable to prefetch dependencies: {error}")
+
+
 def _process_binaries_multi(self, binary: str) -> None:
     """Processes binaries into the binaries list, adding dependencies along the way."""
     if binary in self["binaries"]:
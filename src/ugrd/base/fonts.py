@@ -1,7 +1,7 @@
-__version__ = "0.1.1"
+__version__ = "0.2.0"
 
 from pathlib import Path
-from subprocess import run
+from subprocess import CompletedProcess
 
 from ugrd.exceptions import AutodetectError, ValidationError
 from zenlib.util import colorize as c_
@@ -26,13 +26,19 @@ def _strip_font_type(self, font_name: str) -> str:
     return " ".join(filtered_parts)
 
 
-def _get_font_name(self, font_name: str) -> str:
-    """Given a font name, returns the name from fc-match output.
+def _get_font_name_args(font_name: str) -> list[str]:
+    return ["fc-match", font_name]
+
+
+def _get_font_path_args(font_name: str) -> list[str]:
+    return ["fc-match", "-f", "%{file}", font_name]
+
+
+def _parse_font_name(self, font_name: str, r: CompletedProcess) -> str:
+    """Given a font name and the result of fc-match for it, returns the matched name.
     The output is in the format:
         fontfile.ext: "Font name" "Style" ...
     """
-    r = run(["fc-match", font_name], capture_output=True, text=True)
-
     if r.returncode != 0:
         if font_name:
             raise AutodetectError("Could not find a default font using fc-match.")
@@ -42,14 +48,20 @@ def _get_font_name(self, font_name: str) -> str:
             self.logger.warning(f"Font could not be found, but 'fonts_allow_missing' is True, so continuing: {c_(font_name, 'yellow')}")
 
     # Split after the colon, then get the first part and remove quotes
-    matched_name = r.stdout.split(":")[1].split('" "')[0].strip('" ')
+    matched_name = r.stdout.decode().split(":")[1].split('" "')[0].strip('" ')
     return matched_name
 
 
+def _get_font_name(self, font_name: str) -> str:
+    """Given a font name, returns the name from fc-match output."""
+    r = self._run(_get_font_name_args(font_name), fail_silent=True, fail_hard=False)
+    return _parse_font_name(self, font_name, r)
+
+
 def _get_font_path(self, font_name: str) -> Path:
     """Uses fc-match -f '%{file}' to find the font file path."""
-    r = run(["fc-match", "-f", "%{file}", font_name], capture_output=True, text=True)
-    font_path = Path(r.stdout.strip())
+    r = self._run(_get_font_path_args(font_name), fail_silent=True, fail_hard=False)
+    font_path = Path(r.stdout.decode().strip())
     return font_path
 
 
@@ -65,26 +77,33 @@ def _process_fonts_multi(self, font_name: str) -> None:
     uses fc-match -f '%{file}' to find the font file path, appends it to self["dependencies"] if valid.
 
     Sets the default font if it's not already set.
+    The default font, font name, and font path are looked up with fc-match at once.
     """
-
+    cleaned_font_name = _strip_font_size(self, font_name)
+    commands = [_get_font_name_args(cleaned_font_name), _get_font_path_args(cleaned_font_name)]
     if not self["default_font"]:
-        default_font_name = _get_font_name(self, "")
+        commands.append(_get_font_name_args(""))
+    name_match, path_match, *default_match = self._run_many(commands, fail_silent=True, fail_hard=False)
+
+    if default_match:
+        default_font_name = _parse_font_name(self, "", default_match[0])
         self["default_font"] = default_font_name
 
-    cleaned_font_name = _strip_font_size(self, font_name)
+    font_path = Path(path_match.stdout.decode().strip())
     # If the cleaned font name returns the default font, it is not found
     if cleaned_font_name == self["default_font"]:
         # The default font is being set, so we assume it's valid
         pass
-    elif _get_font_name(self, cleaned_font_name) == self["default_font"]:
+    elif _parse_font_name(self, cleaned_font_name, name_match) == self["default_font"]:
         self.logger.debug(
             f"Font lookup returned default font, trying to strip style specifiers: {c_(cleaned_font_name, 'yellow')}"
         )
         cleaned_font_name = _strip_font_type(self, cleaned_font_name)
         if _get_font_name(self, cleaned_font_name) == self["default_font"]:
             raise ValidationError(f"Font could not be found: {c_(font_name, 'red')}")
+        font_path = _get_font_path(self, cleaned_font_name)
 
-    if font_path := _get_font_path(self, cleaned_font_name):
+    if font_path:
         self.data["fonts"][font_name] = font_path
         self["dependencies"] = font_path
     else:
@@ -1,4 +1,4 @@
-__version__ = "2.0.0"
+__version__ = "2.0.1"
 
 from pathlib import Path
 from selectors import EVENT_READ, DefaultSelector
@@ -55,7 +55,7 @@ def init_test_vars(self):
 
 def _get_qemu_cmd_args(self, test_image):
     """Returns arguments to run QEMU for the current test configuration."""
-    test_initrd = self._get_out_path(self["out_file"])
+    test_initrd = self._get_out_path(self.cpio_out_file or self["out_file"])
     self.logger.log(33, f"Testing initramfs image: {c_(test_initrd, 'blue', bold=True)}")
     test_rootfs = test_image._get_out_path(test_image["out_file"])
     self.logger.log(33, f"Test rootfs image: {c_(test_rootfs, 'green', bold=True)}")
@@ -0,0 +1,158 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+from json import dumps, loads
+from os import walk
+from pathlib import Path
+from stat import S_ISREG
+from threading import Lock
+
+BUILD_MANIFEST_VERSION = 1
+
+
+def get_file_signature(path: Path) -> tuple[int, int, int] | None:
+    """Returns the (size, mtime_ns, inode) of a file, following symlinks.
+    Returns None if the path is not a regular file."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def _get_dest_signature(path: Path) -> list[int] | None:
+    """Returns the signature of a file in the build directory, without following symlinks."""
+    try:
+        stat = path.lstat()
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class BuildManifest:
+    """Records the files deployed to the build directory, so unchanged files can be kept between builds.
+
+    Each entry is keyed by the path relative to the build directory, and contains the source path,
+    the signature of the source when it was deployed, and the signature of the deployed file.
+    Files are only kept if both signatures still match, so deployed files which were modified are replaced.
+
+    Entries are marked as deployed when they are recorded, or when a deployer finds them to be current.
+    Entries which were kept but not deployed in the current build are stale, and removed by prune.
+    """
+
+    def __init__(self, build_dir: Path, manifest_file: Path) -> None:
+        self.build_dir = build_dir
+        self.manifest_file = manifest_file
+        self.entries: dict[str, dict] = {}
+        self.deployed: set[str] = set()
+        self._lock = Lock()  # Deployers run in thread pools
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _load(self) -> None:
+        """Loads the manifest file, starting with no entries if it is missing, invalid, or for another build dir."""
+        try:
+            manifest = loads(self.manifest_file.read_text())
+            if manifest["version"] == BUILD_MANIFEST_VERSION and manifest["build_dir"] == str(self.build_dir):
+                self.entries = manifest["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+
+    def save(self) -> None:
+        """Writes the manifest to a temporary file, then moves it into place.
+        Raises an OSError if it can't be written."""
+        manifest = {"version": BUILD_MANIFEST_VERSION, "build_dir": str(self.build_dir), "entries": self.entries}
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + ".tmp")
+        temp_file.write_text(dumps(manifest))
+        temp_file.replace(self.manifest_file)
+
+    def _get_name(self, dest_path: Path) -> str:
+        return str(dest_path.relative_to(self.build_dir))
+
+    def _is_unchanged(self, name: str) -> bool:
+        """Checks that the source and deployed file of an entry have not changed since it was recorded."""
+        entry = self.entries[name]
+        source_signature = get_file_signature(Path(entry["source"]))
+        if source_signature is None or list(source_signature) != entry["signature"]:
+            return False
+        return _get_dest_signature(self.build_dir / name) == entry["dest_signature"]
+
+    def is_current(self, dest_path: Path, source: Path) -> bool:
+        """Checks if the destination was deployed from the source, and neither has changed.
+        If so, the entry is marked as deployed in this build."""
+        name = self._get_name(dest_path)
+        with self._lock:
+            if name not in self.entries or self.entries[name]["source"] != str(source):
+                return False
+            if not self._is_unchanged(name):
+                return False
+            self.deployed.add(name)
+        return True
+
+    def record(self, dest_path: Path, source: Path) -> None:
+        """Records a file which was deployed from the source."""
+        name = self._get_name(dest_path)
+        signature = get_file_signature(source)
+        entry = {
+            "source": str(source),
+            "signature": list(signature) if signature else None,
+            "dest_signature": _get_dest_signature(dest_path),
+        }
+        with self._lock:
+            self.entries[name] = entry
+            self.deployed.add(name)
+
+    def release(self, dest_path: Path) -> bool:
+        """Stops tracking a file which was kept from a previous build, but was not deployed in this build.
+        Used when the path is replaced by another type of file, such as a generated file.
+        Returns True if the file was kept from a previous build, and should be replaced."""
+        name = self._get_name(dest_path)
+        with self._lock:
+            if name in self.entries and name not in self.deployed:
+                del self.entries[name]
+                return True
+        return False
+
+    def clean(self) -> tuple[int, int]:
+        """Removes everything from the build directory, except files which were deployed and are unchanged.
+        Symlinks and generated files are always removed, along with any directories left empty.
+        Returns the number of kept and removed files."""
+        kept: dict[str, dict] = {}
+        removed = 0
+        for root, dirs, files in walk(self.build_dir, topdown=False):
+            for name in files:
+                path = Path(root, name)
+                entry_name = self._get_name(path)
+                if entry_name in self.entries and self._is_unchanged(entry_name):
+                    kept[entry_name] = self.entries[entry_name]
+                else:
+                    path.unlink()
+                    removed += 1
+            for name in dirs:
+                path = Path(root, name)
+                if path.is_symlink():
+                    path.unlink()
+                    removed += 1
+                elif not any(path.iterdir()):
+                    path.rmdir()
+        self.entries = kept
+        self.deployed.clear()
+        return len(kept), removed
+
+    def prune(self) -> list[str]:
+        """Removes files which were kept from a previous build, but were not deployed in this build.
+        Files which were modified since they were recorded are left in place, as something else wrote them.
+        Returns the names of the removed entries."""
+        stale = [name for name in self.entries if name not in self.deployed]
+        for name in stale:
+            path = self.build_dir / name
+            if _get_dest_signature(path) == self.entries.pop(name)["dest_signature"]:
+                path.unlink()
+        return stale
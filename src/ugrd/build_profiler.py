@@ -0,0 +1,175 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+from contextlib import contextmanager
+from json import dumps
+from os import getpid, times
+from pathlib import Path
+from sys import addaudithook
+from threading import get_native_id
+from time import perf_counter_ns, process_time
+from typing import Iterator
+
+_subprocess_count = 0
+_audit_hook_added = False
+
+
+def _audit_hook(event: str, args: tuple) -> None:
+    """Counts subprocesses started by this process, such as by _run."""
+    global _subprocess_count
+    if event == "subprocess.Popen":
+        _subprocess_count += 1
+
+
+def _add_audit_hook() -> None:
+    """Adds the audit hook used to count subprocesses, once, as audit hooks can't be removed."""
+    global _audit_hook_added
+    if not _audit_hook_added:
+        addaudithook(_audit_hook)
+        _audit_hook_added = True
+
+
+def get_cpu_time() -> float:
+    """Returns the CPU time used by this process and its waited for children, in seconds.
+    Child process times are only counted in clock ticks."""
+    child_times = times()
+    return process_time() + child_times.children_user + child_times.children_system
+
+
+def get_bytes_written() -> int:
+    """Returns the number of bytes this process passed to write calls, from /proc/self/io.
+    Returns 0 if it can't be read."""
+    try:
+        with open("/proc/self/io", "rb") as io_file:
+            for line in io_file:
+                if line.startswith(b"wchar:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+class ProfileEvent:
+    """A recorded call of a hook or function. The start time is relative to the start of the profiler, in ns."""
+
+    __slots__ = ("name", "category", "start", "wall_time", "cpu_time", "subprocesses", "bytes_written", "pid", "tid")
+
+    def __init__(
+        self,
+        name: str,
+        category: str,
+        start: int,
+        wall_time: int,
+        cpu_time: float,
+        subprocesses: int,
+        bytes_written: int,
+    ) -> None:
+        self.name = name
+        self.category = category
+        self.start = start
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.subprocesses = subprocesses
+        self.bytes_written = bytes_written
+        self.pid = getpid()
+        self.tid = get_native_id()
+
+    def __repr__(self) -> str:
+        return f"<ProfileEvent {self.category}:{self.name} wall={self.wall_time / 1e6:.3f}ms>"
+
+
+class BuildProfiler:
+    """Records the wall time, CPU time, subprocess count, and bytes written of build hooks and functions.
+
+    CPU time includes child processes which were waited for, such as commands run with _run.
+    Bytes written are read from /proc/self/io, and include everything written by the process, such as log output.
+    Events are nested, so hook totals include the functions they run, and function totals include config processing.
+
+    The trace is written in the Chrome trace event format, which can be opened with Perfetto or chrome://tracing.
+    """
+
+    def __init__(self, trace_file: Path | str) -> None:
+        _add_audit_hook()
+        self.trace_file = Path(trace_file)
+        self.events: list[ProfileEvent] = []
+        self.start = perf_counter_ns()
+
+    @contextmanager
+    def record(self, name: str, category: str) -> Iterator[None]:
+        """Records an event for everything run in the context, even if it raises an exception."""
+        start, cpu_time = perf_counter_ns(), get_cpu_time()
+        subprocesses, bytes_written = _subprocess_count, get_bytes_written()
+        try:
+            yield
+        finally:
+            self.events.append(
+                ProfileEvent(
+                    name,
+                    category,
+                    start - self.start,
+                    perf_counter_ns() - start,
+                    get_cpu_time() - cpu_time,
+                    _subprocess_count - subprocesses,
+                    get_bytes_written() - bytes_written,
+                )
+            )
+
+    def get_totals(self) -> list[tuple[str, str, int, int, float, int, int]]:
+        """Returns the category, name, call count, wall time, CPU time, subprocesses, and bytes written of each
+        recorded hook or function, by descending wall time."""
+        totals: dict[tuple[str, str], list] = {}
+        for event in self.events:
+            total = totals.setdefault((event.category, event.name), [0, 0, 0.0, 0, 0])
+            total[0] += 1
+            total[1] += event.wall_time
+            total[2] += event.cpu_time
+            total[3] += event.subprocesses
+            total[4] += event.bytes_written
+        return sorted(((*key, *total) for key, total in totals.items()), key=lambda total: total[3], reverse=True)
+
+    def get_summary(self, limit: int = 25) -> str:
+        """Returns a table of the totals for all hooks, and the limit slowest functions and config processors."""
+        header = ("Type", "Name", "Calls", "Wall ms", "CPU ms", "Procs", "Written")
+        lines = ["%-8s %-40s %6s %10s %10s %6s %10s" % header]
+        shown: dict[str, int] = {}
+        for category, name, calls, wall_time, cpu_time, subprocesses, bytes_written in self.get_totals():
+            if category != "hook" and shown.get(category, 0) >= limit:
+                continue
+            shown[category] = shown.get(category, 0) + 1
+            lines.append(
+                "%-8s %-40s %6d %10.1f %10.1f %6d %9.1fK"
+                % (category, name[:40], calls, wall_time / 1e6, cpu_time * 1e3, subprocesses, bytes_written / 2**10)
+            )
+        return "\n".join(lines)
+
+    def get_trace(self) -> dict:
+        """Returns the recorded events in the Chrome trace event format, as complete events with times in us."""
+        trace_events: list[dict] = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"ugrd [{pid}]"}}
+            for pid in sorted({event.pid for event in self.events})
+        ]
+        for event in self.events:
+            trace_events.append(
+                {
+                    "name": event.name,
+                    "cat": event.category,
+                    "ph": "X",
+                    "ts": event.start / 1e3,
+                    "dur": event.wall_time / 1e3,
+                    "pid": event.pid,
+                    "tid": event.tid,
+                    "args": {
+                        "cpu_ms": round(event.cpu_time * 1e3, 3),
+                        "subprocesses": event.subprocesses,
+                        "bytes_written": event.bytes_written,
+                    },
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, trace_file: Path | None = None) -> Path:
+        """Writes the trace to trace_file, or the trace file of the profiler, returns the path written.
+        Raises an OSError if it can't be written."""
+        trace_file = trace_file or self.trace_file
+        trace_file.write_text(dumps(self.get_trace()))
+        return trace_file
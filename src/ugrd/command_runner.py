@@ -0,0 +1,109 @@
+__author__ = "desultory"
+__version__ = "0.2.0"
+
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+from subprocess import CompletedProcess, TimeoutExpired, run
+from time import perf_counter
+from typing import Any
+
+from zenlib.util import colorize as c_
+
+
+class CommandRecord:
+    """A command run by _run, with the duration in seconds.
+    The return code is None if the command could not be run, or timed out."""
+
+    __slots__ = ("args", "duration", "returncode")
+
+    def __init__(self, args: list[str], duration: float, returncode: int | None) -> None:
+        self.args = args
+        self.duration = duration
+        self.returncode = returncode
+
+    def __repr__(self) -> str:
+        return f"<CommandRecord {' '.join(self.args)} returncode={self.returncode} duration={self.duration:.3f}s>"
+
+
+class CommandRunner:
+    """Runs external commands for the generator and the config, recording each in the command_log.
+    The generator uses the command_log of the config, so commands run while processing the config are reported.
+    Classes using this must have a logger, and support get and item access for config values.
+    """
+
+    command_log: list[CommandRecord]
+    logger: Any
+
+    def _get_max_workers(self) -> int:
+        """Returns the number of worker threads to use, max_workers if set, otherwise the number of CPUs."""
+        return self.get("max_workers") or cpu_count() or 1
+
+    def _run(
+        self, args: list[str], timeout: int | None = None, fail_silent: bool = False, fail_hard: bool = True
+    ) -> CompletedProcess:  # type: ignore[type-arg]
+        """Runs a command, returns the CompletedProcess object on success.
+        The command, duration, and return code are recorded in the command_log.
+        If a timeout is set, the command will fail hard if it times out.
+        If fail_silent is set, non-zero return codes will not log stderr/stdout.
+        If fail_hard is set, non-zero return codes will raise a RuntimeError.
+        """
+
+        def print_err(ret: CompletedProcess | TimeoutExpired) -> None:  # type: ignore[type-arg]
+            if args := ret.args:
+                if isinstance(args, tuple):
+                    args = args[0]  # When there's a timeout, args is a (args, timeout) tuple
+                self.logger.error("Failed command: %s" % c_(" ".join(args), "red", bright=True))
+            if stdout := ret.stdout:
+                self.logger.error("Command output:\n%s" % stdout.decode())
+            if stderr := ret.stderr:
+                self.logger.error("Command error:\n%s" % stderr.decode())
+
+        timeout = timeout or self["timeout"]
+        cmd_args = [str(arg) for arg in args]
+        self.logger.debug("Running command: %s" % " ".join(cmd_args))
+        start, returncode = perf_counter(), None
+        try:
+            cmd = run(cmd_args, capture_output=True, timeout=timeout)
+            returncode = cmd.returncode
+        except TimeoutExpired as e:
+            # Always fail hard for timeouts
+            print_err(e)
+            raise RuntimeError("[%ds] Command timed out: %s" % (timeout, [str(arg) for arg in cmd_args])) from e
+        finally:  # Record commands which could not be run too, list appends are thread safe
+            self.command_log.append(CommandRecord(cmd_args, perf_counter() - start, returncode))
+
+        if cmd.returncode != 0:
+            if not fail_silent:
+                print_err(cmd)  # Print the full error output if not failing silently
+            if fail_hard:  # Fail hard means raise an exception
+                raise RuntimeError("Failed to run command: %s" % c_(" ".join(cmd.args), "red", bright=True))
+
+        return cmd
+
+    def _run_many(
+        self, commands: list[list[str]], timeout: int | None = None, fail_silent: bool = False, fail_hard: bool = True
+    ) -> list[CompletedProcess]:  # type: ignore[type-arg]
+        """Runs independent commands concurrently with _run, using up to max_workers threads.
+        Returns the CompletedProcess objects in the order of the commands.
+        The arguments are passed to _run for each command, if any command raises an exception, the first is raised.
+        """
+        if not commands:
+            return []
+
+        max_workers = min(self._get_max_workers(), len(commands))
+        self.logger.debug("Running %d commands using %d workers" % (len(commands), max_workers))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._run, args, timeout, fail_silent, fail_hard) for args in commands]
+            return [future.result() for future in futures]
+
+    def _report_commands(self) -> None:
+        """Logs the number of commands run, their total duration, and the slowest and failed commands."""
+        if not self.command_log:
+            return
+        failed = [record for record in self.command_log if record.returncode != 0]
+        total = sum(record.duration for record in self.command_log)
+        self.logger.info("Ran %d commands in %.2fs, %d failed." % (len(self.command_log), total, len(failed)))
+        for record in sorted(self.command_log, key=lambda record: record.duration, reverse=True)[:10]:
+            self.logger.debug("[%.3fs] Command: %s" % (record.duration, " ".join(record.args)))
+        for record in failed:
+            self.logger.debug("[%s] Failed command: %s" % (record.returncode, " ".join(record.args)))
@@ -0,0 +1,334 @@
+__author__ = "desultory"
+__version__ = "0.2.1"
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from shutil import which
+from struct import pack
+from subprocess import PIPE, Popen, run
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+from typing import BinaryIO, Iterator
+from zlib import crc32
+
+from pycpio.errors import UnavailableCompression
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+XZ_STREAM_FLAGS = b"\x00\x01"  # CRC32 checks, the kernel's xz decoder always supports these
+XZ_FILTER_LZMA2 = 0x21
+XZ_PRESET_DICT_SIZES = [2**18, 2**20, 2**21, 2**22, 2**22, 2**23, 2**23, 2**24, 2**25, 2**26]
+
+COMPRESSION_EXTENSIONS = {"xz": "xz", "zstd": "zstd", "gzip": "gz"}
+
+
+def _encode_varint(value: int) -> bytes:
+    """Encodes an integer using the xz multibyte format, 7 bits per byte."""
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _pad4(length: int) -> bytes:
+    return b"\0" * (-length % 4)
+
+
+def get_lzma2_dict_prop(dict_size: int) -> int:
+    """Returns the LZMA2 dictionary size property for a dictionary size, rounding up."""
+    for prop in range(40):
+        if (2 | (prop & 1)) << (prop // 2 + 11) >= dict_size:
+            return prop
+    return 40
+
+
+class XZBlockWriter:
+    """Writes a single xz stream, compressing independent blocks in a thread pool.
+
+    Data is split into blocks of block_size, each block is compressed with raw LZMA2 and written in order.
+    Like 'xz -T', the result is a standard multi-block stream, which the kernel's xz decoder can decompress.
+    CRC32 checks are used, as CRC64 is not supported by older kernels.
+
+    Memory use is bounded by the number of blocks being compressed, which is limited to threads + 1.
+    """
+
+    def __init__(self, out_file: BinaryIO, threads: int, preset: int = 6, block_size: int | None = None) -> None:
+        """Raises a ValueError if the preset is not 0-9, optionally with lzma.PRESET_EXTREME set."""
+        from lzma import FILTER_LZMA2, PRESET_EXTREME
+
+        if not 0 <= preset & ~PRESET_EXTREME <= 9:
+            raise ValueError("Invalid xz cpio_compression_level, must be 0-9: %s" % preset)
+
+        self.out_file = out_file
+        self.dict_size = XZ_PRESET_DICT_SIZES[preset & 0x1F]
+        self.filters = [{"id": FILTER_LZMA2, "preset": preset, "dict_size": self.dict_size}]
+        self.block_size = block_size or 3 * self.dict_size  # Matches the default of xz -T
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads + 1
+        self.pending: deque[Future] = deque()
+        self.buffer = bytearray()
+        self.records: list[tuple[int, int]] = []  # (unpadded size, uncompressed size)
+        self.out_file.write(XZ_HEADER_MAGIC + XZ_STREAM_FLAGS + pack("<I", crc32(XZ_STREAM_FLAGS)))
+
+    def __enter__(self) -> "XZBlockWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.close()
+
+    def _get_block_header(self) -> bytes:
+        """Returns the block header, which only contains the LZMA2 filter flags."""
+        dict_prop = bytes([get_lzma2_dict_prop(self.dict_size)])
+        filter_flags = _encode_varint(XZ_FILTER_LZMA2) + _encode_varint(1) + dict_prop
+        header = b"\x00" + filter_flags  # Block flags, one filter, no optional sizes
+        header_size = len(header) + 1 + len(_pad4(len(header) + 1)) + 4
+        header = bytes([header_size // 4 - 1]) + header + _pad4(len(header) + 1)
+        return header + pack("<I", crc32(header))
+
+    def _compress_block(self, data: bytes) -> tuple[bytes, int, int]:
+        """Compresses a block, returns the encoded block, its unpadded size, and the uncompressed size."""
+        from lzma import FORMAT_RAW, compress
+
+        header = self._get_block_header()
+        compressed = compress(data, format=FORMAT_RAW, filters=self.filters)
+        block = header + compressed + _pad4(len(compressed)) + pack("<I", crc32(data))
+        return block, len(header) + len(compressed) + 4, len(data)
+
+    def _write_block(self, future: Future) -> None:
+        block, unpadded_size, uncompressed_size = future.result()
+        self.out_file.write(block)
+        self.records.append((unpadded_size, uncompressed_size))
+
+    def _submit(self, data: bytes) -> None:
+        self.pending.append(self.executor.submit(self._compress_block, data))
+        while len(self.pending) > self.max_pending:
+            self._write_block(self.pending.popleft())
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def close(self) -> None:
+        """Compresses any buffered data, then writes the index and stream footer."""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_block(self.pending.popleft())
+        self.executor.shutdown()
+
+        index = b"\x00" + _encode_varint(len(self.records))
+        for unpadded_size, uncompressed_size in self.records:
+            index += _encode_varint(unpadded_size) + _encode_varint(uncompressed_size)
+        index += _pad4(len(index))
+        index += pack("<I", crc32(index))
+        self.out_file.write(index)
+
+        backward_size = pack("<I", len(index) // 4 - 1)
+        footer = backward_size + XZ_STREAM_FLAGS
+        self.out_file.write(pack("<I", crc32(footer)) + footer + XZ_FOOTER_MAGIC)
+
+
+@contextmanager
+def _open_pipe(path: Path, args: list[str]) -> Iterator[BinaryIO]:
+    """Opens a pipe to an external compressor, which writes to the path.
+    Raises a RuntimeError if the compressor fails."""
+    with path.open("wb") as out_file:
+        process = Popen(args, stdin=PIPE, stdout=out_file)
+        try:
+            yield process.stdin  # type: ignore[misc]
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdin.close()  # type: ignore[union-attr]
+            returncode = process.wait()
+    if returncode:
+        raise RuntimeError("Compression command failed with code %d: %s" % (returncode, " ".join(args)))
+
+
+@contextmanager
+def _open_xz(path: Path, threads: int, level: int | None = None) -> Iterator[BinaryIO]:
+    """Opens an xz file for writing, using block-parallel compression if threads is greater than 1.
+    Falls back to an external 'xz' if the lzma module is not available."""
+    try:
+        from lzma import CHECK_CRC32
+        from lzma import open as xz_open
+    except ImportError:  # Python may be built without lzma support
+        xz_open = None
+
+    preset = 6 if level is None else level
+    if xz_open is None:
+        if not (xz := which("xz")):
+            raise UnavailableCompression("xz compression requires the lzma module or the xz command")
+        with _open_pipe(path, [xz, "-c", "--check=crc32", f"-{preset}", f"-T{threads}"]) as out_file:
+            yield out_file
+    elif threads > 1:
+        with path.open("wb") as raw_file, XZBlockWriter(raw_file, threads, preset) as out_file:
+            yield out_file  # type: ignore[misc]
+    else:
+        with xz_open(path, "wb", check=CHECK_CRC32, preset=preset) as out_file:
+            yield out_file  # type: ignore[misc]
+
+
+@contextmanager
+def _open_zstd(path: Path, threads: int, level: int | None = None) -> Iterator[BinaryIO]:
+    """Opens a zstd file for writing, using zstandard worker threads if threads is greater than 1.
+    Falls back to an external 'zstd' if the zstandard library is not available."""
+    try:
+        from zstandard import ZstdCompressor  # type: ignore
+    except ImportError:
+        ZstdCompressor = None
+
+    level = 3 if level is None else level
+    if ZstdCompressor is None:
+        if not (zstd := which("zstd")):
+            raise UnavailableCompression("zstd compression requires the zstandard library or the zstd command")
+        with _open_pipe(path, [zstd, "-c", "-q", f"-{level}", f"-T{threads}"]) as out_file:
+            yield out_file
+    else:
+        compressor = ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        with path.open("wb") as raw_file, compressor.stream_writer(raw_file, closefd=False) as out_file:
+            yield out_file
+
+
+@contextmanager
+def _open_gzip(path: Path, level: int | None = None) -> Iterator[BinaryIO]:
+    """Opens a gzip file for writing. Compression is not threaded."""
+    from gzip import GzipFile
+
+    with path.open("wb") as raw_file:
+        with GzipFile(fileobj=raw_file, mode="wb", compresslevel=9 if level is None else level, mtime=0) as out_file:
+            yield out_file  # type: ignore[misc]
+
+
+@contextmanager
+def open_compressed(
+    path: Path, compression: str | bool | None, threads: int = 1, level: int | None = None
+) -> Iterator[BinaryIO]:
+    """Opens a file for writing with the specified compression, using up to the passed number of threads.
+    'true' and 'xz' use xz with crc32 checks, which the kernel can decompress.
+    'false', 'none', or an empty value disables compression.
+    If level is not set, the default level of the compressor is used.
+
+    Raises UnavailableCompression if the compression type is unknown or no compressor is available.
+    """
+    compression = str(compression or "false").lower()
+    if compression in ("false", "none"):
+        with path.open("wb") as out_file:
+            yield out_file
+    elif compression in ("true", "xz"):
+        with _open_xz(path, threads, level) as out_file:
+            yield out_file
+    elif compression == "zstd":
+        with _open_zstd(path, threads, level) as out_file:
+            yield out_file
+    elif compression == "gzip":
+        with _open_gzip(path, level) as out_file:
+            yield out_file
+    else:
+        raise UnavailableCompression("Unknown compression type: %s" % compression)
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    """Decompresses data written by open_compressed, using an external command if the library is not available."""
+    if compression == "gzip":
+        from gzip import decompress as gzip_decompress
+
+        return gzip_decompress(data)
+
+    try:
+        if compression == "xz":
+            from lzma import decompress as xz_decompress
+
+            return xz_decompress(data)
+        from zstandard import ZstdDecompressor  # type: ignore
+
+        return ZstdDecompressor().decompressobj().decompress(data)
+    except ImportError:
+        if not (command := which(compression)):
+            raise UnavailableCompression("No decompressor available for: %s" % compression)
+        return run([command, "-d", "-c", "-q"], input=data, stdout=PIPE, check=True).stdout
+
+
+def sample_file(file: BinaryIO, size: int, sample_size: int, chunk_count: int = 8) -> bytes:
+    """Reads up to sample_size bytes from a file of the passed size, in chunks spread evenly across the file.
+    If the file is smaller than the sample size, the whole file is read."""
+    file.seek(0)
+    if size <= sample_size:
+        return file.read()
+
+    chunk_size = sample_size // chunk_count
+    sample = bytearray()
+    for chunk in range(chunk_count):
+        file.seek(chunk * (size - chunk_size) // (chunk_count - 1))
+        sample += file.read(chunk_size)
+    return bytes(sample)
+
+
+class CompressionBenchmark:
+    """The measured results of compressing and decompressing a sample with one compression type and level.
+    Rates are in bytes of uncompressed data per second."""
+
+    __slots__ = ("compression", "level", "input_size", "output_size", "compress_time", "decompress_time")
+
+    def __init__(
+        self,
+        compression: str,
+        level: int,
+        input_size: int,
+        output_size: int,
+        compress_time: float,
+        decompress_time: float,
+    ) -> None:
+        self.compression = compression
+        self.level = level
+        self.input_size = input_size
+        self.output_size = output_size
+        self.compress_time = compress_time
+        self.decompress_time = decompress_time
+
+    def __repr__(self) -> str:
+        return f"<CompressionBenchmark {self.compression}-{self.level} ratio={self.ratio:.3f}>"
+
+    @property
+    def ratio(self) -> float:
+        """The compressed size, as a fraction of the uncompressed size."""
+        return self.output_size / self.input_size if self.input_size else 1.0
+
+    @property
+    def compress_rate(self) -> float:
+        return self.input_size / self.compress_time if self.compress_time else float("inf")
+
+    @property
+    def decompress_rate(self) -> float:
+        return self.input_size / self.decompress_time if self.decompress_time else float("inf")
+
+
+def benchmark_compression(sample: bytes, compression: str, level: int, threads: int = 1) -> CompressionBenchmark:
+    """Compresses and decompresses the sample, measuring the compressed size and time taken.
+    Compression uses the same code path as the final image, writing to a temporary file.
+    Raises a ValueError if the decompressed data does not match the sample."""
+    with NamedTemporaryFile(prefix="ugrd-benchmark-") as temp_file:
+        start = perf_counter()
+        with open_compressed(Path(temp_file.name), compression, threads, level) as out_file:
+            out_file.write(sample)
+        compress_time = perf_counter() - start
+        compressed = Path(temp_file.name).read_bytes()
+
+    start = perf_counter()
+    decompressed = decompress(compressed, compression)
+    decompress_time = perf_counter() - start
+    if decompressed != sample:
+        raise ValueError("Decompressed data does not match the sample: %s-%d" % (compression, level))
+    return CompressionBenchmark(compression, level, len(sample), len(compressed), compress_time, decompress_time)
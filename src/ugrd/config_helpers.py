@@ -1,15 +1,25 @@
+from copy import deepcopy
+from functools import lru_cache
+from json import dumps, loads
+from os import environ
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
-from pycpio import PyCPIO
 from zenlib.types import NoDupFlatList
 from zenlib.util import parse_toml
 
+from .build_manifest import get_file_signature
+
 DEFAULT_CONFIG_PATH = "/etc/ugrd/config.toml"
 MODULE_SEARCH_PATHS = [Path(__file__).parent, Path("/var/lib/ugrd")]
+# Parsed module configs are cached here, by the size, mtime, and inode of the module config file
+# UGRD_MODULE_CACHE can be set to use another file, or set to an empty string to disable the cache
+MODULE_CACHE_FILE = Path("/var/cache/ugrd/modules.json")
+MODULE_CACHE_ENV = "UGRD_MODULE_CACHE"
+MODULE_CACHE_VERSION = 1
 
 ALLOWED_PARAMETER_TYPES: dict[str, type] = {
-    t.__name__: t for t in (bool, str, int, float, dict, list, Path, NoDupFlatList, PyCPIO)
+    t.__name__: t for t in (bool, str, int, float, dict, list, Path, NoDupFlatList)
 }
 
 
@@ -31,21 +41,104 @@ def get_module_name(module_path: Path) -> str:
     return parent_name + module_name
 
 
+@lru_cache(maxsize=None)
+def get_module_index() -> dict[str, Path]:
+    """Returns a dict of module names to the paths of their config files, the search paths are only walked once.
+    If a module name is in multiple search paths, the first is used."""
+    module_index: dict[str, Path] = {}
+    for module_path in get_module_paths():
+        module_index.setdefault(get_module_name(module_path), module_path)
+    return module_index
+
+
+class ModuleConfigCache:
+    """Caches parsed module configs in a JSON file, by the signature of the module config file.
+    Configs which can't be stored as JSON are parsed every time.
+    Cached configs are copied when read, as loading a module can modify its config.
+    If cache_file is None, configs are cached for this process only.
+    """
+
+    def __init__(self, cache_file: Optional[Path]) -> None:
+        self.cache_file = cache_file
+        self.entries: dict[str, dict[str, Any]] = {}
+        self._dirty = False
+        if cache_file is None:
+            return
+        try:
+            cache = loads(cache_file.read_text())
+            if cache["version"] == MODULE_CACHE_VERSION:
+                self.entries = cache["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+
+    def read(self, module_path: Path) -> dict[str, Any]:
+        """Returns the parsed config of a module config file, parsing it if it is not cached or has changed."""
+        signature = get_file_signature(module_path)
+        if (entry := self.entries.get(str(module_path))) and signature and entry["signature"] == list(signature):
+            return deepcopy(entry["config"])
+
+        config = parse_toml(module_path)
+        try:
+            self.entries[str(module_path)] = loads(dumps({"signature": signature, "config": config}))
+            self._dirty = True
+        except (TypeError, ValueError):  # Such as TOML dates
+            pass
+        return config
+
+    def save(self) -> bool:
+        """Writes the cache if any configs were parsed, returns True if it was written.
+        The cache is written to a temporary file, then moved into place. Raises an OSError if it can't be written."""
+        if not self._dirty or self.cache_file is None:
+            return False
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        temp_file.write_text(dumps({"version": MODULE_CACHE_VERSION, "entries": self.entries}))
+        temp_file.replace(self.cache_file)
+        self._dirty = False
+        return True
+
+
+def get_module_cache_file() -> Optional[Path]:
+    """Returns the module config cache file, from UGRD_MODULE_CACHE if it is set, otherwise MODULE_CACHE_FILE.
+    Returns None if UGRD_MODULE_CACHE is set to an empty string."""
+    if (cache_file := environ.get(MODULE_CACHE_ENV)) is not None:
+        return Path(cache_file) if cache_file else None
+    return MODULE_CACHE_FILE
+
+
+@lru_cache(maxsize=None)
+def get_module_cache() -> ModuleConfigCache:
+    """Returns the module config cache for this process, loaded from get_module_cache_file()."""
+    return ModuleConfigCache(get_module_cache_file())
+
+
+def save_module_cache() -> None:
+    """Saves the module config cache, ignoring errors, as the cache directory may not be writable."""
+    try:
+        get_module_cache().save()
+    except OSError:
+        pass
+
+
 def read_ugrd_module(module_name: str) -> dict[str, Any]:
     """Reads a ugrd module given a module name. Returns the config"""
-    for module in get_module_paths():
-        if module_name == get_module_name(module):
-            return parse_toml(module)
+    if module_path := get_module_index().get(module_name):
+        return get_module_cache().read(module_path)
 
     raise FileNotFoundError(f"Unable to find module: {module_name}")
 
 
 def resolve_type(type_name: str) -> type:
     """Resolves a type name to a type"""
+    if type_name == "PyCPIO":  # Imported when used, so the CLI can read module configs without pycpio
+        from pycpio import PyCPIO
+
+        return PyCPIO
     try:
         return ALLOWED_PARAMETER_TYPES[type_name]
     except KeyError as e:
-        raise ValueError(f"Unknown type: {type_name}, Allowed types: {ALLOWED_PARAMETER_TYPES}") from e
+        allowed_types = [*ALLOWED_PARAMETER_TYPES, "PyCPIO"]
+        raise ValueError(f"Unknown type: {type_name}, Allowed types: {allowed_types}") from e
 
 
 def get_parameters() -> dict[str, dict[str, str]]:
@@ -53,13 +146,13 @@ def get_parameters() -> dict[str, dict[str, str]]:
     these are defined in the "custom_parameters" section of the config file
     """
     parameters = {}
-    for module in get_module_paths():
+    for module_name, module in get_module_index().items():
         try:
-            config = parse_toml(module)
+            config = get_module_cache().read(module)
         except Exception as e:
             print(f"!!! Failed to parse {module}:\n{e}")
             continue
         if "custom_parameters" in config:
-            module_name = get_module_name(module)
             parameters[module_name] = config["custom_parameters"]
+    save_module_cache()
     return parameters
@@ -0,0 +1,256 @@
+__author__ = "desultory"
+__version__ = "0.5.1"
+
+from pathlib import Path
+from shutil import copyfileobj
+from stat import S_IFCHR, S_IFDIR, S_IFLNK, S_IFMT, S_IFREG
+from tempfile import SpooledTemporaryFile
+from time import time
+from typing import BinaryIO
+
+from .compression import open_compressed
+from .virtual_tree import VirtualEntry, VirtualTree
+
+NEWC_MAGIC = b"070701"
+NEWC_TRAILER = "TRAILER!!!"
+_BUFFER_SIZE = 2**20  # 1 MiB, the amount of file data read at once
+_SPOOL_SIZE = 2**23  # 8 MiB, decompressed data larger than this is spooled to a temporary file
+
+
+def _pad(length: int) -> bytes:
+    """Returns the padding needed to align a length to 4 bytes."""
+    return b"\0" * (-length % 4)
+
+
+class CPIOIndexEntry:
+    """An entry in the index of a written archive.
+    The offset is the position of the entry header in the uncompressed archive.
+    Data is not kept in memory, it is read from the virtual tree entry when requested.
+    """
+
+    __slots__ = ("name", "mode", "size", "offset", "entry")
+
+    def __init__(self, name: str, mode: int, size: int, offset: int, entry: VirtualEntry | None = None) -> None:
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self.offset = offset
+        self.entry = entry
+
+    def __repr__(self) -> str:
+        return f"<CPIOIndexEntry {self.name} mode={self.mode:o} size={self.size} offset={self.offset}>"
+
+    @property
+    def is_symlink(self) -> bool:
+        return S_IFMT(self.mode) == S_IFLNK
+
+    def read_bytes(self) -> bytes:
+        """Reads the entry data, symlinks return the link target."""
+        if self.entry is None:
+            return b""
+        if self.entry.entry_type == S_IFLNK:
+            return self.entry.target.encode()  # type: ignore[union-attr]
+        if self.entry.entry_type == S_IFREG:
+            return self.entry.read_bytes()
+        return b""
+
+
+class CPIOWriter:
+    """Writes a newc format CPIO archive to a file object, one entry at a time.
+    File data is streamed into the archive, so only one buffer is held in memory.
+    Written entries are recorded in the index, by name.
+    """
+
+    def __init__(self, out_file: BinaryIO, mtime: int | None = None) -> None:
+        self.out_file = out_file
+        self.mtime = int(time()) if mtime is None else mtime
+        self.inode = 0
+        self.offset = 0
+        self.index: dict[str, CPIOIndexEntry] = {}
+
+    def _write(self, data: bytes) -> None:
+        self.out_file.write(data)
+        self.offset += len(data)
+
+    def _write_header(
+        self,
+        name: str,
+        mode: int,
+        size: int = 0,
+        mtime: int | None = None,
+        nlink: int = 1,
+        major: int = 0,
+        minor: int = 0,
+        inode: int | None = None,
+    ) -> int:
+        """Writes the header and name of an entry, padded to 4 bytes. Returns the inode number.
+        A new inode is used unless one is passed. The trailer uses inode 0."""
+        if name == NEWC_TRAILER:
+            inode = 0
+        else:
+            self.index[name] = CPIOIndexEntry(name, mode, size, self.offset)
+            if inode is None:
+                self.inode += 1
+                inode = self.inode
+
+        encoded_name = name.encode() + b"\0"
+        fields = (inode, mode, 0, 0, nlink, self.mtime if mtime is None else mtime, size, 0, 0, major, minor)
+        header = NEWC_MAGIC + b"".join(b"%08X" % field for field in fields)
+        header += b"%08X%08X" % (len(encoded_name), 0)  # namesize, check
+        self._write(header + encoded_name + _pad(len(header) + len(encoded_name)))
+        return inode
+
+    def add_directory(self, name: str, mode: int = 0o755) -> int:
+        return self._write_header(name, S_IFDIR | mode, nlink=2)
+
+    def add_symlink(self, name: str, target: str) -> int:
+        data = target.encode()
+        inode = self._write_header(name, S_IFLNK | 0o777, len(data))
+        self._write(data + _pad(len(data)))
+        return inode
+
+    def add_chardev(self, name: str, mode: int, major: int, minor: int) -> int:
+        return self._write_header(name, S_IFCHR | mode, major=major, minor=minor)
+
+    def add_file(
+        self, name: str, mode: int, data: BinaryIO, size: int, mtime: int | None = None, nlink: int = 1
+    ) -> int:
+        """Adds a regular file, streaming size bytes from the data file object. Returns the inode number.
+        Raises a ValueError if the data does not match the size, such as if the source changed."""
+        inode = self._write_header(name, S_IFREG | mode, size, mtime, nlink)
+        written = 0
+        while chunk := data.read(min(_BUFFER_SIZE, size - written)):
+            self._write(chunk)
+            written += len(chunk)
+        if written != size or data.read(1):
+            raise ValueError("[%s] File size changed while writing, expected %d bytes" % (name, size))
+        self._write(_pad(size))
+        return inode
+
+    def add_hardlink(self, name: str, mode: int, inode: int, nlink: int, size: int) -> int:
+        """Adds a hardlink to a file which was already written with the same inode, mode, and nlink.
+        The data is only stored with the first entry, which the kernel links to. The size is recorded in the index."""
+        self._write_header(name, S_IFREG | mode, nlink=nlink, inode=inode)
+        self.index[name].size = size
+        return inode
+
+    def add_entry(self, name: str, entry: VirtualEntry, nlink: int = 1) -> int:
+        """Adds an entry from a virtual tree, reading file data from its source.
+        Returns the inode number of the entry. nlink is only used for regular files."""
+        if entry.entry_type == S_IFDIR:
+            inode = self.add_directory(name, entry.get_mode())
+        elif entry.entry_type == S_IFLNK:
+            inode = self.add_symlink(name, entry.target)  # type: ignore[arg-type]
+        elif entry.entry_type == S_IFCHR:
+            inode = self.add_chardev(name, entry.get_mode(), entry.major, entry.minor)
+        elif entry.entry_type != S_IFREG:
+            raise ValueError("[%s] Unsupported entry type: %o" % (name, entry.entry_type))
+        elif entry.data is not None:
+            with entry.open() as data:
+                inode = self.add_file(name, entry.get_mode(), data, len(entry.data), nlink=nlink)
+        elif not entry.decompressor:
+            stat = entry.source.stat()  # type: ignore[union-attr]
+            with entry.open() as data:
+                inode = self.add_file(name, entry.get_mode(), data, stat.st_size, int(stat.st_mtime), nlink)
+        else:  # The decompressed size is not known ahead of time, but must be written in the header
+            with entry.open() as data, SpooledTemporaryFile(_SPOOL_SIZE) as spool:
+                copyfileobj(data, spool, _BUFFER_SIZE)
+                size = spool.tell()
+                spool.seek(0)
+                inode = self.add_file(name, entry.get_mode(), spool, size, nlink=nlink)  # type: ignore[arg-type]
+        self.index[name].entry = entry
+        return inode
+
+    def finish(self) -> None:
+        """Writes the trailer entry, ending the archive."""
+        self._write_header(NEWC_TRAILER, 0, mtime=0)
+
+
+def _get_file_size(entry: VirtualEntry) -> int | None:
+    """Returns the size of a regular file entry, or None if it is not known without decompressing it."""
+    if entry.entry_type != S_IFREG or entry.decompressor:
+        return None
+    if entry.data is not None:
+        return len(entry.data)
+    return entry.source.stat().st_size  # type: ignore[union-attr]
+
+
+def find_duplicates(tree: VirtualTree, names: list[str]) -> dict[str, str]:
+    """Finds regular files with the same contents and mode, returns a dict of duplicate names to the first name.
+    Files are grouped by size first, so only files which may be duplicates are hashed, in bounded chunks.
+    Decompressed and empty files are not deduplicated.
+    """
+    from hashlib import sha256
+
+    by_size: dict[tuple[int, int], list[str]] = {}
+    for name in names:
+        entry = tree.entries[name]
+        if size := _get_file_size(entry):
+            by_size.setdefault((size, entry.get_mode()), []).append(name)
+
+    duplicates = {}
+    for group in by_size.values():
+        if len(group) < 2:
+            continue
+        by_hash: dict[bytes, str] = {}
+        for name in group:
+            digest = sha256()
+            with tree.entries[name].open() as data:
+                while chunk := data.read(_BUFFER_SIZE):
+                    digest.update(chunk)
+            if original := by_hash.get(digest.digest()):
+                duplicates[name] = original
+            else:
+                by_hash[digest.digest()] = name
+    return duplicates
+
+
+def index_tree(tree: VirtualTree) -> dict[str, CPIOIndexEntry]:
+    """Returns an index of the entries in a tree without writing an archive, such as when a cached archive is used.
+    Offsets are not known, so they are set to -1. Decompressed files have a size of 0."""
+    index = {}
+    for name in sorted(tree.entries):
+        entry = tree.entries[name]
+        index[name] = CPIOIndexEntry(name, entry.entry_type | entry.get_mode(), _get_file_size(entry) or 0, -1, entry)
+    return index
+
+
+def write_archive(tree: VirtualTree, out_file: BinaryIO, deduplicate: bool = False) -> dict[str, CPIOIndexEntry]:
+    """Writes all entries in a virtual tree to a file object as a CPIO archive, in sorted order so parents come first.
+    If deduplicate is set, files with the same contents are written as hardlinks, with data on the first entry.
+    Returns the index of the written archive.
+    """
+    names = sorted(tree.entries)
+    duplicates = find_duplicates(tree, names) if deduplicate else {}
+    link_counts: dict[str, int] = {}
+    for original in duplicates.values():
+        link_counts[original] = link_counts.get(original, 1) + 1
+
+    inodes: dict[str, int] = {}
+    writer = CPIOWriter(out_file)
+    for name in names:
+        entry = tree.entries[name]
+        if original := duplicates.get(name):
+            size = _get_file_size(entry) or 0
+            writer.add_hardlink(name, entry.get_mode(), inodes[original], link_counts[original], size)
+            writer.index[name].entry = entry
+        else:
+            inodes[name] = writer.add_entry(name, entry, link_counts.get(name, 1))
+    writer.finish()
+    return writer.index
+
+
+def write_tree(
+    tree: VirtualTree,
+    out_path: Path,
+    compression: str | bool | None,
+    deduplicate: bool = False,
+    compression_threads: int = 1,
+    compression_level: int | None = None,
+) -> dict[str, CPIOIndexEntry]:
+    """Writes all entries in a virtual tree to a CPIO archive file, using write_archive.
+    Compression uses up to compression_threads threads, and the default level unless compression_level is set.
+    Returns the index of the written archive.
+    """
+    with open_compressed(out_path, compression, compression_threads, compression_level) as out_file:
+        return write_archive(tree, out_file, deduplicate)
@@ -1,5 +1,5 @@
 __author__ = "desultory"
-__version__ = "4.2.1"
+__version__ = "4.3.1"
 
 from json import loads
 from pathlib import Path
@@ -0,0 +1,188 @@
+__author__ = "desultory"
+__version__ = "0.2.0"
+
+from contextlib import nullcontext
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH, flock, ioctl
+from hashlib import sha256
+from json import dumps, loads
+from os import getpid, link
+from pathlib import Path
+from shutil import copyfileobj
+from threading import Lock, get_ident
+from time import time
+from typing import IO, BinaryIO, Callable
+
+from .build_manifest import get_file_signature
+from .generator_helpers import FICLONE, copy_file
+
+DECOMPRESSED_STORE_VERSION = 1
+_BUFFER_SIZE = 2**20  # 1 MiB
+
+
+class DecompressedStore:
+    """Stores decompressed copies of compressed files, such as kernel modules and firmware, between builds.
+
+    Files are keyed by the path, size, mtime, and inode of the compressed source,
+    so a changed source is decompressed again.
+    Stored files are reflinked to the destination if possible, otherwise hardlinked, or copied if both fail.
+
+    The index records the size and last use of each file. When saved, the least recently used files are removed
+    until the store is under max_size. Files used by the current build are never removed.
+
+    The store can be used by concurrent builds, such as the workers of build_multi:
+    Builds hold a shared lock on use.lock from the first file they use until the store is closed,
+    files are only evicted when no other build holds it.
+    The index is merged with the index on disk, and saved, under an exclusive lock on index.lock.
+    """
+
+    def __init__(self, store_dir: Path, max_size: int) -> None:
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.index_file = store_dir / "index.json"
+        self.index_lock_file = store_dir / "index.lock"
+        self.use_lock_file = store_dir / "use.lock"
+        self.entries: dict[str, dict] = {}
+        self.used: set[str] = set()
+        self._lock = Lock()  # Files are decompressed in a thread pool
+        self._use_lock: IO | None = None
+        self._use_lock_pid = 0  # Locks inherited by forked processes are shared with the parent
+        self.entries = self._read_index()
+
+    def _read_index(self) -> dict[str, dict]:
+        """Returns the entries of the index on disk, or an empty dict if it is missing or invalid."""
+        try:
+            index = loads(self.index_file.read_text())
+            if index["version"] == DECOMPRESSED_STORE_VERSION:
+                return index["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return {}
+
+    def _hold_use_lock(self) -> None:
+        """Takes a shared lock on the use lock file, if this process does not hold it.
+        It is held until the store is closed, so other builds don't evict files used by this build."""
+        if self._use_lock and self._use_lock_pid == getpid():
+            return
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._use_lock = self.use_lock_file.open("a")
+        self._use_lock_pid = getpid()
+        flock(self._use_lock, LOCK_SH)  # Waits for evictions by other builds
+
+    def close(self) -> None:
+        """Releases the use lock, files used by this build may be evicted by other builds after it is closed."""
+        if self._use_lock and self._use_lock_pid == getpid():
+            self._use_lock.close()
+        self._use_lock = None
+
+    @staticmethod
+    def get_key(source: Path) -> str:
+        """Returns the store key for a source file, raises a FileNotFoundError if it is not a regular file."""
+        if not (signature := get_file_signature(source)):
+            raise FileNotFoundError("Compressed source is not a file: %s" % source)
+        return sha256(("%s\0%d\0%d\0%d" % (source, *signature)).encode()).hexdigest()
+
+    def get_path(self, source: Path, decompressor: Callable[[BinaryIO], BinaryIO]) -> tuple[Path, bool]:
+        """Returns the path of the decompressed source in the store, and whether it was already stored.
+        If it is not stored, it is decompressed to a temporary file, then moved into place."""
+        key = self.get_key(source)
+        stored_path = self.store_dir / key
+        with self._lock:
+            self._hold_use_lock()
+            self.used.add(key)
+            if stored_path.is_file():  # It may have been stored by another build
+                self.entries[key] = {"size": stored_path.stat().st_size, "last_used": time()}
+                return stored_path, True
+
+        temp_path = self.store_dir / f"{key}.{getpid()}.{get_ident()}.tmp"
+        try:
+            with source.open("rb") as compressed_file, decompressor(compressed_file) as decompressed_file:
+                with temp_path.open("wb") as out_file:
+                    copyfileobj(decompressed_file, out_file, _BUFFER_SIZE)
+            temp_path.replace(stored_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+        with self._lock:
+            self.entries[key] = {"size": stored_path.stat().st_size, "last_used": time()}
+        return stored_path, False
+
+    def deploy(self, source: Path, dest: Path, decompressor: Callable[[BinaryIO], BinaryIO]) -> tuple[bool, str]:
+        """Deploys the decompressed source to the destination, which must not exist.
+        Returns whether it was already stored, and the method used to deploy it: reflink, hardlink, or a copy method."""
+        stored_path, stored = self.get_path(source, decompressor)
+        with stored_path.open("rb") as stored_file, dest.open("wb") as dest_file:
+            try:
+                ioctl(dest_file.fileno(), FICLONE, stored_file.fileno())
+                return stored, "reflink"
+            except OSError:
+                pass
+        dest.unlink()
+        try:
+            link(stored_path, dest)
+            return stored, "hardlink"
+        except OSError:  # Not on the same filesystem
+            return stored, copy_file(stored_path, dest)
+
+    def evict(self) -> list[str]:
+        """Removes the least recently used files which are not used by this build, until the store is under max_size.
+        Files in the store directory are scanned, so files missing from the index are also evicted,
+        using their mtime as the last use. Entries for missing files are removed from the index.
+        Must only be run when no other build is using the store. Returns the removed keys."""
+        files = {path.name: path.stat().st_size for path in self.store_dir.iterdir() if not path.suffix}
+        for key in self.entries.keys() - files.keys():
+            del self.entries[key]
+        for key, size in files.items():
+            if key not in self.entries:
+                self.entries[key] = {"size": size, "last_used": (self.store_dir / key).stat().st_mtime}
+            self.entries[key]["size"] = size
+
+        total_size = sum(files.values())
+        removed = []
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            if key in self.used:
+                continue
+            (self.store_dir / key).unlink(missing_ok=True)
+            total_size -= self.entries.pop(key)["size"]
+            removed.append(key)
+        return removed
+
+    def _merge_index(self) -> None:
+        """Merges the index on disk into the entries, keeping the latest use of each file."""
+        for key, entry in self._read_index().items():
+            if key not in self.entries or entry["last_used"] > self.entries[key]["last_used"]:
+                self.entries[key] = entry
+
+    def _try_evict(self) -> list[str]:
+        """Evicts files if no other build holds the use lock, returns the removed keys.
+        Must be run while holding the index lock, which is also held by other builds when they evict.
+        Converting the use lock may briefly release it, but other builds can't evict without the index lock."""
+        own_lock = self._use_lock if self._use_lock_pid == getpid() else None
+        with nullcontext(own_lock) if own_lock else self.use_lock_file.open("a") as use_lock:
+            try:
+                flock(use_lock, LOCK_EX | LOCK_NB)
+            except BlockingIOError:  # Other builds are using the store, it is evicted when they save
+                if own_lock:  # Take the shared lock again, in case the failed conversion released it
+                    flock(own_lock, LOCK_SH)
+                return []
+            try:
+                return self.evict()
+            finally:
+                if own_lock:
+                    flock(own_lock, LOCK_SH)
+
+    def save(self) -> list[str]:
+        """Merges the index on disk, evicts files over the size limit if no other build is using the store,
+        then writes the index to a temporary file and moves it into place, under the index lock.
+        Returns the evicted keys, raises an OSError if the index can't be written."""
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock, self.index_lock_file.open("a") as index_lock:
+            flock(index_lock, LOCK_EX)  # Released when closed
+            self._merge_index()
+            removed = self._try_evict()
+            index = {"version": DECOMPRESSED_STORE_VERSION, "entries": self.entries}
+            temp_file = self.index_file.with_name(f"{self.index_file.name}.{getpid()}.tmp")
+            temp_file.write_text(dumps(index))
+            temp_file.replace(self.index_file)
+        return removed
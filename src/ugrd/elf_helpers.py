@@ -0,0 +1,582 @@
+__author__ = "desultory"
+__version__ = "0.5.0"
+
+from collections import deque
+from functools import cmp_to_key, lru_cache
+from mmap import ACCESS_READ, mmap
+from os import stat
+from pathlib import Path
+from struct import Struct
+from struct import error as StructError
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHN_XINDEX = 0xFFFF
+
+ET_DYN = 3
+
+EM_386 = 3
+EM_SPARC32PLUS = 18
+EM_PPC = 20
+EM_PPC64 = 21
+EM_S390 = 22
+EM_ARM = 40
+EM_SPARCV9 = 43
+EM_X86_64 = 62
+EM_AARCH64 = 183
+EM_RISCV = 243
+EM_LOONGARCH = 258
+
+EF_ARM_ABI_FLOAT_SOFT = 0x200
+EF_ARM_ABI_FLOAT_HARD = 0x400
+EF_RISCV_FLOAT_ABI = 0x6
+EF_RISCV_FLOAT_ABI_SOFT = 0x0
+EF_RISCV_FLOAT_ABI_DOUBLE = 0x4
+EF_LARCH_ABI_MODIFIER_MASK = 0x7
+EF_LARCH_ABI_SOFT_FLOAT = 0x1
+EF_LARCH_ABI_DOUBLE_FLOAT = 0x3
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+LD_SO_CACHE = "/etc/ld.so.cache"
+LD_SO_CACHE_MAGIC = b"glibc-ld.so.cache1.1"
+LD_SO_CACHE_OLD_MAGIC = b"ld.so-1.7.0"
+# The low byte of ld.so.cache entry flags is the library type, the next byte is the architecture, such as x86-64
+LD_SO_CACHE_FLAG_ELF_LIBC6 = 0x0003
+LD_SO_CACHE_FLAG_ARCH_MASK = 0xFF00
+# Searched after rpaths, runpaths and the ld.so.cache, before any additional library paths
+DEFAULT_LIBRARY_PATHS = ["/lib64", "/usr/lib64", "/lib", "/usr/lib"]
+
+# Field layouts following e_ident, for each ELF class
+_ELF_HEADER_FORMATS = {ELFCLASS32: "HHIIIIIHHHHHH", ELFCLASS64: "HHIQQQIHHHHHH"}
+_SECTION_HEADER_FORMATS = {ELFCLASS32: "IIIIIIIIII", ELFCLASS64: "IIQQQQIIQQ"}
+# The 64 bit program header moves p_flags after p_type
+_PROGRAM_HEADER_FORMATS = {ELFCLASS32: "IIIIIIII", ELFCLASS64: "IIQQQQQQ"}
+_DYNAMIC_ENTRY_FORMATS = {ELFCLASS32: "iI", ELFCLASS64: "qQ"}
+# ELFInfo by path, inode and mtime, None for files which are not ELF files
+_ELF_INFO_CACHE: dict[tuple[str, int, int], "ELFInfo | None"] = {}
+
+
+class ELFError(Exception):
+    pass
+
+
+class ELFFile:
+    """Minimal ELF reader, only reads what is needed to extract data from sections.
+
+    The data can be any buffer, such as bytes or an mmap.
+    """
+
+    def __init__(self, data: bytes | mmap | memoryview) -> None:
+        self.data = data
+        if bytes(data[:4]) != ELF_MAGIC:
+            raise ELFError("Invalid ELF magic: %s" % bytes(data[:4]))
+
+        self.elf_class = data[4]
+        if self.elf_class not in _ELF_HEADER_FORMATS:
+            raise ELFError("Invalid ELF class: %s" % self.elf_class)
+
+        if data[5] == ELFDATA2LSB:
+            self.byte_order = "<"
+        elif data[5] == ELFDATA2MSB:
+            self.byte_order = ">"
+        else:
+            raise ELFError("Invalid ELF data encoding: %s" % data[5])
+
+        try:
+            (
+                self.e_type,
+                self.e_machine,
+                _,  # e_version
+                _,  # e_entry
+                self.e_phoff,
+                self.e_shoff,
+                self.e_flags,
+                _,  # e_ehsize
+                self.e_phentsize,
+                self.e_phnum,
+                self.e_shentsize,
+                self.e_shnum,
+                self.e_shstrndx,
+            ) = self._unpack(_ELF_HEADER_FORMATS[self.elf_class], 16)
+        except StructError as e:
+            raise ELFError("Truncated ELF header") from e
+
+        self._sections: dict[str, tuple[int, int, int]] | None = None
+        self._program_headers: list[tuple[int, int, int, int]] | None = None
+        self._dynamic: dict[int, list[int]] | None = None
+
+    @classmethod
+    def from_path(cls, path: Path | str) -> "ELFFile":
+        """Reads an ELF file into memory, using mmap to avoid copying the file."""
+        with open(path, "rb") as f:
+            try:
+                data: bytes | mmap = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError:  # Empty files can't be mapped
+                data = b""
+        return cls(data)
+
+    def _unpack(self, fmt: str, offset: int) -> tuple:
+        return Struct(self.byte_order + fmt).unpack_from(self.data, offset)
+
+    @property
+    def sections(self) -> dict[str, tuple[int, int, int]]:
+        """A dict of section names to (sh_type, sh_offset, sh_size), read when first accessed."""
+        if self._sections is None:
+            self._sections = self._read_sections()
+        return self._sections
+
+    def _read_sections(self) -> dict[str, tuple[int, int, int]]:
+        """Reads the section header table, returning a dict of section names to (sh_type, sh_offset, sh_size)."""
+        if not self.e_shoff:
+            return {}
+
+        fmt = _SECTION_HEADER_FORMATS[self.elf_class]
+        try:
+            headers = [self._unpack(fmt, self.e_shoff)]
+            # When there are more than SHN_LORESERVE sections, the count and string table index are in section 0
+            section_count = self.e_shnum or headers[0][5]
+            shstrndx = headers[0][6] if self.e_shstrndx == SHN_XINDEX else self.e_shstrndx
+            for index in range(1, section_count):
+                headers.append(self._unpack(fmt, self.e_shoff + index * self.e_shentsize))
+            strtab_offset, strtab_size = headers[shstrndx][4], headers[shstrndx][5]
+        except (StructError, IndexError) as e:
+            raise ELFError("Truncated ELF section header table") from e
+
+        strtab = bytes(self.data[strtab_offset : strtab_offset + strtab_size])
+        sections = {}
+        for header in headers:
+            name_offset = header[0]
+            name = strtab[name_offset : strtab.find(b"\0", name_offset)].decode(errors="replace")
+            sections[name] = (header[1], header[4], header[5])
+        return sections
+
+    def get_section_data(self, name: str) -> bytes:
+        """Returns the contents of a section by name, raises an ELFError if the section does not exist."""
+        if name not in self.sections:
+            raise ELFError("Section not found: %s" % name)
+        _, offset, size = self.sections[name]
+        return bytes(self.data[offset : offset + size])
+
+    @property
+    def program_headers(self) -> list[tuple[int, int, int, int]]:
+        """A list of (p_type, p_offset, p_vaddr, p_filesz) for each program header, read when first accessed."""
+        if self._program_headers is None:
+            self._program_headers = self._read_program_headers()
+        return self._program_headers
+
+    def _read_program_headers(self) -> list[tuple[int, int, int, int]]:
+        """Reads the program header table, returning a list of (p_type, p_offset, p_vaddr, p_filesz)."""
+        fmt = _PROGRAM_HEADER_FORMATS[self.elf_class]
+        headers = []
+        try:
+            for index in range(self.e_phnum if self.e_phoff else 0):
+                header = self._unpack(fmt, self.e_phoff + index * self.e_phentsize)
+                if self.elf_class == ELFCLASS64:
+                    headers.append((header[0], header[2], header[3], header[5]))
+                else:
+                    headers.append((header[0], header[1], header[2], header[4]))
+        except StructError as e:
+            raise ELFError("Truncated ELF program header table") from e
+        return headers
+
+    def _vaddr_to_offset(self, vaddr: int) -> int:
+        """Converts a virtual address to a file offset using the PT_LOAD segments."""
+        for p_type, p_offset, p_vaddr, p_filesz in self.program_headers:
+            if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        raise ELFError("Virtual address is not in a loaded segment: %#x" % vaddr)
+
+    def _read_string(self, offset: int) -> str:
+        """Reads a null terminated string from the data at the passed offset."""
+        end = self.data.find(b"\0", offset)
+        if end == -1:
+            raise ELFError("Unterminated string at offset: %#x" % offset)
+        return bytes(self.data[offset:end]).decode(errors="surrogateescape")
+
+    @property
+    def interpreter(self) -> str | None:
+        """The program interpreter from the PT_INTERP segment, None if the file has no interpreter."""
+        for p_type, p_offset, _, p_filesz in self.program_headers:
+            if p_type == PT_INTERP:
+                return bytes(self.data[p_offset : p_offset + p_filesz]).rstrip(b"\0").decode(errors="surrogateescape")
+        return None
+
+    @property
+    def dynamic(self) -> dict[int, list[int]]:
+        """A dict of dynamic section tags to their values, empty if there is no PT_DYNAMIC segment."""
+        if self._dynamic is None:
+            self._dynamic = self._read_dynamic()
+        return self._dynamic
+
+    def _read_dynamic(self) -> dict[int, list[int]]:
+        """Reads the dynamic segment, stops at the DT_NULL entry."""
+        fmt = _DYNAMIC_ENTRY_FORMATS[self.elf_class]
+        entry_size = Struct(fmt).size
+        dynamic: dict[int, list[int]] = {}
+        for p_type, p_offset, _, p_filesz in self.program_headers:
+            if p_type != PT_DYNAMIC:
+                continue
+            try:
+                for offset in range(p_offset, p_offset + p_filesz, entry_size):
+                    tag, value = self._unpack(fmt, offset)
+                    if tag == DT_NULL:
+                        break
+                    dynamic.setdefault(tag, []).append(value)
+            except StructError as e:
+                raise ELFError("Truncated ELF dynamic segment") from e
+        return dynamic
+
+    def get_dynamic_strings(self, tag: int) -> list[str]:
+        """Returns the strings for a dynamic tag which references the dynamic string table, such as DT_NEEDED."""
+        if tag not in self.dynamic:
+            return []
+        if DT_STRTAB not in self.dynamic:
+            raise ELFError("Dynamic segment has no string table")
+        strtab = self._vaddr_to_offset(self.dynamic[DT_STRTAB][0])
+        return [self._read_string(strtab + value) for value in self.dynamic[tag]]
+
+
+class ELFInfo:
+    """The information about an ELF file needed to resolve its shared library dependencies."""
+
+    __slots__ = (
+        "elf_class",
+        "byte_order",
+        "type",
+        "machine",
+        "flags",
+        "interpreter",
+        "needed",
+        "rpath",
+        "runpath",
+        "soname",
+    )
+
+    def __init__(self, elf: ELFFile) -> None:
+        self.elf_class = elf.elf_class
+        self.byte_order = elf.byte_order
+        self.type = elf.e_type
+        self.machine = elf.e_machine
+        self.flags = elf.e_flags
+        self.interpreter = elf.interpreter
+        self.needed = elf.get_dynamic_strings(DT_NEEDED)
+        self.rpath = _split_search_path(elf.get_dynamic_strings(DT_RPATH))
+        self.runpath = _split_search_path(elf.get_dynamic_strings(DT_RUNPATH))
+        soname = elf.get_dynamic_strings(DT_SONAME)
+        self.soname = soname[0] if soname else None
+
+    def is_compatible(self, other: "ELFInfo") -> bool:
+        """Checks that another ELF file can be loaded with this one, the class, byte order and machine must match."""
+        return (self.elf_class, self.byte_order, self.machine) == (other.elf_class, other.byte_order, other.machine)
+
+
+def _split_search_path(search_paths: list[str]) -> list[str]:
+    """Splits : separated DT_RPATH/DT_RUNPATH strings into a list of paths."""
+    return [path for search_path in search_paths for path in search_path.split(":") if path]
+
+
+def _read_elf_info(path: str, inode: int, mtime: int) -> ELFInfo | None:
+    """Reads the dependency information of an ELF file, cached in _ELF_INFO_CACHE by path, inode and mtime.
+    Returns None if the file is not an ELF file."""
+    key = (path, inode, mtime)
+    if key not in _ELF_INFO_CACHE:
+        with open(path, "rb") as f:
+            is_elf = f.read(4) == ELF_MAGIC
+        _ELF_INFO_CACHE[key] = ELFInfo(ELFFile.from_path(path)) if is_elf else None
+    return _ELF_INFO_CACHE[key]
+
+
+def get_elf_info(path: Path | str) -> ELFInfo | None:
+    """Returns the ELFInfo for a file, None if it is not an ELF file.
+    Results are memoized as long as the inode and mtime of the file don't change."""
+    file_stat = stat(path)
+    return _read_elf_info(str(path), file_stat.st_ino, file_stat.st_mtime_ns)
+
+
+def _read_cache_string(data: bytes, offset: int) -> str:
+    """Reads a null terminated string from ld.so.cache data."""
+    try:
+        return data[offset : data.index(b"\0", offset)].decode(errors="surrogateescape")
+    except ValueError as e:
+        raise ELFError("Unterminated string in ld.so.cache at offset: %#x" % offset) from e
+
+
+def _read_ld_so_cache_new(data: bytes, start: int) -> list[tuple[str, int, str, int]]:
+    """Reads new format glibc ld.so.cache entries, starting at the header, returns (name, flags, path, hwcap) tuples.
+
+    The header is: magic[20], nlibs (u32), len_strings (u32), flags (u8), padding[3],
+    extension_offset (u32), unused[3] (u32)
+    Entries are: flags (i32), key (u32), value (u32), osversion (u32), hwcap (u64)
+    String offsets are relative to the start of the header.
+    """
+    byte_order = ">" if data[start + 28] == 3 else "<"  # flags of 3 indicate big endian, 2 little endian
+    try:
+        nlibs, _ = Struct(byte_order + "II").unpack_from(data, start + 20)
+        entry = Struct(byte_order + "iIIIQ")
+        entries = [entry.unpack_from(data, start + 48 + index * entry.size) for index in range(nlibs)]
+    except StructError as e:
+        raise ELFError("Truncated ld.so.cache") from e
+
+    return [
+        (_read_cache_string(data, start + key), flags, _read_cache_string(data, start + value), hwcap)
+        for flags, key, value, _, hwcap in entries
+    ]
+
+
+def _read_ld_so_cache_old(data: bytes) -> list[tuple[str, int, str, int]]:
+    """Reads old format glibc ld.so.cache entries, returns (name, flags, path, hwcap) tuples.
+
+    The header is: magic[11], padding[1], nlibs (u32)
+    Entries are: flags (i32), key (u32), value (u32)
+    String offsets are relative to the end of the entries.
+    """
+    try:
+        (nlibs,) = Struct("=I").unpack_from(data, 12)
+        entry = Struct("=iII")
+        entries = [entry.unpack_from(data, 16 + index * entry.size) for index in range(nlibs)]
+    except StructError as e:
+        raise ELFError("Truncated ld.so.cache") from e
+
+    strings = 16 + nlibs * entry.size
+    return [
+        (_read_cache_string(data, strings + key), flags, _read_cache_string(data, strings + value), 0)
+        for flags, key, value in entries
+    ]
+
+
+@lru_cache(maxsize=None)
+def _read_ld_so_cache(path: str, inode: int, mtime: int) -> dict[str, list[tuple[int, str]]]:
+    """Reads a glibc ld.so.cache, returns a dict of library names to (flags, path) tuples.
+    Entries for each name are in cache order, entries without hwcaps come first.
+
+    The new format is used if present, it may follow the entries of the old format in the same file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if (start := data.find(LD_SO_CACHE_MAGIC)) != -1:
+        entries = _read_ld_so_cache_new(data, start)
+    elif data.startswith(LD_SO_CACHE_OLD_MAGIC):
+        entries = _read_ld_so_cache_old(data)
+    else:
+        raise ELFError("Unknown ld.so.cache format: %s" % path)
+
+    libraries: dict[str, list[tuple[int, str]]] = {}
+    hwcap_libraries: dict[str, list[tuple[int, str]]] = {}
+    for name, flags, lib_path, hwcap in entries:
+        (hwcap_libraries if hwcap else libraries).setdefault(name, []).append((flags, lib_path))
+
+    for name, hwcap_entries in hwcap_libraries.items():
+        libraries.setdefault(name, []).extend(hwcap_entries)
+    return libraries
+
+
+def read_ld_so_cache(path: Path | str = LD_SO_CACHE) -> dict[str, list[tuple[int, str]]]:
+    """Returns a dict of library names to (flags, path) tuples from the ld.so.cache, an empty dict if it doesn't exist.
+    Results are memoized as long as the inode and mtime of the file don't change."""
+    try:
+        file_stat = stat(path)
+    except FileNotFoundError:
+        return {}
+    return _read_ld_so_cache(str(path), file_stat.st_ino, file_stat.st_mtime_ns)
+
+
+def get_ld_so_cache_flags(info: ELFInfo) -> int | None:
+    """Returns the ld.so.cache entry flags for a glibc library, the libc6 type and the architecture flag.
+    Returns None if the architecture flag is not known, such as for MIPS.
+    """
+    is_64 = info.elf_class == ELFCLASS64
+    if info.machine == EM_X86_64:
+        arch_flag = 0x0300 if is_64 else 0x0800  # x86-64 or x32
+    elif info.machine in [EM_386, EM_PPC] or (info.machine == EM_S390 and not is_64):
+        arch_flag = 0x0000
+    elif info.machine in [EM_SPARCV9, EM_SPARC32PLUS] and is_64:
+        arch_flag = 0x0100
+    elif info.machine == EM_S390:
+        arch_flag = 0x0400
+    elif info.machine == EM_PPC64:
+        arch_flag = 0x0500
+    elif info.machine == EM_AARCH64:
+        arch_flag = 0x0A00
+    elif info.machine == EM_ARM and info.flags & EF_ARM_ABI_FLOAT_HARD:
+        arch_flag = 0x0900
+    elif info.machine == EM_ARM and info.flags & EF_ARM_ABI_FLOAT_SOFT:
+        arch_flag = 0x0B00
+    elif info.machine == EM_RISCV and info.flags & EF_RISCV_FLOAT_ABI == EF_RISCV_FLOAT_ABI_SOFT:
+        arch_flag = 0x0F00
+    elif info.machine == EM_RISCV and info.flags & EF_RISCV_FLOAT_ABI == EF_RISCV_FLOAT_ABI_DOUBLE:
+        arch_flag = 0x1000
+    elif info.machine == EM_LOONGARCH and info.flags & EF_LARCH_ABI_MODIFIER_MASK == EF_LARCH_ABI_SOFT_FLOAT:
+        arch_flag = 0x1100
+    elif info.machine == EM_LOONGARCH and info.flags & EF_LARCH_ABI_MODIFIER_MASK == EF_LARCH_ABI_DOUBLE_FLOAT:
+        arch_flag = 0x1200
+    else:
+        return None
+    return LD_SO_CACHE_FLAG_ELF_LIBC6 | arch_flag
+
+
+def _split_digits(name: str) -> list[str]:
+    """Splits a library name into runs of digits and single other characters."""
+    parts: list[str] = []
+    for char in name:
+        if char.isdigit() and parts and parts[-1].isdigit():
+            parts[-1] += char
+        else:
+            parts.append(char)
+    return parts
+
+
+def ld_so_cache_libcmp(name1: str, name2: str) -> int:
+    """Compares library names like glibc's _dl_cache_libcmp, numbers are compared by value and sort after letters."""
+    parts1, parts2 = _split_digits(name1), _split_digits(name2)
+    for part1, part2 in zip(parts1, parts2):
+        if part1.isdigit() and part2.isdigit():
+            if int(part1) != int(part2):
+                return int(part1) - int(part2)
+        elif part1.isdigit():
+            return 1
+        elif part2.isdigit():
+            return -1
+        elif part1 != part2:
+            return ord(part1) - ord(part2)
+    return len(parts1) - len(parts2)
+
+
+def make_ld_so_cache(libraries: dict[str, tuple[int, str]], byte_order: str = "<") -> bytes:
+    """Makes a new format glibc ld.so.cache from a dict of library names to (flags, path).
+
+    Entries are sorted in descending _dl_cache_libcmp order, which the loader uses to binary search the cache.
+    String offsets are relative to the start of the file, no extensions are written.
+    """
+    names = sorted(libraries, key=cmp_to_key(ld_so_cache_libcmp), reverse=True)
+    entry = Struct(byte_order + "iIIIQ")
+    strings_offset = 48 + len(names) * entry.size
+
+    entries = b""
+    strings = b""
+    for name in names:
+        flags, lib_path = libraries[name]
+        key = strings_offset + len(strings)
+        strings += name.encode(errors="surrogateescape") + b"\0"
+        value = strings_offset + len(strings)
+        strings += lib_path.encode(errors="surrogateescape") + b"\0"
+        entries += entry.pack(flags, key, value, 0, 0)
+
+    endian_flag = 3 if byte_order == ">" else 2
+    header = LD_SO_CACHE_MAGIC + Struct(byte_order + "IIB3xI12x").pack(len(names), len(strings), endian_flag, 0)
+    return header + entries + strings
+
+
+def _expand_search_path(search_path: str, origin: Path, elf_class: int) -> str:
+    """Expands the $ORIGIN and $LIB dynamic string tokens in a rpath/runpath entry."""
+    lib = "lib64" if elf_class == ELFCLASS64 else "lib"
+    for token, value in [("ORIGIN", str(origin)), ("LIB", lib)]:
+        search_path = search_path.replace("${%s}" % token, value).replace("$%s" % token, value)
+    return search_path
+
+
+def find_elf_library(
+    name: str,
+    parent: ELFInfo,
+    search_paths: list[str],
+    library_paths: list[str] | tuple[str, ...] = (),
+    ld_so_cache: Path | str = LD_SO_CACHE,
+) -> Path:
+    """Finds a library needed by an ELF file, skipping candidates which are not compatible with the parent.
+
+    If the name contains a /, it is used as a path.
+    Otherwise, searches the passed rpath/runpath search paths, the ld.so.cache, the default library paths,
+    then any additional library paths.
+
+    Raises an ELFError if the library can't be found.
+    """
+    if "/" in name:
+        candidates = [name]
+    else:
+        candidates = [str(Path(path) / name) for path in search_paths]
+        candidates += [lib_path for _, lib_path in read_ld_so_cache(ld_so_cache).get(name, [])]
+        candidates += [str(Path(path) / name) for path in [*DEFAULT_LIBRARY_PATHS, *library_paths]]
+
+    for candidate in candidates:
+        try:
+            info = get_elf_info(candidate)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        if info and parent.is_compatible(info):
+            return Path(candidate)
+    raise ELFError("Unable to find library: %s" % name)
+
+
+def get_elf_dependencies(
+    path: Path | str, library_paths: list[str] | tuple[str, ...] = (), ld_so_cache: Path | str = LD_SO_CACHE
+) -> list[Path]:
+    """Resolves the shared library dependencies of an ELF file, similar to `lddtree -l`.
+
+    Returns a list starting with the file itself, followed by the interpreter, then all libraries.
+    Files which are not ELF files, or are statically linked, only return the file itself.
+
+    DT_RPATH is inherited by loaded libraries if they have no DT_RUNPATH, DT_RUNPATH only applies to the file it is in.
+    Raises an ELFError if a library can't be found.
+    """
+    path = Path(path)
+    info = get_elf_info(path)
+    dependencies = [path]
+    if not info:
+        return dependencies
+
+    resolved: set[str] = set()
+    if info.interpreter:
+        dependencies.append(Path(info.interpreter))
+        resolved.add(Path(info.interpreter).name)  # Libraries needing the interpreter get the same file
+
+    queue: deque[tuple[Path, ELFInfo, list[str]]] = deque([(path, info, [])])
+    while queue:
+        object_path, object_info, inherited_rpath = queue.popleft()
+        origin = object_path.parent
+        rpath = [] if object_info.runpath else inherited_rpath + object_info.rpath
+        search_paths = [_expand_search_path(p, origin, info.elf_class) for p in rpath + object_info.runpath]
+        for name in object_info.needed:
+            if name in resolved:
+                continue
+            resolved.add(name)
+            library = find_elf_library(name, info, search_paths, library_paths, ld_so_cache)
+            if library not in dependencies:
+                dependencies.append(library)
+            if library_info := get_elf_info(library):
+                queue.append((library, library_info, rpath))
+    return dependencies
+
+
+def prefetch_elf_dependencies(
+    path: Path | str, library_paths: list[str] | tuple[str, ...] = ()
+) -> tuple[dict[tuple[str, int, int], ELFInfo | None], str | None]:
+    """Resolves the dependencies of an ELF file in a worker process.
+    Returns the ELFInfo read for the file and its libraries, which can be added to the cache of the parent process
+    with update_elf_info_cache, and the error if the dependencies could not be resolved.
+    """
+    known = set(_ELF_INFO_CACHE)
+    error = None
+    try:
+        get_elf_dependencies(path, library_paths)
+    except (ELFError, OSError) as e:
+        error = str(e)
+    return {key: info for key, info in _ELF_INFO_CACHE.items() if key not in known}, error
+
+
+def update_elf_info_cache(elf_info: dict[tuple[str, int, int], ELFInfo | None]) -> None:
+    """Adds ELFInfo read by prefetch_elf_dependencies to the cache of this process."""
+    _ELF_INFO_CACHE.update(elf_info)
@@ -1,11 +1,51 @@
 __author__ = "desultory"
-__version__ = "3.9.0"
+__version__ = "4.4.5"
 
+from os import uname
 from pathlib import Path
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from typing import TYPE_CHECKING
 
-from pycpio.cpio.symlink import CPIO_Symlink
+from pycpio.errors import UnavailableCompression
+from ugrd.compression import (
+    COMPRESSION_EXTENSIONS,
+    CompressionBenchmark,
+    benchmark_compression,
+    open_compressed,
+    sample_file,
+)
+from ugrd.cpio_writer import index_tree, write_archive, write_tree
+from ugrd.generator_helpers import copy_file
+from ugrd.virtual_tree import VirtualTree
 from zenlib.util import colorize, contains, unset
 
+if TYPE_CHECKING:  # Imported when cpio_cache is used
+    from ugrd.image_cache import ImageCache
+
+# Compression levels tried by cpio_compression = "auto", and the kernel options needed to unpack each type
+_AUTO_COMPRESSION_LEVELS = {"xz": (1, 6, 9), "zstd": (3, 10, 19), "gzip": (1, 6, 9)}
+_KERNEL_COMPRESSION_OPTIONS = {"xz": "CONFIG_RD_XZ", "zstd": "CONFIG_RD_ZSTD", "gzip": "CONFIG_RD_GZIP"}
+_AUTO_SAMPLE_SIZE = 2**24  # 16 MiB of the uncompressed archive is used for benchmarks
+# Config which does not change the contents of the image, ignored when checking the image cache
+_IMAGE_CACHE_IGNORED = [
+    "out_file", "out_dir", "clean", "cpio_rotate", "old_count", "cpio_cache", "cpio_cache_count", "_kernel_versions"
+]
+_AUTO_OBJECTIVES = {
+    "size": lambda result: (result.ratio, -result.decompress_rate),
+    "decompress": lambda result: -result.decompress_rate,
+    "build": lambda result: -result.compress_rate,
+}
+
+
+def _process_cpio_compression_objective(self, objective: str) -> None:
+    """Validates the cpio_compression_objective, which is used to pick a compression type when set to auto."""
+    if objective not in _AUTO_OBJECTIVES:
+        raise ValueError(
+            "Invalid cpio_compression_objective, must be one of %s: %s" % (list(_AUTO_OBJECTIVES), objective)
+        )
+    self.data["cpio_compression_objective"] = objective
+
 
 @contains("check_cpio")
 def check_cpio_deps(self) -> str:
@@ -32,30 +72,36 @@ def check_in_cpio(self) -> str:
     return "All files and lines found in CPIO."
 
 
+def _get_out_file(self) -> str:
+    """Returns the name of the output CPIO archive, the cpio_out_file picked by auto compression if set."""
+    return self.cpio_out_file or self["out_file"]
+
+
 def _check_in_cpio(self, file, lines=[], quiet=False) -> None:
-    """Checks that the file is in the CPIO archive, and it contains the specified lines."""
-    cpio = self._cpio_archive
+    """Checks that the file is in the CPIO archive, and it contains the specified lines.
+    Uses the index of the written archive, file data is read from the source when lines are checked."""
+    index = self.cpio_index
     file = str(file).lstrip("/")  # Normalize as it may be a path
     self.logger.debug("Checking CPIO for dependency: %s" % file)
-    if file not in cpio.entries:
+    if file not in index:
         fp = Path(file)
         while str(fp) not in ["/", "."]:
             fp = fp.parent
-            if str(fp) not in cpio.entries:
+            if str(fp) not in index:
                 continue
 
-            if isinstance(cpio.entries[str(fp)], CPIO_Symlink):
+            if index[str(fp)].is_symlink:
                 self.logger.debug("Resolving CPIO symlink: %s" % fp)
-                return _check_in_cpio(self, cpio.entries[str(fp)].data.decode("ascii").rstrip("\0"), lines, quiet=True)
+                return _check_in_cpio(self, index[str(fp)].read_bytes().decode(), lines, quiet=True)
 
         if not quiet:
-            self.logger.warning("CPIO entries:\n%s" % "\n".join(cpio.entries.keys()))
+            self.logger.warning("CPIO entries:\n%s" % "\n".join(index.keys()))
         raise FileNotFoundError("File not found in CPIO: %s" % file)
     else:
         self.logger.debug("File found in CPIO: %s" % file)
 
     if lines:
-        entry_data = cpio.entries[file].data.decode().splitlines()
+        entry_data = index[file].read_bytes().decode().splitlines()
         for line in lines:
             if line not in entry_data:
                 raise FileNotFoundError("Line not found in CPIO: %s" % line)
@@ -63,45 +109,237 @@ def _check_in_cpio(self, file, lines=[], quiet=False) -> None:
                 self.logger.debug("Line found in CPIO: %s" % line)
 
 
-@unset("out_file")
-def get_archive_name(self) -> None:
-    """Determines the filename for the output CPIO archive based on the current configuration.
-    Sets the 'out_file' key in the configuration dictionary.
-    """
-    if self.get("kmod_init") and self.get("kernel_version"):
+def _get_archive_name(self, compression_type) -> str:
+    """Returns the default archive name for a compression type.
+    The kernel version is included if kernel modules are loaded, or if images are built for multiple kernels.
+    No extension is added if compression is disabled, or if it is set to auto, before a type is picked."""
+    if self.get("kernel_version") and (self.get("kmod_init") or self.get("_kernel_versions")):
         out_file = f"ugrd-{self['kernel_version']}.cpio"
     else:
         out_file = "ugrd.cpio"
 
-    if compression_type := self["cpio_compression"]:
+    if compression_type:
         # if --compress or --no-compress is set, the type string will be a bool
-        if compression_type.lower() != "false":
+        compression_type = str(compression_type).lower()
+        if compression_type not in ["false", "auto"]:
             # Ignore the extention if compression is set to false
-            if compression_type.lower() == "true":
+            if compression_type == "true":
                 # If set to true, xz is the default compression type
                 compression_type = "xz"
-            out_file += f".{compression_type}"
-    self["out_file"] = out_file
+            out_file += f".{COMPRESSION_EXTENSIONS.get(compression_type, compression_type)}"
+    return out_file
+
+
+@unset("out_file")
+def get_archive_name(self) -> None:
+    """Determines the filename for the output CPIO archive based on the current configuration.
+    Sets the 'out_file' key in the configuration dictionary.
+    """
+    self["out_file"] = _get_archive_name(self, self["cpio_compression"])
 
 
 def make_cpio(self) -> None:
     """
-    Populates the CPIO archive using the build directory,
-    toggles the deduplication setting based on cpio_deduplicate,
-    writes it to the output file, and rotates the output file if necessary.
+    Writes the CPIO archive from the build directory, or the virtual tree if direct_cpio is enabled.
+    Entries are written in sorted order, file data is streamed from the source in bounded chunks.
+    Duplicate files are written as hardlinks if cpio_deduplicate is set.
+    Compression uses cpio_compression_threads threads, all CPUs are used if set to 0.
+    If cpio_compression is set to auto, the compression type and level are picked by benchmarking the archive.
+    If cpio_cache is enabled, a cached archive from a build with the same inputs is used instead, if available.
+    Rotates the output file if necessary.
+
     Creates device nodes in the CPIO archive if make_nodes is False. (make_nodes will create actual files instead)
-    Raises FileNotFoundError if the output directory does not exist.
+    Sets the cpio_index used by CPIO checks.
     """
-    cpio = self._cpio_archive
-    cpio.deduplicate = self["cpio_deduplicate"]
-    cpio.append_recursive(self._get_build_path("/"), relative=True)
+    self.cpio_out_file = None
+    if self["direct_cpio"]:
+        tree = self.virtual_tree
+    else:
+        tree = VirtualTree.from_directory(self._get_build_path("/"))
 
-    if not self.get("make_nodes"):
+    if self["direct_cpio"] or not self.get("make_nodes"):
         for node in self["nodes"].values():
             self.logger.debug("Adding CPIO node: %s" % node)
-            cpio.add_chardev(name=node["path"], mode=node["mode"], major=node["major"], minor=node["minor"])
+            tree.add_chardev(node["path"], node["mode"], node["major"], node["minor"])
+
+    if cache := _get_image_cache(self):
+        cache_key = _get_image_cache_key(self)
+        if cached_image := cache.get(cache_key):
+            return _use_cached_image(self, tree, cached_image)
+        self.logger.debug("Image cache miss: %s" % cache_key)
+
+    threads = self["cpio_compression_threads"] or self._get_max_workers()
+    self.logger.debug("Compressing CPIO archive using %d threads" % threads)
+
+    if str(self["cpio_compression"]).lower() == "auto":
+        _make_auto_compressed_cpio(self, tree, threads)
+    else:
+        out_cpio = _prepare_out_file(self)
+        level = self.get("cpio_compression_level")
+        level = None if level is None or level < 0 else level  # 0 is a valid level
+        index = write_tree(tree, out_cpio, self["cpio_compression"], self["cpio_deduplicate"], threads, level)
+        self.cpio_index = index
+        self.logger.info(
+            "Wrote %s entries to CPIO archive: %s"
+            % (colorize(len(index), "cyan"), colorize(out_cpio, "green", bright=True))
+        )
+
+    if cache:
+        _save_cached_image(self, cache, cache_key)
+
+
+def _get_image_cache(self) -> "ImageCache | None":
+    """Returns the image cache under cache_dir, or None if cpio_cache is disabled or no cache_dir is set."""
+    if not self.get("cpio_cache") or not self.get("cache_dir"):
+        return None
+    from ugrd.image_cache import ImageCache
+
+    return ImageCache(self["cache_dir"] / "images", self["cpio_cache_count"])
 
-    out_cpio = self._get_out_path(self["out_file"])
+
+def _get_image_cache_key(self) -> str:
+    """Returns the manifest hash of the build, which is used as the image cache key.
+    Hashes the final config, the signatures of source files, and the generated init and profile."""
+    from ugrd.image_cache import get_manifest_hash
+
+    config = {key: value for key, value in self.config_dict.data.items() if key not in _IMAGE_CACHE_IGNORED}
+    sources = [Path(copy["source"]) for copy in self["copies"].values()]
+    generated_files = {}
+    for path in ["init", "etc/profile", self.get("_custom_init_file")]:
+        if path and self._build_path_exists(path):
+            generated_files[str(path)] = self._read_build_file(path)
+    return get_manifest_hash(config, sources, generated_files)
+
+
+def _use_cached_image(self, tree: VirtualTree, cached_image: Path) -> None:
+    """Copies or reflinks a cached image to the output file.
+    The tree is indexed without writing it, so CPIO checks can still be run."""
+    if str(self["cpio_compression"]).lower() == "auto" and self["out_file"] == _get_archive_name(self, "auto"):
+        self.cpio_out_file = cached_image.name
+    out_cpio = _prepare_out_file(self)
+    method = copy_file(cached_image, out_cpio)
+    self.cpio_index = index_tree(tree)
+    self.logger.info(
+        "Inputs are unchanged, using cached CPIO archive (%s): %s"
+        % (method, colorize(out_cpio, "green", bright=True))
+    )
+
+
+def _save_cached_image(self, cache: "ImageCache", cache_key: str) -> None:
+    """Copies the written image into the image cache, logging a warning if it can't be written."""
+    try:
+        cached_image = cache.store(cache_key, self._get_out_path(_get_out_file(self)))
+        self.logger.info("Saved CPIO archive to the image cache: %s" % colorize(cached_image, "green"))
+    except OSError as e:
+        self.logger.warning("Unable to write image cache: %s" % e)
+        self.logger.info(f"Set {colorize('cpio_cache', 'blue')}=false to disable the image cache.")
+
+
+def _get_kernel_compressions(self) -> list[str] | None:
+    """Returns the initramfs compression types enabled in the kernel config, or None if the config is not found.
+    Checks kernel_config_file, the kernel build dir, /boot, and /proc/config.gz if it is the running kernel."""
+    kernel_version = self.get("kernel_version") or uname().release
+    config_files = [
+        self.get("kernel_config_file"),
+        Path("/lib/modules") / kernel_version / "build" / ".config",
+        Path("/boot") / f"config-{kernel_version}",
+    ]
+    if kernel_version == uname().release:
+        config_files.append(Path("/proc/config.gz"))
+
+    for config_file in config_files:
+        if config_file and Path(config_file).is_file():
+            break
+    else:
+        self.logger.warning("[%s] Kernel config not found, compression support cannot be checked." % kernel_version)
+        return None
+
+    self.logger.debug("Checking initramfs compression support in kernel config: %s" % config_file)
+    from gzip import open as gzip_open
+
+    with (gzip_open if str(config_file).endswith(".gz") else open)(config_file, "rt") as f:
+        enabled = {line.split("=")[0] for line in f if line.strip().endswith("=y")}
+    return [compression for compression, option in _KERNEL_COMPRESSION_OPTIONS.items() if option in enabled]
+
+
+def _benchmark_compressions(self, sample: bytes, threads: int) -> list[CompressionBenchmark]:
+    """Benchmarks each compression type and level supported by the kernel against the sample.
+    Compression types without an available compressor are skipped."""
+    compressions = _get_kernel_compressions(self)
+    if compressions is None:
+        compressions = list(_AUTO_COMPRESSION_LEVELS)
+    elif not compressions:
+        raise UnavailableCompression("The kernel config does not enable any supported initramfs compression.")
+
+    results = []
+    for compression in compressions:
+        for level in _AUTO_COMPRESSION_LEVELS[compression]:
+            try:
+                results.append(benchmark_compression(sample, compression, level, threads))
+            except UnavailableCompression as e:
+                self.logger.warning("Skipping compression benchmark: %s" % e)
+                break
+    if not results:
+        raise UnavailableCompression("No compressor is available for: %s" % ", ".join(compressions))
+    return results
+
+
+def _log_benchmarks(self, results: list[CompressionBenchmark], archive_size: int, best: CompressionBenchmark) -> None:
+    """Logs the measured results for each benchmark, with the image size and times estimated for the full archive."""
+    header = ("Type", "Level", "Ratio", "Compress MB/s", "Decompress MB/s", "Est. size")
+    lines = ["%-6s %5s %7s %14s %16s %10s" % header]
+    for result in results:
+        line = "%-6s %5d %7.3f %14.1f %16.1f %9.1fM" % (
+            result.compression,
+            result.level,
+            result.ratio,
+            result.compress_rate / 2**20,
+            result.decompress_rate / 2**20,
+            archive_size * result.ratio / 2**20,
+        )
+        lines.append(colorize(line, "green", bright=True) if result is best else line)
+    sample_size = results[0].input_size / 2**20
+    self.logger.info("Compression benchmarks for a %.1fM sample:\n%s" % (sample_size, "\n".join(lines)))
+
+
+def _make_auto_compressed_cpio(self, tree: VirtualTree, threads: int) -> None:
+    """Writes the archive uncompressed to a temporary file, then benchmarks compression types and levels on a sample.
+    The result which best fits cpio_compression_objective is used to compress the archive to the output file.
+    If out_file was generated, cpio_out_file is set to it with the extension of the picked compression type.
+    """
+    with TemporaryFile(dir=self["tmpdir"]) as archive:
+        index = write_archive(tree, archive, self["cpio_deduplicate"])
+        archive_size = archive.tell()
+        sample = sample_file(archive, archive_size, _AUTO_SAMPLE_SIZE)
+
+        results = _benchmark_compressions(self, sample, threads)
+        best = min(results, key=_AUTO_OBJECTIVES[self["cpio_compression_objective"]])
+        _log_benchmarks(self, results, archive_size, best)
+        self.logger.info(
+            "Using compression for objective '%s': %s"
+            % (self["cpio_compression_objective"], colorize(f"{best.compression}-{best.level}", "cyan", bold=True))
+        )
+
+        if self["out_file"] == _get_archive_name(self, "auto"):
+            self.cpio_out_file = _get_archive_name(self, best.compression)
+        out_cpio = _prepare_out_file(self)
+        archive.seek(0)
+        with open_compressed(out_cpio, best.compression, threads, best.level) as out_file:
+            copyfileobj(archive, out_file, 2**20)
+
+    self.cpio_index = index
+    self.logger.info(
+        "Wrote %s entries to CPIO archive: %s"
+        % (colorize(len(index), "cyan"), colorize(out_cpio, "green", bright=True))
+    )
+
+
+def _prepare_out_file(self) -> Path:
+    """Returns the path of the output CPIO archive, creating the output directory if needed.
+    Rotates or removes an existing file based on cpio_rotate and clean.
+    Raises a FileExistsError if the file exists, and cleaning/rotation are disabled.
+    """
+    out_cpio = self._get_out_path(_get_out_file(self))
     if not out_cpio.parent.exists():
         self._mkdir(out_cpio.parent, resolve_build=False)
 
@@ -113,5 +351,4 @@ def make_cpio(self) -> None:
             out_cpio.unlink()
         else:
             raise FileExistsError("File already exists, and cleaning/rotation are disabled: %s" % out_cpio)
-
-    cpio.write_cpio_file(out_cpio, compression=self["cpio_compression"], _log_bump=-10)
+    return out_cpio
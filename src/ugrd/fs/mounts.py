@@ -1,5 +1,5 @@
 __author__ = "desultory"
-__version__ = "7.3.5"
+__version__ = "7.3.6"
 
 from pathlib import Path
 from re import search
@@ -935,7 +935,7 @@ def mount_fstab(self) -> list[str]:
     mount_retries sets the number of times to retry the mount, infinite otherwise.
     If space is pressed during the wait, the mount process will be aborted, and execution will continue
     """
-    if not self._get_build_path("/etc/fstab").exists():
+    if not self._build_path_exists("/etc/fstab"):
         return self.logger.info(
             "No initramfs fstab found, skipping mount_fstab. If non-root storage devices are not needed at boot, this is fine."
         )
@@ -1,8 +1,9 @@
-__version__ = "2.1.0"
+__version__ = "2.1.1"
 
 from re import match
 from tempfile import TemporaryDirectory
 
+from ugrd.exceptions import ValidationError
 from zenlib.util import colorize as c_
 from zenlib.util import contains
 
@@ -142,6 +143,8 @@ def make_test_luks_image(self, image_path) -> None:
 
 def make_test_image(self) -> None:
     """Creates a test image from the build dir"""
+    if self["direct_cpio"]:
+        raise ValidationError("Test images are created from the build directory, which is not used with direct_cpio.")
     build_dir = self._get_build_path("/").resolve()
     self.logger.log(33, f"Creating test image from build directory: {c_(build_dir, 'blue', bold=True)}")
 
@@ -1,17 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from fcntl import ioctl
+from os import copy_file_range
 from pathlib import Path
-from shutil import copy2
-from subprocess import CompletedProcess, TimeoutExpired, run
+from shutil import copyfileobj, copystat
+from stat import S_IFLNK
+from tempfile import NamedTemporaryFile
 from uuid import uuid4
 
 from zenlib.util import colorize as c_
 from zenlib.util import pretty_print
 
+from .command_runner import CommandRunner
 from .exceptions import ValidationError
+from .import_order import ImportOrderError, get_order_edges, sort_functions
 from .initramfs_protocol import InitramfsProtocol
+from .lazy_format import lazy_c_
 
-__version__ = "2.0.0"
+__version__ = "2.6.2"
 
 _RANDOM_BUILD_ID = str(uuid4())
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), clones file extents on filesystems with reflink support
+_COPY_CHUNK_SIZE = 2**24  # 16 MiB, the maximum amount copied per copy_file_range call
+
+
+def copy_file(source: Path, dest: Path) -> str:
+    """Copies a file and its metadata, like shutil.copy2.
+
+    The data is reflinked with FICLONE if the filesystem supports it, such as btrfs or xfs.
+    Otherwise, it is copied in the kernel with copy_file_range, or read and written if that fails.
+
+    Returns the method used to copy the data.
+    """
+    with open(source, "rb") as source_file, open(dest, "wb") as dest_file:
+        try:
+            ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+            method = "reflink"
+        except OSError:
+            try:
+                offset = 0
+                source_fd, dest_fd = source_file.fileno(), dest_file.fileno()
+                while copied := copy_file_range(source_fd, dest_fd, _COPY_CHUNK_SIZE, offset, offset):
+                    offset += copied
+                method = "copy_file_range"
+            except OSError:  # Not supported between these filesystems, or by the kernel
+                dest_file.seek(0)
+                dest_file.truncate()
+                copyfileobj(source_file, dest_file)
+                method = "copy"
+    copystat(source, dest)
+    return method
 
 
 def get_subpath(path: Path, subpath: Path | str) -> Path:
@@ -27,7 +64,7 @@ def get_subpath(path: Path, subpath: Path | str) -> Path:
     return path / subpath
 
 
-class GeneratorHelpers(InitramfsProtocol):
+class GeneratorHelpers(CommandRunner, InitramfsProtocol):
     """Mixin class for the InitramfsGenerator class."""
 
     def _get_out_path(self, path: Path | str) -> Path:
@@ -48,35 +85,66 @@ class GeneratorHelpers(InitramfsProtocol):
             return get_subpath(build_dir, path)
         return get_subpath(get_subpath(self["tmpdir"], build_dir), path)
 
+    def _get_virtual_path(self, path: Path | str, resolve_build: bool = True) -> str | None:
+        """Returns the path in the virtual tree if direct_cpio is enabled, and the path is in the build directory.
+        Otherwise, returns None, so the build directory is used.
+        """
+        if not self.get("direct_cpio"):
+            return None
+        build_path = self._get_build_path(path) if resolve_build else Path(path)
+        try:
+            return str(build_path.relative_to(self._get_build_path("/")))
+        except ValueError:
+            return None
+
+    def _build_path_exists(self, path: Path | str) -> bool:
+        """Checks if a path exists within the build directory, or the virtual tree if direct_cpio is enabled."""
+        if (virtual_path := self._get_virtual_path(path)) is not None:
+            return virtual_path in self.virtual_tree
+        return self._get_build_path(path).exists()
+
+    def _read_build_file(self, path: Path | str) -> str:
+        """Reads a text file within the build directory, or the virtual tree if direct_cpio is enabled."""
+        if (virtual_path := self._get_virtual_path(path)) is not None:
+            return self.virtual_tree.read_bytes(virtual_path).decode()
+        return self._get_build_path(path).read_text()
+
     def _mkdir(self, path: Path, resolve_build: bool = True) -> None:
         """
         Creates a directory within the build directory.
         If resolve_build is True, the path is resolved to the build directory.
         If not, the provided path is used as-is.
+
+        If direct_cpio is enabled, directories within the build directory are created in the virtual tree.
         """
+        if (virtual_path := self._get_virtual_path(path, resolve_build)) is not None:
+            self.logger.log(5, "Creating virtual directory: %s", virtual_path)
+            self.virtual_tree.mkdir(virtual_path)
+            return
+
         if resolve_build:
             path = self._get_build_path(path)
 
-        self.logger.log(5, "Creating directory: %s" % path)
+        self.logger.log(5, "Creating directory: %s", path)
         if path.is_dir():
             path_dir = path.parent
-            self.logger.debug("Directory path: %s" % path_dir)
+            self.logger.debug("Directory path: %s", path_dir)
         else:
             path_dir = path
 
         while path_dir.is_symlink():
             path_dir = self._get_build_path(path_dir.resolve())
-            self.logger.debug("[%s] Resolved directory symlink: %s" % (path, path_dir))
+            self.logger.debug("[%s] Resolved directory symlink: %s", path, path_dir)
 
         if not path_dir.parent.is_dir():
-            self.logger.debug("Parent directory does not exist: %s" % path_dir.parent)
+            self.logger.debug("Parent directory does not exist: %s", path_dir.parent)
             self._mkdir(path_dir.parent, resolve_build=False)
 
         if not path_dir.is_dir():
             path_dir.mkdir()
-            self.logger.log(self["_build_log_level"], "Created directory: %s" % c_(path, "green"))
+            self.logger.log(self["_build_log_level"], "Created directory: %s", lazy_c_(path, "green"))
         else:
-            self.logger.debug("Directory already exists: %s" % path_dir)
+            self.logger.debug("Directory already exists: %s", path_dir)
 
     def _write(
         self, file_name: Path | str, contents: list[str] | str, chmod_mask: int = 0o644, append: bool = False
@@ -86,31 +154,79 @@ class GeneratorHelpers(InitramfsProtocol):
         Sets the passed chmod_mask.
         If the first line is a shebang, sh -n is run on the file.
         """
+        if isinstance(contents, list):
+            contents = "\n".join(contents)
+
+        if (virtual_path := self._get_virtual_path(file_name)) is not None:
+            return self._write_virtual(virtual_path, contents, chmod_mask, append)
+
         file_path = self._get_build_path(file_name)
 
         if not file_path.parent.is_dir():
-            self.logger.debug("Parent directory for '%s' does not exist: %s" % (file_path.name, file_path))
+            self.logger.debug("Parent directory for '%s' does not exist: %s", file_path.name, file_path)
             self._mkdir(file_path.parent, resolve_build=False)
 
-        if isinstance(contents, list):
-            contents = "\n".join(contents)
-
+        self._release_kept_file(file_path)
         if file_path.is_file():
             self.logger.warning("File already exists: %s" % c_(file_path, "yellow"))
             if contents in file_path.read_text():
-                self.logger.debug("Contents:\n%s" % contents)
+                self.logger.debug("Contents:\n%s", contents)
                 return self.logger.warning("Contents are already present, skipping write: %s" % file_path)
 
             if self["clean"] and not append:
                 self.logger.warning("Deleting file: %s" % c_(file_path, "red", bright=True, bold=True))
                 file_path.unlink()
 
-        self.logger.debug("[%s] Writing contents:\n%s" % (file_path, contents))
+        self.logger.debug("[%s] Writing contents:\n%s", file_path, contents)
         with open(file_path, "a") as file:
             file.write(contents)
 
+        self._check_shell_script(file_path, contents)
+
+        self.logger.info("Wrote file: %s" % c_(file_path, "green", bright=True))
+        file_path.chmod(chmod_mask)
+        self.logger.debug("[%s] Set file permissions: %s", file_path, chmod_mask)
+
+    def _release_kept_file(self, file_path: Path) -> None:
+        """Removes a file which was kept from the previous incremental build, but was not deployed in this build.
+        Used before a file is generated or replaced by a symlink, so it does not contain the previous contents."""
+        if self.build_manifest and self.build_manifest.release(file_path):
+            self.logger.debug("Removing file kept from the previous build: %s", file_path)
+            file_path.unlink()
+
+    def _write_virtual(self, virtual_path: str, contents: str, chmod_mask: int, append: bool) -> None:
+        """Writes text to a file in the virtual tree, used by _write when direct_cpio is enabled.
+        Shell scripts are checked using a temporary file."""
+        existing = ""
+        if self.virtual_tree.is_file(virtual_path):
+            self.logger.warning("Virtual file already exists: %s" % c_(virtual_path, "yellow"))
+            existing = self.virtual_tree.read_bytes(virtual_path).decode()
+            if contents in existing:
+                self.logger.debug("Contents:\n%s", contents)
+                return self.logger.warning("Contents are already present, skipping write: %s" % virtual_path)
+
+            if self["clean"] and not append:
+                self.logger.warning("Replacing virtual file: %s" % c_(virtual_path, "red", bright=True, bold=True))
+                existing = ""
+
+        self.logger.debug("[%s] Writing virtual contents:\n%s", virtual_path, contents)
         if contents.startswith(self["shebang"].split(" ")[0]):
-            self.logger.debug("Running sh -n on file: %s" % file_name)
+            with NamedTemporaryFile("w", prefix="ugrd-", suffix=".sh") as script:
+                script.write(existing + contents)
+                script.flush()
+                self._check_shell_script(Path(script.name), contents, virtual_path)
+        else:
+            self._check_shell_script(None, contents, virtual_path)
+
+        self.virtual_tree.add_data(virtual_path, (existing + contents).encode(), chmod_mask)
+        self.logger.info("Wrote virtual file: %s" % c_(virtual_path, "green", bright=True))
+
+    def _check_shell_script(self, file_path: Path | None, contents: str, file_name: Path | str | None = None) -> None:
+        """Runs sh -n on a written file if the contents start with the configured shebang.
+        Raises a ValidationError if the script is invalid."""
+        file_name = file_name or file_path
+        if contents.startswith(self["shebang"].split(" ")[0]):
+            self.logger.debug("Running sh -n on file: %s", file_name)
             try:
                 self._run(["sh", "-n", str(file_path)])
             except RuntimeError as e:
@@ -119,9 +235,20 @@ class GeneratorHelpers(InitramfsProtocol):
         elif contents.startswith("#!"):
             self.logger.warning("[%s] Skipping sh -n on file with unrecognized shebang: %s" % (file_name, contents[0]))
 
-        self.logger.info("Wrote file: %s" % c_(file_path, "green", bright=True))
+    def _write_bytes(self, file_name: Path | str, data: bytes, chmod_mask: int = 0o644) -> None:
+        """Writes binary data to a file within the build directory, replacing it if it exists.
+        If direct_cpio is enabled, the data is added to the virtual tree."""
+        if (virtual_path := self._get_virtual_path(file_name)) is not None:
+            self.virtual_tree.add_data(virtual_path, data, chmod_mask)
+            return self.logger.info("Wrote virtual file: %s" % c_(virtual_path, "green", bright=True))
+
+        file_path = self._get_build_path(file_name)
+        if not file_path.parent.is_dir():
+            self._mkdir(file_path.parent, resolve_build=False)
+        self._release_kept_file(file_path)
+        file_path.write_bytes(data)
         file_path.chmod(chmod_mask)
-        self.logger.debug("[%s] Set file permissions: %s" % (file_path, chmod_mask))
+        self.logger.info("Wrote file: %s" % c_(file_path, "green", bright=True))
 
     def _copy(self, source: Path | str, dest: Path | str | None = None) -> None:
         """Copies a file into the initramfs build directory.
@@ -131,12 +258,49 @@ class GeneratorHelpers(InitramfsProtocol):
         Crates parent directories if they do not exist
 
         Raises a RuntimeError if the destination path is not within the build directory.
+
+        If direct_cpio is enabled, the source is added to the virtual tree, and read when the archive is written.
         """
         if not isinstance(source, Path):
             source = Path(source)
 
+        if (virtual_path := self._get_virtual_path(dest or source)) is not None:
+            return self._copy_virtual(source, virtual_path)
+
+        dest_path = self._get_copy_dest(source, dest)
+        if not dest_path.parent.is_dir():
+            self.logger.debug("Parent directory for '%s' does not exist: %s", dest_path.name, dest_path.parent)
+            self._mkdir(dest_path.parent, resolve_build=False)
+
+        self._copy_checked(source, dest_path)
+
+    def _copy_virtual(self, source: Path, virtual_path: str) -> None:
+        """Adds a file to the virtual tree, reading it from the source when the archive is written.
+        If the destination is a directory, the source filename is appended."""
+        if self.virtual_tree.is_dir(virtual_path):
+            self.logger.debug("Destination is a directory, adding source filename: %s", source.name)
+            virtual_path = f"{self.virtual_tree.resolve(virtual_path)}/{source.name}"
+
+        if self.virtual_tree.is_file(virtual_path):
+            self.logger.warning(
+                "Virtual file already exists, overwriting: %s" % c_(virtual_path, "yellow", bright=True)
+            )
+
+        virtual_path = self.virtual_tree.add_file(virtual_path, source)
+        self.logger.log(
+            self["_build_log_level"], "Adding '%s' as '%s'", lazy_c_(source, "blue"), lazy_c_(virtual_path, "green")
+        )
+
+    def _get_copy_dest(self, source: Path, dest: Path | str | None = None) -> Path:
+        """Returns the destination path for a copy within the build directory.
+        If a destination is not provided, the source is used, under the build directory.
+        If the destination is a directory, the source filename is appended.
+
+        Symlinked parent directories are resolved.
+        Raises a RuntimeError if the destination path is not within the build directory.
+        """
         if not dest:
-            self.logger.log(5, "No destination specified, using source: %s" % source)
+            self.logger.log(5, "No destination specified, using source: %s", source)
             dest = source
 
         dest_path = self._get_build_path(dest)
@@ -144,17 +308,11 @@ class GeneratorHelpers(InitramfsProtocol):
 
         while dest_path.parent.is_symlink():
             resolved_path = dest_path.parent.resolve() / dest_path.name
-            self.logger.debug("Resolved symlink: %s -> %s" % (dest_path, resolved_path))
+            self.logger.debug("Resolved symlink: %s -> %s", dest_path, resolved_path)
             dest_path = self._get_build_path(resolved_path)
 
-        if not dest_path.parent.is_dir():
-            self.logger.debug("Parent directory for '%s' does not exist: %s" % (dest_path.name, dest_path.parent))
-            self._mkdir(dest_path.parent, resolve_build=False)
-
-        if dest_path.is_file():
-            self.logger.warning("File already exists, overwriting: %s" % c_(dest_path, "yellow", bright=True))
-        elif dest_path.is_dir():
-            self.logger.debug("Destination is a directory, adding source filename: %s" % source.name)
+        if dest_path.is_dir():
+            self.logger.debug("Destination is a directory, adding source filename: %s", source.name)
             dest_path = dest_path / source.name
 
         try:  # Ensure the target is in the build directory
@@ -162,8 +320,62 @@ class GeneratorHelpers(InitramfsProtocol):
         except ValueError as e:
             raise RuntimeError("Destination path is not within the build directory: %s" % dest_path) from e
 
-        self.logger.log(self["_build_log_level"], "Copying '%s' to '%s'" % (c_(source, "blue"), c_(dest_path, "green")))
-        copy2(source, dest_path)
+        return dest_path
+
+    def _copy_checked(self, source: Path, dest_path: Path) -> None:
+        """Copies a file to a resolved destination path in the build directory, with an existing parent directory.
+        For incremental builds, the copy is skipped if the file was copied from the same, unchanged source."""
+        if self.build_manifest and self.build_manifest.is_current(dest_path, source):
+            return self.logger.log(5, "[%s] Source is unchanged, keeping: %s", source, dest_path)
+
+        if dest_path.is_file():
+            self.logger.warning("File already exists, overwriting: %s" % c_(dest_path, "yellow", bright=True))
+
+        self.logger.log(
+            self["_build_log_level"], "Copying '%s' to '%s'", lazy_c_(source, "blue"), lazy_c_(dest_path, "green")
+        )
+        method = copy_file(source, dest_path)
+        self.logger.log(5, "[%s] Copied using: %s", dest_path, method)
+        if self.build_manifest:
+            self.build_manifest.record(dest_path, source)
+
+    def _copy_many(self, copies: list[tuple[Path | str, Path | str | None]]) -> None:
+        """Copies many files into the initramfs build directory, using a thread pool.
+        Takes a list of (source, destination) tuples, if the destination is None, the source is used.
+
+        Destination paths are resolved first, then all parent directories are created, then files are copied.
+        If multiple copies have the same destination, the last one is used.
+        """
+        if self.get("direct_cpio"):  # Files are read when the archive is written, nothing to copy yet
+            for source, dest in copies:
+                self._copy(source, dest)
+            return
+
+        destinations: dict[Path, Path] = {}
+        for source, dest in copies:
+            source = Path(source)
+            dest_path = self._get_copy_dest(source, dest)
+            if dest_path in destinations:
+                self.logger.warning(
+                    "[%s] Destination is used by multiple copies, using: %s" % (dest_path, c_(source, "yellow"))
+                )
+                destinations.pop(dest_path)
+            destinations[dest_path] = source
+
+        for parent in sorted({dest_path.parent for dest_path in destinations}):
+            if not parent.is_dir():
+                self.logger.debug("Creating parent directory for copies: %s", parent)
+                self._mkdir(parent, resolve_build=False)
+
+        if not destinations:
+            return
+
+        max_workers = min(self._get_max_workers(), len(destinations))
+        self.logger.debug("Copying %d files using %d workers", len(destinations), max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._copy_checked, source, dest) for dest, source in destinations.items()]
+            for future in futures:
+                future.result()  # Raise any exceptions
 
     def _symlink(self, source: Path | str, target: Path | str) -> None:
         """Creates a symlink in the build directory.
@@ -174,29 +386,33 @@ class GeneratorHelpers(InitramfsProtocol):
 
         If the symlink source is under a symlink in the build directory, resolve to the actual path.
         """
+        if (virtual_path := self._get_virtual_path(target)) is not None:
+            return self._symlink_virtual(str(source), virtual_path)
+
         if not isinstance(source, Path):
             source = Path(source)
 
         target = self._get_build_path(target)
 
         while target.parent.is_symlink():
-            self.logger.debug("Resolving target parent symlink: %s" % target.parent)
+            self.logger.debug("Resolving target parent symlink: %s", target.parent)
             resolved_target = target.parent.resolve() / target.name
             target = self._get_build_path(resolved_target)
 
         if not target.parent.is_dir():
-            self.logger.debug("Parent directory for '%s' does not exist: %s" % (target.name, target.parent))
+            self.logger.debug("Parent directory for '%s' does not exist: %s", target.name, target.parent)
             self._mkdir(target.parent, resolve_build=False)
 
         build_source = self._get_build_path(source)
         while build_source.parent.is_symlink():
-            self.logger.debug("Resolving source parent symlink: %s" % build_source.parent)
+            self.logger.debug("Resolving source parent symlink: %s", build_source.parent)
             build_source = self._get_build_path(build_source.parent.resolve() / build_source.name)
             source = build_source.relative_to(self._get_build_path("/"))
 
+        self._release_kept_file(target)
         if target.is_symlink():
             if target.resolve() == source:
-                return self.logger.debug("Symlink already exists: %s -> %s" % (target, source))
+                return self.logger.debug("Symlink already exists: %s -> %s", target, source)
             elif self["clean"]:
                 self.logger.warning("Deleting symlink: %s" % c_(target, "red", bright=True))
                 target.unlink()
@@ -204,55 +420,46 @@ class GeneratorHelpers(InitramfsProtocol):
                 raise RuntimeError("Symlink already exists: %s -> %s" % (target, target.resolve()))
 
         if target.relative_to(self._get_build_path("/")) == source:
-            return self.logger.debug("Cannot symlink to self: %s -> %s" % (target, source))
+            return self.logger.debug("Cannot symlink to self: %s -> %s", target, source)
 
         self.logger.log(
-            self["_build_log_level"], "Creating symlink: %s -> %s" % (c_(target, "green"), c_(source, "blue"))
+            self["_build_log_level"], "Creating symlink: %s -> %s", lazy_c_(target, "green"), lazy_c_(source, "blue")
         )
         target.symlink_to(source)
 
-    def _run(
-        self, args: list[str], timeout: int | None = None, fail_silent: bool = False, fail_hard: bool = True
-    ) -> CompletedProcess:  # type: ignore[type-arg]
-        """Runs a command, returns the CompletedProcess object on success.
-        If a timeout is set, the command will fail hard if it times out.
-        If fail_silent is set, non-zero return codes will not log stderr/stdout.
-        If fail_hard is set, non-zero return codes will raise a RuntimeError.
-        """
-
-        def print_err(ret: CompletedProcess | TimeoutExpired) -> None:  # type: ignore[type-arg]
-            if args := ret.args:
-                if isinstance(args, tuple):
-                    args = args[0]  # When there's a timeout, args is a (args, timeout) tuple
-                self.logger.error("Failed command: %s" % c_(" ".join(args), "red", bright=True))
-            if stdout := ret.stdout:
-                self.logger.error("Command output:\n%s" % stdout.decode())
-            if stderr := ret.stderr:
-                self.logger.error("Command error:\n%s" % stderr.decode())
-
-        timeout = timeout or self["timeout"]
-        cmd_args = [str(arg) for arg in args]
-        self.logger.debug("Running command: %s" % " ".join(cmd_args))
-        try:
-            cmd = run(cmd_args, capture_output=True, timeout=timeout)
-        except TimeoutExpired as e:
-            # Always fail hard for timeouts
-            print_err(e)
-            raise RuntimeError("[%ds] Command timed out: %s" % (timeout, [str(arg) for arg in cmd_args])) from e
+    def _symlink_virtual(self, source: str, virtual_path: str) -> None:
+        """Creates a symlink in the virtual tree, used by _symlink when direct_cpio is enabled.
+        Symlinked parent directories of absolute sources are resolved within the tree."""
+        tree = self.virtual_tree
+        if source.startswith("/"):
+            source = "/" + tree.resolve_parent(source)
+
+        if existing := tree.get(virtual_path):
+            if existing.entry_type != S_IFLNK:
+                raise FileExistsError("Virtual path exists and is not a symlink: %s" % virtual_path)
+            elif existing.target == source:
+                return self.logger.debug("Virtual symlink already exists: %s -> %s", virtual_path, source)
+            elif self["clean"]:
+                self.logger.warning("Replacing virtual symlink: %s" % c_(virtual_path, "red", bright=True))
+            else:
+                raise RuntimeError("Symlink already exists: %s -> %s" % (virtual_path, existing.target))
 
-        if cmd.returncode != 0:
-            if not fail_silent:
-                print_err(cmd)  # Print the full error output if not failing silently
-            if fail_hard:  # Fail hard means raise an exception
-                raise RuntimeError("Failed to run command: %s" % c_(" ".join(cmd.args), "red", bright=True))
+        if tree.resolve_parent(virtual_path) == tree.resolve_parent(Path(virtual_path).parent / source):
+            return self.logger.debug("Cannot symlink to self: %s -> %s", virtual_path, source)
 
-        return cmd
+        virtual_path = tree.add_symlink(virtual_path, source)
+        self.logger.log(
+            self["_build_log_level"],
+            "Creating virtual symlink: %s -> %s",
+            lazy_c_(virtual_path, "green"),
+            lazy_c_(source, "blue"),
+        )
 
     def _rotate_old(self, file_name: Path, sequence: int = 0) -> None:
         """Copies a file to file_name.old then file_name.old.n, where n is the next number in the sequence"""
         # Nothing to do if the file doesn't exist
         if not file_name.is_file():
-            self.logger.debug("File does not exist: %s" % file_name)
+            self.logger.debug("File does not exist: %s", file_name)
             return
 
         # If the cycle count is not set, attempt to clean
@@ -267,13 +474,13 @@ class GeneratorHelpers(InitramfsProtocol):
                     "Unable to cycle file, as cycle count is not set and clean is disabled: %s" % file_name
                 )
 
-        self.logger.debug("[%d] Cycling file: %s" % (sequence, file_name))
+        self.logger.debug("[%d] Cycling file: %s", sequence, file_name)
 
         # If the sequence is 0, we're cycling the file for the first time, just rename it to .old
         suffix = ".old" if sequence == 0 else ".old.%d" % sequence
         target_file = file_name.with_suffix(suffix)
 
-        self.logger.debug("[%d] Target file: %s" % (sequence, target_file))
+        self.logger.debug("[%d] Target file: %s", sequence, target_file)
         # If the target file exists, cycle again
         if target_file.is_file():
             # First check if we've reached the cycle limit
@@ -286,7 +493,7 @@ class GeneratorHelpers(InitramfsProtocol):
                     self.logger.debug("Cycle limit reached")
                     return
             else:
-                self.logger.debug("[%d] Target file exists, cycling again" % sequence)
+                self.logger.debug("[%d] Target file exists, cycling again", sequence)
                 self._rotate_old(target_file, sequence + 1)
 
         # Finally, rename the file
@@ -295,93 +502,38 @@ class GeneratorHelpers(InitramfsProtocol):
 
     def sort_hook_functions(self, hook: str) -> None:
         """Sorts the functions for the specified hook based on the import order.
-        "before" functions are moved before the target function,
-        "after" functions' target function is moved before the current function.
+        "before" functions are moved before their targets, "after" functions are moved after their targets.
+        Orders with functions or targets which are not in the hook are ignored.
 
-        Filters orders which do not contain functions or targets in the current hook.
+        The requirements are compiled into edges between the functions, which are sorted with sort_functions.
+        The function names and edges of the sorted hook are stored, so it is only sorted again if either changes.
         """
-        func_names = [func.__name__ for func in self["imports"].get(hook, [])]
+        functions = self["imports"].get(hook, [])
+        func_names = [func.__name__ for func in functions]
         if not func_names:
-            return self.logger.debug("No functions for hook: %s" % hook)
-
-        b = self["import_order"].get("before", {})
-        before = {k: v for k, v in b.items() if k in func_names and any(subv in func_names for subv in b[k])}
-        a = self["import_order"].get("after", {})
-        after = {k: v for k, v in a.items() if k in func_names and any(subv in func_names for subv in a[k])}
-
-        if not before and not after:
-            return self.logger.debug("No import order specified for hook: %s" % hook)
-
-        def iter_order(order: dict[str, list[str]], direction: str) -> bool:
-            """Iterate over all functions in an import order list,
-            using this information to move the order of function names in the import list.
-
-            Returns True if any changes were made, False otherwise."""
-            changed = False
-
-            for func_name, other_funcs in order.items():
-                func_index = func_names.index(func_name)  # Get the index based on the current position
-                assert func_index >= 0, "Function not found in import list: %s" % func_name
-                for other_func in other_funcs:
-                    try:
-                        other_index = func_names.index(other_func)
-                    except ValueError:
-                        continue
-                    assert other_index >= 0, "Function not found in import list: %s" % other_func
-
-                    def reorder_func(direction: str) -> None:
-                        """Reorders the function based on the direction."""
-                        if direction == "before":  # Move the function before the other function
-                            self.logger.debug(
-                                f"[{c_(func_name, 'green')}] Moving function before: {c_(other_func, 'blue')}"
-                            )
-                            func_names.insert(other_index, func_names.pop(func_index))
-                            self["imports"][hook].insert(other_index, self["imports"][hook].pop(func_index))
-                        elif direction == "after":  # Move the other function before the current function
-                            self.logger.debug(
-                                f"[{c_(func_name, 'green')}] Moving function after: {c_(other_func, 'blue')}"
-                            )
-                            func_names.insert(func_index, func_names.pop(other_index))
-                            self["imports"][hook].insert(func_index, self["imports"][hook].pop(other_index))
-                        else:
-                            raise ValueError("Invalid direction: %s" % direction)
-
-                    import_funcs = ", ".join([i.__name__ for i in self["imports"][hook]])
-                    self.logger.log(5, f"[{c_(hook, 'blue')}] Current function order: {c_(import_funcs, 'yellow')}")
-
-                    if direction == "before":  # func_index should be before other_index
-                        if func_index > other_index:  # If the current function is after the other function
-                            reorder_func("before")  # Move the current function before the other function)
-                            changed = True
-                        else:  # Log otherwise
-                            self.logger.log(
-                                5, f"[{c_(func_name, 'green')}] Function already before: {c_(other_func, 'blue')}"
-                            )
-                    elif direction == "after":  # func_index should be after other_index
-                        if func_index < other_index:  # If the current function is before the other function
-                            reorder_func("after")  # Move the current function after the other function
-                            changed = True
-                        else:
-                            self.logger.log(
-                                5, f"[{c_(func_name, 'green')}] Function already after: {c_(other_func, 'blue')}"
-                            )
-                    else:
-                        raise ValueError("Invalid direction: %s" % direction)
-                    func_index = func_names.index(func_name)  # Update the index after moving
-            return changed
-
-        max_iterations = len(func_names) * (len(before) + 1) * (len(after) + 1)  # Prevent infinite loops
-        iterations = max_iterations
-        while iterations:
-            iterations -= 1
-            # Update the order based on the before and after lists
-            if not any([iter_order(before, "before"), iter_order(after, "after")]):
+            return self.logger.debug("No functions for hook: %s", hook)
+
+        edges = get_order_edges(func_names, self["import_order"])
+        if self.hook_orders.get(hook) == (func_names, edges):
+            return self.logger.log(5, "[%s] Import order is unchanged", hook)
+
+        if not edges:
+            self.logger.debug("No import order specified for hook: %s", hook)
+        else:
+            try:
+                order = sort_functions(func_names, edges)
+            except ImportOrderError as e:
+                self.logger.error("[%s] Import list: %s", hook, func_names)
+                self.logger.error("[%s] Import order requirements: %s", hook, edges)
+                raise e
+
+            if order != list(range(len(order))):
+                sorted_functions = [functions[index] for index in order]
+                functions.clear()
+                functions += sorted_functions
+                func_names = [func.__name__ for func in functions]
+                edges = get_order_edges(func_names, self["import_order"])
                 self.logger.debug(
-                    "[%s] Import order converged after %s iterations" % (hook, max_iterations - iterations)
+                    "[%s] Sorted functions: %s", lazy_c_(hook, "blue"), lazy_c_(", ".join(func_names), "yellow")
                 )
-                break  # Keep going until no changes are made
-        else:  # If the loop completes without breaking, raise an error
-            self.logger.error("Import list: %s" % func_names)
-            self.logger.error("Before: %s" % before)
-            self.logger.error("After: %s" % after)
-            raise ValueError("Import order did not converge after %s iterations" % max_iterations)
+        self.hook_orders[hook] = (func_names, edges)
@@ -0,0 +1,119 @@
+__author__ = "desultory"
+__version__ = "0.1.1"
+
+from hashlib import sha256
+from os import utime
+from pathlib import Path
+from shutil import rmtree
+from sys import modules
+from typing import Any
+
+from .build_manifest import get_file_signature
+from .generator_helpers import copy_file
+
+IMAGE_CACHE_VERSION = 1
+
+
+def hash_value(digest, value: Any) -> None:
+    """Updates a hash with a stable representation of a config value.
+    Dicts are hashed in key order and sets are hashed in the order of their item hashes.
+    Paths to regular files include the file signature, functions and classes are hashed by name.
+    """
+    digest.update(type(value).__name__.encode() + b":")
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            hash_value(digest, key)
+            hash_value(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            hash_value(digest, item)
+    elif isinstance(value, (set, frozenset)):
+        item_hashes = []
+        for item in value:
+            item_hash = sha256()
+            hash_value(item_hash, item)
+            item_hashes.append(item_hash.digest())
+        digest.update(b"".join(sorted(item_hashes)))
+    elif isinstance(value, Path):
+        digest.update(str(value).encode())
+        digest.update(repr(get_file_signature(value)).encode())
+    elif callable(value):
+        digest.update(f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', value)}".encode())
+    else:
+        digest.update(repr(value).encode())
+    digest.update(b";")
+
+
+def get_code_signature() -> list[tuple[str, tuple[int, int, int] | None]]:
+    """Returns the file signatures of all loaded ugrd modules, so cached images are not used after an update."""
+    signature = []
+    for name, module in sorted(modules.items()):
+        if name.split(".")[0] == "ugrd" and (module_file := getattr(module, "__file__", None)):
+            signature.append((name, get_file_signature(Path(module_file))))
+    return signature
+
+
+def get_manifest_hash(config: dict, sources: list[Path], generated_files: dict[str, str]) -> str:
+    """Returns a hash of everything used to build an image.
+    This includes the config, the signatures of the source files, generated files such as the init, and the ugrd code.
+    Paths in the config are treated as source files.
+    """
+    digest = sha256()
+    hash_value(digest, IMAGE_CACHE_VERSION)
+    hash_value(digest, config)
+    hash_value(digest, sources)
+    hash_value(digest, generated_files)
+    hash_value(digest, get_code_signature())
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """Stores built images in a directory, by the manifest hash of the build.
+    Each entry is a directory named by the hash, containing the image with its original name.
+    Only the max_entries most recently used entries are kept.
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = 4) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def get(self, key: str) -> Path | None:
+        """Returns the cached image for a key, or None if it is not cached.
+        The entry is marked as used, so it is evicted last."""
+        entry_dir = self.cache_dir / key
+        try:
+            images = [image for image in entry_dir.iterdir() if image.is_file()]
+        except OSError:
+            return None
+        if len(images) != 1:
+            return None
+        try:
+            utime(entry_dir)
+        except OSError:  # The cache may be read-only
+            pass
+        return images[0]
+
+    def store(self, key: str, image: Path) -> Path:
+        """Copies an image into the cache, reflinking it if possible, then evicts old entries.
+        The image is copied to a temporary directory first, then moved into place.
+        Returns the path of the cached image, raises an OSError if it can't be written."""
+        entry_dir = self.cache_dir / key
+        temp_dir = self.cache_dir / f"{key}.tmp"
+        rmtree(temp_dir, ignore_errors=True)
+        temp_dir.mkdir(parents=True)
+        copy_file(image, temp_dir / image.name)
+        rmtree(entry_dir, ignore_errors=True)
+        temp_dir.replace(entry_dir)
+        self.evict()
+        return entry_dir / image.name
+
+    def evict(self) -> list[Path]:
+        """Removes the least recently used entries beyond max_entries, returns the removed entry directories."""
+        entries = sorted(
+            (entry for entry in self.cache_dir.iterdir() if entry.is_dir() and not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime_ns,
+            reverse=True,
+        )
+        for entry in entries[self.max_entries :]:
+            rmtree(entry)
+        return entries[self.max_entries :]
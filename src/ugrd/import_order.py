@@ -0,0 +1,128 @@
+__author__ = "desultory"
+__version__ = "0.2.0"
+
+from heapq import heapify, heappop, heappush
+
+
+class ImportOrderError(ValueError):
+    """Raised when import order requirements can't be satisfied, the cycle is a list of function names,
+    where each function must run before the next, and the last is the first."""
+
+    def __init__(self, cycle: list[str]) -> None:
+        self.cycle = cycle
+        super().__init__("Import order requirements contain a cycle: %s" % " -> ".join(cycle))
+
+
+def _get_targets(order: dict[str, list[str] | str], function: str) -> list[str]:
+    targets = order.get(function, [])
+    return [targets] if isinstance(targets, str) else targets
+
+
+def get_order_edges(func_names: list[str], import_order: dict[str, dict]) -> list[tuple[str, str]]:
+    """Returns (first, second) pairs of function names, where the first must run before the second.
+    "before" functions run before their targets, "after" functions run after their targets.
+    Requirements for functions or targets which are not in func_names are ignored.
+    """
+    names = set(func_names)
+    before, after = import_order.get("before", {}), import_order.get("after", {})
+    edges = []
+    for function in dict.fromkeys(func_names):
+        edges.extend((function, target) for target in _get_targets(before, function) if target in names)
+        edges.extend((target, function) for target in _get_targets(after, function) if target in names)
+    return edges
+
+
+def get_order_rule(edge: tuple[str, str], import_order: dict[str, dict]) -> tuple[str, str, str]:
+    """Returns the import_order entry an edge from get_order_edges was made from, as (order type, function, target).
+    The function of a "before" entry is the first function of the edge, the function of an "after" entry is the second.
+    """
+    first, second = edge
+    if second in _get_targets(import_order.get("before", {}), first):
+        return "before", first, second
+    return "after", second, first
+
+
+def _find_cycle(remaining: set[int], predecessors: list[list[int]], func_names: list[str]) -> list[str]:
+    """Finds a cycle in the functions which could not be sorted, each of which has a remaining predecessor.
+    Predecessors are followed until one repeats, then the path from it is returned in running order.
+    The cycle starts with the function which is first in func_names."""
+    index = min(remaining)
+    path: list[int] = []
+    seen: dict[int, int] = {}
+    while index not in seen:
+        seen[index] = len(path)
+        path.append(index)
+        index = next(predecessor for predecessor in predecessors[index] if predecessor in remaining)
+    cycle = path[seen[index] :][::-1]
+    start = cycle.index(min(cycle))  # Start from the first function in the import list
+    cycle = cycle[start:] + cycle[:start]
+    return [func_names[index] for index in cycle + cycle[:1]]
+
+
+def sort_functions(func_names: list[str], edges: list[tuple[str, str]]) -> list[int]:
+    """Returns the indices of func_names in an order where the first function of each edge runs before the second.
+
+    Uses a topological sort which keeps the original order where possible.
+    Each function is ranked by the lowest original index of itself and the functions which must run after it,
+    so functions are pulled forward to run before the functions which need them, rather than pushed back.
+    Raises an ImportOrderError with the cycle if the order can't be satisfied.
+    """
+    indices: dict[str, list[int]] = {}
+    for index, name in enumerate(func_names):
+        indices.setdefault(name, []).append(index)
+
+    successors: list[list[int]] = [[] for _ in func_names]
+    predecessors: list[list[int]] = [[] for _ in func_names]
+    for first, second in edges:
+        for first_index in indices[first]:
+            for second_index in indices[second]:
+                successors[first_index].append(second_index)
+                predecessors[second_index].append(first_index)
+
+    # Kahn's algorithm, in any order, to find an order to rank the functions in, or a cycle
+    in_degree = [len(predecessor) for predecessor in predecessors]
+    ready = [index for index, degree in enumerate(in_degree) if not degree]
+    topological_order = []
+    while ready:
+        index = ready.pop()
+        topological_order.append(index)
+        for successor in successors[index]:
+            in_degree[successor] -= 1
+            if not in_degree[successor]:
+                ready.append(successor)
+
+    if len(topological_order) != len(func_names):
+        remaining = set(range(len(func_names))) - set(topological_order)
+        raise ImportOrderError(_find_cycle(remaining, predecessors, func_names))
+
+    rank = list(range(len(func_names)))
+    for index in reversed(topological_order):  # Successors are ranked first
+        for successor in successors[index]:
+            rank[index] = min(rank[index], rank[successor])
+
+    in_degree = [len(predecessor) for predecessor in predecessors]
+    heap = [(rank[index], index) for index, degree in enumerate(in_degree) if not degree]
+    heapify(heap)
+    order = []
+    while heap:
+        _, index = heappop(heap)
+        order.append(index)
+        for successor in successors[index]:
+            in_degree[successor] -= 1
+            if not in_degree[successor]:
+                heappush(heap, (rank[successor], successor))
+    return order
+
+
+def find_order_violation(func_names: list[str], edges: list[tuple[str, str]]) -> tuple[str, str] | None:
+    """Returns the first (first, second) edge where the second function runs before the first, or None."""
+    first_positions: dict[str, int] = {}
+    last_positions: dict[str, int] = {}
+    for index, name in enumerate(func_names):
+        first_positions.setdefault(name, index)
+        last_positions[name] = index
+
+    for first, second in edges:
+        if last_positions[first] > first_positions[second]:
+            return first, second
+    return None
@@ -1,12 +1,13 @@
 __author__ = "desultory"
-__version__ = "3.0.0"
+__version__ = "3.5.1"
 
-from collections import UserDict
+from collections import UserDict, deque
+from contextlib import nullcontext
+from functools import partial
 from importlib import import_module
 from importlib.util import module_from_spec, spec_from_file_location
 from pathlib import Path
-from queue import Queue
-from typing import Any
+from typing import Any, Callable
 from types import ModuleType
 
 from pycpio import PyCPIO
@@ -15,11 +16,14 @@ from zenlib.types import NoDupFlatList
 from zenlib.util import colorize as c_
 from zenlib.util import handle_plural, parse_toml, pretty_print
 
-from .config_helpers import DEFAULT_CONFIG_PATH, read_ugrd_module, resolve_type
+from .build_profiler import BuildProfiler
+from .command_runner import CommandRecord, CommandRunner
+from .config_helpers import DEFAULT_CONFIG_PATH, read_ugrd_module, resolve_type, save_module_cache
 from .exceptions import ValidationError
+from .lazy_format import lazy_c_, lazy_pretty_print
 
 
-class InitramfsConfig(LoggerMixIn, UserDict):
+class InitramfsConfig(CommandRunner, LoggerMixIn, UserDict):
     """
     Dict for ugrd config
 
@@ -41,7 +45,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         "validated": bool,  # A flag to indicate if the config has been validated, mostly used for log levels
         "custom_parameters": dict,  # Custom parameters loaded from imports
         "custom_processing": dict,  # Custom processing functions which will be run to validate and process parameters
-        "_processing": dict,  # A dict of queues containing parameters which have been set before the type was known
+        "_processing": dict,  # A dict of deques containing parameters which have been set before the type was known
         "_late_args": NoDupFlatList,  # A list of arguments which could be passed as command line args but need to be processed after the config is loaded
         "stage": str,  # The current processing stage (early, late, final)
         "test_copy_config": NoDupFlatList,  # A list of config values which are copied into test images, from the parent
@@ -52,6 +56,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         startup_args: dict[str, Any] | None = None,
         config_file: Path | str | None = None,
         NO_BASE: bool = False,
+        profiler: BuildProfiler | None = None,
         *args: Any,
         **kwargs: Any,
     ) -> None:
@@ -65,8 +70,14 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         The last queued value will take precedence
 
         The order is: base config -> user config -> arguments
+
+        If a profiler is passed, processing functions are profiled.
+        Commands run by processing functions with _run are recorded in the command_log.
         """
         self.init_logger(args, kwargs)
+        self.profiler = profiler
+        self.command_log: list[CommandRecord] = []
+        self._handlers: dict[str, Callable[[Any], None]] = {}  # Compiled by _compile_handler, per parameter
         super().__init__(*args, **kwargs)
 
         # Define the default parameters
@@ -101,6 +112,8 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         if startup_args:
             self.import_args(startup_args)
 
+        save_module_cache()  # Save module configs parsed while loading
+
     def import_args(self, args: dict) -> None:
         """Imports data from an argument dict."""
         for arg, value in args.items():
@@ -114,11 +127,13 @@ class InitramfsConfig(LoggerMixIn, UserDict):
 
     def _enqueue(self, key: str, value: Any) -> None:
         """Adds a value to the processing queue"""
-        if key not in self["_processing"]:
-            self["_processing"][key] = Queue()
-        self["_processing"][key].put(value)
+        if key not in self.data["_processing"]:
+            self.data["_processing"][key] = deque()
+        self.data["_processing"][key].append(value)
         self.logger.debug(
-            f"[{c_(key, 'blue', background=True)}] Adding parameter to processing queue: {c_(value, 'yellow')}"
+            "[%s] Adding parameter to processing queue: %s",
+            lazy_c_(key, "blue", background=True),
+            lazy_c_(value, "yellow"),
         )
 
     def __setitem__(self, key: str, value: Any) -> None:
@@ -132,10 +147,10 @@ class InitramfsConfig(LoggerMixIn, UserDict):
 
         For everything but the logger, queue values if they are not registered
         """
-        if self["validated"]:
+        if self.data["validated"]:
             self.logger.error(f"[{c_(key, 'yellow')}] Config is validated, refusing to set value: {c_(value, 'red')}")
             return
-        if self["stage"] == "final" and not self["validated"]:
+        if self.data["stage"] == "final":
             self.logger.critical(
                 f"[{c_(key, 'yellow')}] Config is finalized but invalid, refusing to set value: {c_(value, 'red')}"
             )
@@ -145,87 +160,124 @@ class InitramfsConfig(LoggerMixIn, UserDict):
             return self._enqueue(key, value)
 
         # If the type is registered, use the appropriate update function
-        if any(key in d for d in (self.builtin_parameters, self["custom_parameters"])):
+        if key in self._handlers or key in self.builtin_parameters or key in self.data["custom_parameters"]:
             return self.handle_parameter(key, value)
 
         self.logger.log(
             5,
-            f"[{c_(key, 'yellow')}] Unable to determine expected type, valid builtin types:\n{c_(self.builtin_parameters.keys(), 'blue', bold=True)}",
+            "[%s] Unable to determine expected type, valid builtin types:\n%s",
+            lazy_c_(key, "yellow"),
+            lazy_c_(self.builtin_parameters.keys(), "blue", bold=True),
+        )
+        self.logger.log(
+            5, "[%s] Custom types: %s", lazy_c_(key, "blue"), lazy_c_(self["custom_parameters"].keys(), bold=True)
         )
-        self.logger.log(5, f"[{c_(key, 'blue')}] Custom types: {c_(self['custom_parameters'].keys(), bold=True)}")
         # for anything but the logger, add to the processing queue
         if key != "logger":
             self._enqueue(key, value)
 
+    def _profile(self, name: str) -> Any:
+        """Returns a context which records a profile event for a processing function, if profiling is enabled."""
+        return self.profiler.record(name, "config") if self.profiler else nullcontext()
+
     def handle_parameter(self, key: str, value: Any) -> None:
         """
         Handles a config parameter, setting the value and processing it if the type is known.
         Raises a KeyError if the parameter is not registered.
 
-        If the value is a _late_arg, and it's not in the late stage, skip it
+        The handler for each parameter is compiled by _compile_handler on first use,
+        and is used until processing functions, custom parameters, or masks are registered.
+        """
+        if not (handler := self._handlers.get(key)):
+            handler = self._handlers[key] = self._compile_handler(key)
+        handler(value)
+        if key == "masks":  # Masked processing functions are skipped by compiled handlers
+            self._handlers.clear()
+
+    def _compile_handler(self, key: str) -> Callable[[Any], None]:
+        """
+        Returns the function which handles values for a parameter.
+        Raises a KeyError if the parameter is not registered.
 
         Uses custom processing functions if they are defined, otherwise uses the standard setters.
         """
         # Get the expected type, first searching builtin_parameters, then custom_parameters
-        for d in (self.builtin_parameters, self["custom_parameters"]):
-            expected_type = d.get(key)
-            if expected_type:
-                if expected_type.__name__ == "InitramfsGenerator":
-                    self.data[key] = value
-                    self.logger.debug(f"Setting InitramfsGenerator: {c_(key, 'magenta', bold=True)}")
-                    return
-                break  # Break and raise an exception if the type is not found
-        else:
+        expected_type = self.builtin_parameters.get(key) or self.data["custom_parameters"].get(key)
+        if not expected_type:
             raise KeyError(f"Parameter not registered: {c_(key, 'red')}")
 
-        if hasattr(self, f"_process_{key}"):  # The builtin function is decorated and can handle plural
-            self.logger.log(5, f"[{c_(key, 'blue')}] Using builtin setitem: _process_{key}")
-            getattr(self, f"_process_{key}")(value)
-            return
+        if expected_type.__name__ == "InitramfsGenerator":
+            return partial(self._set_generator, key)
+
+        if func := getattr(self, f"_process_{key}", None):  # The builtin function is decorated and can handle plural
+            self.logger.log(5, "[%s] Using builtin setitem: %s", lazy_c_(key, "blue"), func.__name__)
+            return partial(self._run_processor, func.__name__, func)
 
         # Don't use masked processing functions for custom values, fall back to standard setters
         def check_mask(import_name: str) -> bool:
             """Checks if the function is masked."""
             return import_name in self.get("masks", [])
 
-        if func := self["custom_processing"].get(f"_process_{key}"):
+        if func := self.data["custom_processing"].get(f"_process_{key}"):
             if check_mask(func.__name__):
-                self.logger.debug(f"Skipping masked function: {c_(func.__name__, 'yellow', background=True)}")
+                self.logger.debug("Skipping masked function: %s", lazy_c_(func.__name__, "yellow", background=True))
             else:
                 self.logger.log(
-                    5, f"[{c_(key, 'blue')}] Using custom setitem: {c_(func.__name__, 'blue', underline=True)}"
+                    5,
+                    "[%s] Using custom setitem: %s",
+                    lazy_c_(key, "blue"),
+                    lazy_c_(func.__name__, "blue", underline=True),
                 )
-                func(self, value)
-                return
+                return partial(self._run_processor, func.__name__, partial(func, self))
 
-        if func := self["custom_processing"].get(f"_process_{key}_multi"):
+        if func := self.data["custom_processing"].get(f"_process_{key}_multi"):
             if check_mask(func.__name__):
-                self.logger.debug(f"Skipping masked function: {c_(func.__name__, 'yellow', background=True)}")
+                self.logger.debug("Skipping masked function: %s", lazy_c_(func.__name__, "yellow", background=True))
             else:
                 self.logger.log(
                     5,
-                    f"[{c_(key, 'blue')}] Using custom plural setitem: {c_(func.__name__, 'blue', underline=True, bold=True)}",
+                    "[%s] Using custom plural setitem: %s",
+                    lazy_c_(key, "blue"),
+                    lazy_c_(func.__name__, "blue", underline=True, bold=True),
                 )
-                handle_plural(func)(self, value)
-                return
+                return partial(self._run_processor, func.__name__, partial(handle_plural(func), self))
 
         if expected_type in (list, NoDupFlatList):  # Append to lists, don't replace
-            self.logger.log(5, f"[{c_(key, 'blue')}] Using list setitem")
-            self[key].append(value)
-            return
+            self.logger.log(5, "[%s] Using list setitem", lazy_c_(key, "blue"))
+            return partial(self._append_value, key)
 
         if expected_type is dict:  # Create new keys, update existing
-            if key not in self:
-                self.logger.log(5, f"[{c_(key, 'blue')}] Setting dict to: {value}")
-                super().__setitem__(key, value)
-                return
-            self.logger.log(5, f"[{c_(key, 'blue')}] Updating dict with: {value}")
-            self[key].update(value)
+            return partial(self._update_dict, key)
+
+        return partial(self._set_value, key, expected_type)
+
+    def _set_generator(self, key: str, value: Any) -> None:
+        self.data[key] = value
+        self.logger.debug("Setting InitramfsGenerator: %s", lazy_c_(key, "magenta", bold=True))
+
+    def _run_processor(self, name: str, func: Callable[[Any], None], value: Any) -> None:
+        """Runs a processing function with a value, profiling it under its name if profiling is enabled."""
+        with self._profile(name):
+            func(value)
+
+    def _append_value(self, key: str, value: Any) -> None:
+        self.data[key].append(value)
+
+    def _update_dict(self, key: str, value: dict) -> None:
+        if key not in self.data:
+            self.logger.log(5, "[%s] Setting dict to: %s", lazy_c_(key, "blue"), value)
+            self.data[key] = value
             return
+        self.logger.log(5, "[%s] Updating dict with: %s", lazy_c_(key, "blue"), value)
+        self.data[key].update(value)
 
+    def _set_value(self, key: str, expected_type: type, value: Any) -> None:
         casted_value = expected_type(value)
         self.logger.debug(
-            f"[{c_(key, 'blue')}]{c_(expected_type, 'red', dim=True)} Setting value: {c_(casted_value, bold=True)}"
+            "[%s]%s Setting value: %s",
+            lazy_c_(key, "blue"),
+            lazy_c_(expected_type, "red", dim=True),
+            lazy_c_(casted_value, bold=True),
         )
         self.data[key] = casted_value  # For everything else, simply set it
 
@@ -241,8 +293,11 @@ class InitramfsConfig(LoggerMixIn, UserDict):
             parameter_type = resolve_type(parameter_type)
 
         self["custom_parameters"][parameter_name] = parameter_type
+        self._handlers.pop(parameter_name, None)
         self.logger.debug(
-            f"[{c_(parameter_name, 'blue')}] Registered custom parameter with type: {c_(parameter_type, 'red', dim=True)}"
+            "[%s] Registered custom parameter with type: %s",
+            lazy_c_(parameter_name, "blue"),
+            lazy_c_(parameter_type, "red", dim=True),
         )
 
         match parameter_type.__name__:
@@ -271,25 +326,43 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         # Process queued values if they exist
         self._process_unprocessed(parameter_name)
 
+    def _is_masked(self, function_name: str) -> bool:
+        """Checks if a function is masked for any import type, the masks of each type may be a name or a list."""
+        for import_masks in self.get("masks", {}).values():
+            if function_name in ([import_masks] if isinstance(import_masks, str) else import_masks):
+                return True
+        return False
+
     def _process_unprocessed(self, parameter_name: str) -> None:
         """Processes queued values for a parameter.
         Does nothing if there are no queued values
 
         If the value is a _late_arg and it's not the late stage, skip
             this leaves the processing queue untouched
+
+        If a _prefetch_{parameter_name} custom processing function is defined,
+        it is called with all queued values first, unless it is masked.
+        This allows expensive lookups to be done concurrently, values are still processed in order.
         """
         if parameter_name not in self["_processing"]:
-            self.logger.log(5, f"No queued values for: {c_(parameter_name, 'yellow', dim=True)}")
+            self.logger.log(5, "No queued values for: %s", lazy_c_(parameter_name, "yellow", dim=True))
             return
 
         if not self._check_late(parameter_name):
             return
 
-        value_queue = self["_processing"].pop(parameter_name)
-        while not value_queue.empty():
-            value = value_queue.get()
+        values = list(self["_processing"].pop(parameter_name))
+
+        if prefetch := self["custom_processing"].get(f"_prefetch_{parameter_name}"):
+            if self._is_masked(prefetch.__name__):
+                self.logger.debug("Skipping masked function: %s", lazy_c_(prefetch.__name__, "yellow", background=True))
+            else:
+                self.logger.debug("[%s] Prefetching %d queued values", lazy_c_(parameter_name, "blue"), len(values))
+                prefetch(self, values)
+
+        for value in values:
             self.logger.debug(
-                f"[{c_(parameter_name, 'blue')}] Processing queued value: {c_(value, 'yellow', bold=True)}"
+                "[%s] Processing queued value: %s", lazy_c_(parameter_name, "blue"), lazy_c_(value, "yellow", bold=True)
             )
             self[parameter_name] = value
 
@@ -299,7 +372,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         that the function is not ordered after itself.
         Ensures that the same function/target is not in another order type.
         """
-        self.logger.debug(f"Processing import order:\n{pretty_print(import_order)}")
+        self.logger.debug("Processing import order:\n%s", lazy_pretty_print(import_order))
         order_types = ["before", "after"]
         for order_type, order_dict in import_order.items():
             if order_type not in order_types:
@@ -319,12 +392,12 @@ class InitramfsConfig(LoggerMixIn, UserDict):
                 self["import_order"][order_type] = {}
             self["import_order"][order_type].update(order_dict)
 
-        self.logger.debug(f"Registered import order requirements:\n{import_order}")
+        self.logger.debug("Registered import order requirements:\n%s", import_order)
 
     def _import_external_module(self, module_name: str) -> ModuleType:
         """Given a module name, attempts to load it from /var/lib/ugrd, returning the module"""
         module_path = Path("/var/lib/ugrd/" + module_name.replace(".", "/")).with_suffix(".py")
-        self.logger.debug(f"Attempting to sideload module from: {c_(module_path, 'green')}")
+        self.logger.debug("Attempting to sideload module from: %s", lazy_c_(module_path, "green"))
         if not module_path.exists():
             raise ModuleNotFoundError(f"Module not found: {c_(module_name, 'red')}")
 
@@ -348,7 +421,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
                 )
 
             spec_loader.exec_module(module)
-            self.logger.debug(f"Loaded external module: {c_(module_name, 'blue')}")
+            self.logger.debug("Loaded external module: %s", lazy_c_(module_name, "blue"))
 
         except Exception as e:
             raise ModuleNotFoundError(f"[{c_(module_name, 'yellow')}] Unable to load module: {e}") from e
@@ -360,21 +433,22 @@ class InitramfsConfig(LoggerMixIn, UserDict):
     def _process_imports(self, import_type: str, import_value: dict[str, list[str]]) -> None:
         """Processes imports in a module, importing the functions and adding them to the appropriate list."""
         for module_name, function_names in import_value.items():
-            f_name = f"[{c_(module_name, 'green')}]({c_(import_type, underline=True)})"
-            self.logger.debug(f"{f_name} Importing module functions: {function_names}")
+            f_name = (lazy_c_(module_name, "green"), lazy_c_(import_type, underline=True))
+            self.logger.debug("[%s](%s) Importing module functions: %s", *f_name, function_names)
             try:  # First, the module must be imported, so its functions can be accessed
                 module = import_module(module_name)
             except ModuleNotFoundError:  # If it can't be natively imported, try to sideload it
                 module = self._import_external_module(module_name)
 
-            self.logger.log(5, f"{f_name} Imported module contents:{dir(module)}")
+            if self.logger.isEnabledFor(5):  # Don't list the module contents unless they are logged
+                self.logger.log(5, "[%s](%s) Imported module contents:%s", *f_name, dir(module))
             if "_module_name" in dir(module) and module._module_name != module_name:
                 self.logger.warning(
                     f"Module name mismatch: {c_(module._module_name, 'green')} != {c_(module_name, 'red')}"
                 )
 
             if import_type not in self["imports"]:  # Import types are only actually created when needed
-                self.logger.log(5, f"Creating import type: {c_(import_type, underline=True)}")
+                self.logger.log(5, "Creating import type: %s", lazy_c_(import_type, underline=True))
                 self["imports"][import_type] = NoDupFlatList(_log_bump=10, logger=self.logger)
 
             if import_masks := self.get("masks", {}).get(import_type, []):
@@ -428,12 +502,13 @@ class InitramfsConfig(LoggerMixIn, UserDict):
 
             # Append the functions to the appropriate list
             self["imports"][import_type] += function_list
-            self.logger.log(5, f"[{c_(import_type, underline=True)}] Updated import functions: {function_list}")
+            self.logger.log(5, "[%s] Updated import functions: %s", lazy_c_(import_type, underline=True), function_list)
 
             if import_type == "config_processing":  # Register the functions for processing after all imports are done
                 for function in function_list:
                     self["custom_processing"][function.__name__] = function
-                    self.logger.debug(f"Registered config processing function: {c_(function.__name__, 'blue')}")
+                    self.logger.debug("Registered config processing function: %s", lazy_c_(function.__name__, "blue"))
+                self._handlers.clear()  # Handlers are compiled again to use the new processing functions
 
     @handle_plural
     def _process_modules(self, module: str) -> None:
@@ -441,7 +516,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         If that module (by name) has already been loaded, does nothing
         """
         if module in self["modules"]:
-            self.logger.debug(f"Module already loaded: {c_(module, 'yellow')}")
+            self.logger.debug("Module already loaded: %s", lazy_c_(module, "yellow"))
             return
 
         self._load_module(read_ugrd_module(module), module)
@@ -460,7 +535,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         self.logger.info(f"Processing module: {c_(module, 'green', bold=True)}")
 
         if imports := module_config.get("imports"):
-            self.logger.debug(f"[{c_(module, 'green')}] Processing imports: {imports}")
+            self.logger.debug("[%s] Processing imports: %s", lazy_c_(module, "green"), imports)
             self["imports"] = imports
 
         if needs := module_config.get("needs"):
@@ -477,15 +552,21 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         # Process other config such as import orders, defined values
         for name, value in module_config.items():
             if name in ["imports", "custom_parameters", "provides", "needs"]:
-                self.logger.log(5, f"[{c_(module, 'green')}] Skipping: {c_(name, 'yellow')}")
+                self.logger.log(5, "[%s] Skipping: %s", lazy_c_(module, "green"), lazy_c_(name, "yellow"))
                 continue
 
-            self.logger.log(5, f"[{c_(module, 'green')}]({c_(name, 'blue')}) Setting value: {c_(value, bold=True)}")
+            self.logger.log(
+                5,
+                "[%s](%s) Setting value: %s",
+                lazy_c_(module, "green"),
+                lazy_c_(name, "blue"),
+                lazy_c_(value, bold=True),
+            )
             self[name] = value
 
         # If custom parameters are defined, process them and then process any unprocessed values
         if custom_parameters := module_config.get("custom_parameters", {}):
-            self.logger.debug(f"[{c_(module, 'green')}] Processing custom parameters: {custom_parameters}")
+            self.logger.debug("[%s] Processing custom parameters: %s", lazy_c_(module, "green"), custom_parameters)
             self["custom_parameters"] = custom_parameters
 
         # Append the module to the list of loaded modules, avoid recursion
@@ -495,7 +576,9 @@ class InitramfsConfig(LoggerMixIn, UserDict):
 
         # Handle provides tags, ensure only a single module provides a tag
         if provides := module_config.get("provides"):
-            self.logger.debug(f"[{c_(module, bright=True)}] Processing provided tags: {c_(provides, 'green')}")
+            self.logger.debug(
+                "[%s] Processing provided tags: %s", lazy_c_(module, bright=True), lazy_c_(provides, "green")
+            )
             if isinstance(provides, str):
                 provides = [provides]
             for tag in provides:
@@ -508,7 +591,9 @@ class InitramfsConfig(LoggerMixIn, UserDict):
         """Checks if it is time to run a late arg"""
         if self["stage"] != "late" and parameter_name in self["_late_args"]:
             self.logger.debug(
-                f"[{c_(self['stage'], underline=True)}] Deferring processing for late arg: {c_(parameter_name, 'yellow')}"
+                "[%s] Deferring processing for late arg: %s",
+                lazy_c_(self["stage"], underline=True),
+                lazy_c_(parameter_name, "yellow"),
             )
             return False
         return True
@@ -531,7 +616,7 @@ class InitramfsConfig(LoggerMixIn, UserDict):
             raise RuntimeError("Cannot change stage after finalized")
 
         self.data["stage"] = stage
-        self.logger.debug(f"Entering config stage: {c_(stage, 'blue', underline=True, bold=True)}")
+        self.logger.debug("Entering config stage: %s", lazy_c_(stage, "blue", underline=True, bold=True))
 
         if stage == "late":
             self._process_late_values()
@@ -1,24 +1,42 @@
-from importlib.metadata import version
+from contextlib import nullcontext
 from pathlib import Path
 from textwrap import dedent
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable
 
 from zenlib.logging import LoggerMixIn
 from zenlib.util import colorize as c_
-from zenlib.util import pretty_print
 
 from ugrd import InitramfsConfig
 
+from .build_profiler import BuildProfiler
 from .config_helpers import DEFAULT_CONFIG_PATH
 from .exceptions import ValidationError
 from .generator_helpers import GeneratorHelpers
+from .lazy_format import lazy_c_, lazy_pretty_print
+from .virtual_tree import VirtualTree
+
+if TYPE_CHECKING:  # cpio_writer is imported by make_cpio
+    from .cpio_writer import CPIOIndexEntry
+
+
+def _get_version() -> str:
+    """Returns the installed ugrd version, importlib.metadata is only imported when needed, as it is slow to import."""
+    from importlib.metadata import version
+
+    return version(__package__)
 
 
 class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
     def __init__(self, config: Path | str | None = DEFAULT_CONFIG_PATH, *args: Any, **kwargs: Any) -> None:
         self.init_logger(args, kwargs)
+        # If profile is set to a trace file path, hooks, functions, and config processing are profiled
+        self.profiler = BuildProfiler(profile) if (profile := kwargs.pop("profile", None)) else None
         self.config_dict = InitramfsConfig(
-            NO_BASE=kwargs.pop("NO_BASE", False), logger=self.logger, startup_args=kwargs, config_file=config
+            NO_BASE=kwargs.pop("NO_BASE", False),
+            logger=self.logger,
+            startup_args=kwargs,
+            config_file=config,
+            profiler=self.profiler,
         )
 
         # Used for functions that are added to the shell profile
@@ -27,10 +45,28 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
 
         # Used for functions that are run as part of the build process
         self.build_tasks = ["build_enum", "build_pre", "build_tasks", "build_late", "build_deploy", "build_final"]
+        # Build tasks which build_multi runs once for all kernels, except for functions in _kernel_functions
+        self.shared_build_tasks = ["build_enum", "build_pre"]
 
         # init_pre and init_final are run as part of generate_initramfs_main
         self.init_types = ["init_debug", "init_main", "init_mount"]
 
+        # Used instead of the build directory when direct_cpio is enabled
+        self.virtual_tree = VirtualTree()
+
+        # Set by clean_build_dir when incremental_build is enabled
+        self.build_manifest = None
+        # Set when decompress_cache is used, shared by all compressed dependency types
+        self.decompressed_store = None
+        # The entries of the written CPIO archive by name, set by make_cpio and used by CPIO checks
+        self.cpio_index: dict[str, CPIOIndexEntry] = {}
+        # Set by make_cpio when auto compression picks the output file name, used instead of out_file
+        self.cpio_out_file: str | None = None
+        # The function names and import order edges of each sorted hook, used to skip sorting unchanged hooks
+        self.hook_orders: dict[str, tuple[list[str], list[tuple[str, str]]]] = {}
+        # Commands run by _run, shared with the config so commands run while processing it are reported
+        self.command_log = self.config_dict.command_log
+
     #  If the initramfs generator is used as a dictionary, it will use the config_dict.
     def __setitem__(self, key: str, value: Any) -> None:
         self.config_dict[key] = value
@@ -53,8 +89,17 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
     def build(self) -> None:
         """Builds the initramfs image."""
         self.config_dict["stage"] = "late"  # Set the config stage to late, loading deferred config
-        self._log_run(f"Running ugrd v{version('ugrd')}")
-        self.run_build()
+        self._log_run(f"Running ugrd v{_get_version()}")
+        try:
+            self.run_build()
+            self._build_image()
+        finally:
+            self._close_decompressed_store()
+            self._report_commands()
+            self._report_profile()
+
+    def _build_image(self) -> None:
+        """Finalizes the config, then generates the init, packs the image, and runs checks and tests."""
         self.config_dict["stage"] = "final"  # Finalize the config, triggering validation
 
         self.generate_init()
@@ -62,6 +107,105 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
         self.run_checks()
         self.run_tests()
 
+    def build_multi(self, kernel_versions: list[str]) -> None:
+        """Builds an image for each kernel version.
+        build_enum and build_pre are run once, skipping functions in _kernel_functions, which depend on the kernel.
+        Each kernel is then built in a forked worker process, with its own build directory and output file.
+        Up to max_workers kernels are built at once.
+
+        If out_file is set, it must contain {kver}, which is replaced with the kernel version.
+        Raises a ValueError if it does not, and a RuntimeError if any kernel fails to build.
+        """
+        from multiprocessing import get_context
+        from multiprocessing.connection import wait
+
+        if (out_file := self.get("out_file")) and "{kver}" not in out_file:
+            raise ValueError(f"out_file must contain {{kver}} when building multiple kernels: {c_(out_file, 'red')}")
+
+        self["_kernel_versions"] = kernel_versions
+        self.config_dict["stage"] = "late"
+        self._log_run(f"Running ugrd v{_get_version()} for kernels: {', '.join(self['_kernel_versions'])}")
+        try:
+            self.run_build(self.shared_build_tasks, kernel_functions=False)
+        finally:
+            self._report_profile()
+
+        context = get_context("fork")  # Workers inherit the shared build state
+        max_workers = min(self._get_max_workers(), len(self["_kernel_versions"]))
+        running: dict[str, Any] = {}
+        failed = []
+
+        def wait_running() -> None:
+            """Waits for at least one worker to exit, logging the result of each exited worker."""
+            wait([process.sentinel for process in running.values()])
+            for kver, process in list(running.items()):
+                if process.exitcode is None:
+                    continue
+                process.join()
+                del running[kver]
+                if process.exitcode:
+                    self.logger.error(f"[{c_(kver, 'red')}] Build failed with exit code: {process.exitcode}")
+                    failed.append(kver)
+                else:
+                    self.logger.info(f"[{c_(kver, 'green')}] Build completed.")
+
+        for kver in self["_kernel_versions"]:
+            if len(running) >= max_workers:
+                wait_running()
+            running[kver] = context.Process(target=self._build_kernel, args=(kver,), name=f"ugrd-{kver}")
+            running[kver].start()
+        while running:
+            wait_running()
+
+        if failed:
+            raise RuntimeError(f"Failed to build images for kernels: {', '.join(failed)}")
+
+    def _build_kernel(self, kernel_version: str) -> None:
+        """Builds the image for a kernel version, in a worker process forked by build_multi.
+        Sets the kernel version, and suffixes the build directory with it.
+        Runs the functions skipped by build_multi, then the remaining build tasks.
+        """
+        self._log_run(f"Building image for kernel: {kernel_version}")
+        try:
+            self["kernel_version"] = kernel_version
+            self["build_dir"] = self["build_dir"].with_name(f"{self['build_dir'].name}-{kernel_version}")
+            if out_file := self.get("out_file"):
+                self["out_file"] = out_file.replace("{kver}", kernel_version)
+            self.run_build(self.shared_build_tasks, kernel_functions=True)
+            self.run_build([task for task in self.build_tasks if task not in self.shared_build_tasks])
+            self._build_image()
+        except Exception as e:
+            self.logger.critical(f"[{c_(kernel_version, 'red')}] {e}", exc_info=True)
+            exit(1)
+        finally:
+            self._close_decompressed_store()
+            self._report_commands()
+            self._report_profile(kernel_version)
+
+    def _close_decompressed_store(self) -> None:
+        """Closes the decompressed store, if used, so other builds can evict files from it."""
+        if self.decompressed_store:
+            self.decompressed_store.close()
+
+    def _profile(self, name: str, category: str) -> Any:
+        """Returns a context which records a profile event if profiling is enabled."""
+        return self.profiler.record(name, category) if self.profiler else nullcontext()
+
+    def _report_profile(self, kernel_version: str | None = None) -> None:
+        """Logs a summary of the profile, and writes the trace, if profiling is enabled.
+        Traces for kernels built by build_multi are suffixed with the kernel version, and include the shared build.
+        """
+        if not self.profiler:
+            return
+        trace_file = self.profiler.trace_file
+        if kernel_version:
+            trace_file = trace_file.with_name(f"{trace_file.stem}-{kernel_version}{trace_file.suffix}")
+        self.logger.info("Build profile:\n%s" % self.profiler.get_summary())
+        try:
+            self.logger.info("Wrote profile trace: %s" % c_(self.profiler.write_trace(trace_file), "green"))
+        except OSError as e:
+            self.logger.error("Unable to write profile trace: %s" % e)
+
     def run_func(
         self, function: Callable[..., list[str] | str | None], force_include: bool = False, force_exclude: bool = False
     ) -> list[str] | None:
@@ -76,11 +220,17 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
         If force_include is set, forces the function to be included in the shell profile.
         If force_exclude is set, does not include the output of the function in the shell profile and returns output early
         """
-        self.logger.log(self["_build_log_level"], f"Running function: {c_(function.__name__, 'blue', bold=True)}")
-        if function_output := function(self):
+        self.logger.log(
+            self["_build_log_level"], "Running function: %s", lazy_c_(function.__name__, "blue", bold=True)
+        )
+        with self._profile(function.__name__, "function"):
+            function_output = function(self)
+        if function_output:
             if force_exclude:
                 # Log the contents and return early
-                self.logger.log(5, f"[{c_(function.__name__, 'yellow')}] Excluded function output:\n{function_output}")
+                self.logger.log(
+                    5, "[%s] Excluded function output:\n%s", lazy_c_(function.__name__, "yellow"), function_output
+                )
                 return function_output if isinstance(function_output, list) else [function_output]
 
             # Check after running for functions which will not be included in the init scripts/profile
@@ -99,39 +249,48 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
             # If the output is a single line, and force_include is not set, return the contents (not the function name)
             if len(function_output) == 1 and not force_include:
                 self.logger.log(
-                    5, f"[{c_(function.__name__, 'blue')}] Function returned single line: {function_output[0]}"
+                    5, "[%s] Function returned single line: %s", lazy_c_(function.__name__, "blue"), function_output[0]
                 )
                 return function_output
 
             # Otherwise add it to the included functions and return the function name
             self.logger.debug(
-                f"[{c_(function.__name__, 'blue')}] Function returned output:\n{pretty_print(function_output)}"
+                "[%s] Function returned output:\n%s",
+                lazy_c_(function.__name__, "blue"),
+                lazy_pretty_print(function_output),
             )
             self.included_functions[function.__name__] = function_output
-            self.logger.debug(f"Created function alias: {c_(function.__name__, 'blue')}")
+            self.logger.debug("Created function alias: %s", lazy_c_(function.__name__, "blue"))
             return [function.__name__]
         elif force_include:
             raise ValueError(f"Force included function returned no output:{c_(function.__name__, 'red')}")
         else:
-            self.logger.debug(f"Function returned no output: {c_(function.__name__, 'yellow')}")
+            self.logger.debug("Function returned no output: %s", lazy_c_(function.__name__, "yellow"))
             return None
 
-    def run_hook(self, hook: str, *args: Any, **kwargs: Any) -> list[str]:
+    def run_hook(self, hook: str, *args: Any, kernel_functions: bool | None = None, **kwargs: Any) -> list[str]:
         """Runs all functions for the specified hook.
         If the function is masked, it will be skipped.
         If the function is in import_order, handle the ordering
+        If kernel_functions is True, only functions in _kernel_functions are run, if False, they are skipped.
         """
         self.sort_hook_functions(hook)  # This is in generator_helpers.py
         out = []
-        for function in self["imports"].get(hook, []):
-            if function.__name__ in self["masks"].get(hook, []):
-                self.logger.warning(
-                    f"[{c_(hook, bright=True)}] Skipping masked function: {c_(function.__name__, 'yellow', bold=True)}"
-                )
-                continue
-
-            if function_output := self.run_func(function, *args, **kwargs):
-                out += function_output
+        with self._profile(hook, "hook"):
+            for function in self["imports"].get(hook, []):
+                is_kernel_function = function.__name__ in self["_kernel_functions"]
+                if kernel_functions is not None and is_kernel_function != kernel_functions:
+                    continue
+
+                if function.__name__ in self["masks"].get(hook, []):
+                    self.logger.warning(
+                        f"[{c_(hook, bright=True)}] Skipping masked function: "
+                        f"{c_(function.__name__, 'yellow', bold=True)}"
+                    )
+                    continue
+
+                if function_output := self.run_func(function, *args, **kwargs):
+                    out += function_output
         return out
 
     def generate_profile(self) -> list[str]:
@@ -139,7 +298,7 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
 
         !!! MUST BE RUN AFTER ALL HOOKS ARE RUN !!!
         """
-        ver = version(__package__) or 9999  # Version won't be found unless the package is installed
+        ver = _get_version() or 9999  # Version won't be found unless the package is installed
         out = [
             self["shebang"].split(" ")[0],  # Don't add arguments to the shebang (for the profile)
             f"#\n# Generated by UGRD v{ver}\n#",
@@ -147,12 +306,12 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
 
         # Add the library paths
         library_paths = ":".join(self["library_paths"])
-        self.logger.debug("Library paths: %s" % library_paths)
+        self.logger.debug("Library paths: %s", library_paths)
         out.append(f"export LD_LIBRARY_PATH={library_paths}")
 
         # Add search paths
         search_paths = ":".join(self["binary_search_paths"])
-        self.logger.debug("Search paths: %s" % search_paths)
+        self.logger.debug("Search paths: %s", search_paths)
         out.append(f"export PATH={search_paths}")
 
         for func_name, func_content in self.included_functions.items():
@@ -211,16 +370,17 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
             self._write(self["_custom_init_file"], custom_init, 0o755)
 
         self._write("init", init, 0o755)
-        self.logger.debug("Final config:\n%s" % self)
+        self.logger.debug("Final config:\n%s", self)
 
-    def run_build(self) -> None:
-        """Runs all build tasks based on all build tasks
+    def run_build(self, build_tasks: list[str] | None = None, kernel_functions: bool | None = None) -> None:
+        """Runs all build tasks based on all build tasks, or the passed build tasks
         Enable force exclude so the output is not used to generate profile functions
+        kernel_functions is passed to run_hook.
         """
         self._log_run("Running build tasks")
-        for task in self.build_tasks:
-            self.logger.debug("Running build task: %s" % task)
-            self.run_hook(task, force_exclude=True)
+        for task in build_tasks or self.build_tasks:
+            self.logger.debug("Running build task: %s", task)
+            self.run_hook(task, force_exclude=True, kernel_functions=kernel_functions)
 
     def pack_build(self) -> None:
         """Packs the initramfs based on self['imports']['pack']
@@ -266,7 +426,7 @@ class InitramfsGenerator(GeneratorHelpers, LoggerMixIn):
             out += runlevel
             return out
         else:
-            self.logger.debug("No output for init level: %s" % level)
+            self.logger.debug("No output for init level: %s", level)
             return []
 
     def _log_run(self, logline: str) -> None:
@@ -1,10 +1,18 @@
 from pathlib import Path
 from subprocess import CompletedProcess
-from typing import Any, Protocol
+from typing import TYPE_CHECKING, Any, Protocol
 
 from zenlib.typing import HasLogger
 
 from ugrd import InitramfsConfig
+from ugrd.build_manifest import BuildManifest
+from ugrd.build_profiler import BuildProfiler
+from ugrd.command_runner import CommandRecord
+from ugrd.virtual_tree import VirtualTree
+
+if TYPE_CHECKING:  # decompressed_store imports generator_helpers, which imports this module
+    from ugrd.cpio_writer import CPIOIndexEntry
+    from ugrd.decompressed_store import DecompressedStore
 
 
 class InitramfsProtocol(HasLogger, Protocol):
@@ -12,6 +20,14 @@ class InitramfsProtocol(HasLogger, Protocol):
     included_functions: dict[str, str | list[str]]
     build_tasks: list[str]
     init_types: list[str]
+    virtual_tree: VirtualTree
+    build_manifest: BuildManifest | None
+    decompressed_store: "DecompressedStore | None"
+    cpio_index: "dict[str, CPIOIndexEntry]"
+    cpio_out_file: str | None
+    profiler: BuildProfiler | None
+    command_log: list[CommandRecord]
+    hook_orders: dict[str, tuple[list[str], list[tuple[str, str]]]]
 
     # Add basic definitions for functions defining dict like behavior
     def get(self, item: str, default: Any = None) -> Any: ...
@@ -20,14 +36,23 @@ class InitramfsProtocol(HasLogger, Protocol):
     def __contains__(self, key: str) -> bool: ...
 
     # Add definitions for helper functions
+    def _get_virtual_path(self, path: Path | str, resolve_build: bool = True) -> str | None: ...
+    def _build_path_exists(self, path: Path | str) -> bool: ...
+    def _read_build_file(self, path: Path | str) -> str: ...
     def _mkdir(self, path: Path, resolve_build: bool = True) -> None: ...
     def _write(
         self, file_name: Path | str, contents: list[str] | str, chmod_mask: int = 0o644, append: bool = False
     ) -> None: ...
+    def _write_bytes(self, file_name: Path | str, data: bytes, chmod_mask: int = 0o644) -> None: ...
     def _copy(self, source: Path | str, dest: Path | str | None = None) -> None: ...
+    def _copy_many(self, copies: list[tuple[Path | str, Path | str | None]]) -> None: ...
     def _symlink(self, source: Path | str, target: Path | str) -> None: ...
     def _run(
         self, args: list[str], timeout: int | None = None, fail_silent: bool = False, fail_hard: bool = True
         ) -> CompletedProcess: ...  # type: ignore[type-arg]
+    def _run_many(
+        self, commands: list[list[str]], timeout: int | None = None, fail_silent: bool = False, fail_hard: bool = True
+    ) -> list[CompletedProcess]: ...  # type: ignore[type-arg]
+    def _get_max_workers(self) -> int: ...
     def _rotate_old(self, file_name: Path, sequence: int = 0) -> None: ...
     def sort_hook_functions(self, hook: str) -> None: ...
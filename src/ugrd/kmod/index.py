@@ -0,0 +1,381 @@
+__author__ = "desultory"
+__version__ = "0.5.0"
+
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterator
+
+from ugrd.elf_helpers import ELFFile
+
+KMOD_EXTENSIONS = [".ko", ".ko.xz", ".ko.zst", ".ko.zstd", ".ko.gz"]
+ALIAS_WILDCARDS = "*?["
+# depmod metadata files used by the index, the cache is invalidated if any of them change
+INDEX_METADATA_FILES = ["modules.dep", "modules.softdep", "modules.alias", "modules.builtin", "modules.builtin.modinfo"]
+INDEX_CACHE_VERSION = 1
+_BUFFER_SIZE = 2**20  # 1 MiB, the amount of decompressed module data read at once
+_SPOOL_SIZE = 2**23  # 8 MiB, decompressed modules larger than this are spooled to a temporary file
+
+
+def get_kmod_name(kmod_path: Path | str) -> str:
+    """Returns the normalized kernel module name for a module path, such as kernel/fs/ext4/ext4.ko.zst -> ext4"""
+    name = Path(kmod_path).name
+    for extension in KMOD_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[: -len(extension)]
+            break
+    return name.replace("-", "_")
+
+
+def normalize_kmod_alias(alias: str) -> str:
+    """Gets the base alias name from kmod alias info, such as devname:btrfs-control -> btrfs_control
+    Gets data after : and , if present.
+    """
+    if not alias:
+        return ""
+    alias = alias.split(":", 1)[-1]  # Strip bus type
+    alias = alias.split(",", 1)[-1]
+    return alias.replace("-", "_")
+
+
+@lru_cache(maxsize=None)
+def _has_zstandard() -> bool:
+    """Returns True if the optional zstandard library is available, checked once per process."""
+    from importlib.util import find_spec
+
+    return find_spec("zstandard") is not None
+
+
+@contextmanager
+def _open_zstd_command(kmod_path: Path) -> Iterator[BinaryIO]:
+    """Opens a zstd compressed kernel module for reading, decompressing it with an external 'zstd'.
+    Raises an ImportError if the command is not available, and an OSError if it fails."""
+    from shutil import which
+    from subprocess import DEVNULL, PIPE, Popen
+
+    if not (zstd := which("zstd")):
+        raise ImportError("zstd kernel modules require the zstandard library or the zstd command")
+    with Popen([zstd, "-dcq", str(kmod_path)], stdout=PIPE, stderr=DEVNULL) as process:
+        yield process.stdout  # type: ignore[misc]
+    if process.returncode:
+        raise OSError("zstd failed with code %d: %s" % (process.returncode, kmod_path))
+
+
+@contextmanager
+def _open_kmod(kmod_path: Path) -> Iterator[BinaryIO]:
+    """Opens a compressed kernel module for reading, the contents are decompressed as they are read.
+    zstd modules are decompressed with the zstandard library if it is available, otherwise with an external 'zstd'.
+    """
+    if kmod_path.name.endswith(".xz"):
+        from lzma import open as xz_open
+
+        with xz_open(kmod_path) as f:
+            yield f  # type: ignore[misc]
+    elif kmod_path.name.endswith(".gz"):
+        from gzip import open as gz_open
+
+        with gz_open(kmod_path) as f:
+            yield f  # type: ignore[misc]
+    elif kmod_path.name.endswith(".zst") or kmod_path.name.endswith(".zstd"):
+        if not _has_zstandard():
+            with _open_zstd_command(kmod_path) as f:
+                yield f
+            return
+        from zstandard import ZstdDecompressor  # type: ignore
+
+        with open(kmod_path, "rb") as f, ZstdDecompressor().stream_reader(f) as reader:
+            yield reader
+    else:
+        raise ValueError("Unknown kernel module compression: %s" % kmod_path)
+
+
+def _read_modinfo_section(kmod_path: Path) -> bytes:
+    """Returns the .modinfo section of a kernel module file.
+    Uncompressed modules are mapped with mmap, so only the required pages are read.
+    Compressed modules are decompressed in chunks to a spooled temporary file,
+    modules larger than _SPOOL_SIZE are written to disk and mapped, rather than held in memory.
+    """
+    if kmod_path.name.endswith(".ko"):
+        return ELFFile.from_path(kmod_path).get_section_data(".modinfo")
+
+    with _open_kmod(kmod_path) as kmod_file, SpooledTemporaryFile(_SPOOL_SIZE) as spool:
+        copyfileobj(kmod_file, spool, _BUFFER_SIZE)
+        if spool.tell() <= _SPOOL_SIZE:
+            spool.seek(0)
+            return ELFFile(spool.read()).get_section_data(".modinfo")
+        with mmap(spool.fileno(), 0, access=ACCESS_READ) as data:  # The spool was rolled over to a file
+            return ELFFile(data).get_section_data(".modinfo")
+
+
+def read_kmod_modinfo(kmod_path: Path | str) -> dict[str, list[str]]:
+    """Reads the .modinfo section of a kernel module file, decompressing it if needed.
+
+    The section contains null separated <key>=<value> entries, keys may be repeated.
+    Returns a dict of keys to lists of values.
+    """
+    modinfo: dict[str, list[str]] = {}
+    for entry in _read_modinfo_section(Path(kmod_path)).split(b"\0"):
+        key, separator, value = entry.decode("utf-8", errors="ignore").partition("=")
+        if separator:
+            modinfo.setdefault(key, []).append(value)
+    return modinfo
+
+
+class KmodIndex:
+    """Kernel module metadata index for a single kernel version.
+
+    Reads the metadata files generated by depmod under /lib/modules/<kernel_version> once,
+    so filenames, dependencies, softdeps, aliases and builtin modules can be looked up without modinfo.
+
+    Aliases are indexed for lookups without scanning every alias:
+        - aliases: exact alias -> module
+        - _alias_names: normalized alias name (bus type stripped, - replaced with _) -> module
+        - _alias_patterns: literal prefix of wildcard aliases -> [(pattern, module), ...]
+
+    The text versions of the files are used, depmod always generates them alongside the .bin variants.
+
+    If a cache_file is passed, the parsed index and any firmware read from modules are loaded from it,
+    as long as the depmod metadata files have not changed since it was written.
+    save_cache writes the cache when anything new was read.
+    """
+
+    def __init__(self, kmod_dir: Path | str, cache_file: Path | str | None = None) -> None:
+        self.kmod_dir = Path(kmod_dir)
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.filenames: dict[str, str] = {}
+        self.depends: dict[str, list[str]] = {}
+        self.softdeps: dict[str, list[str]] = {}
+        self.aliases: dict[str, str] = {}
+        self._alias_names: dict[str, str] = {}
+        self._alias_patterns: dict[str, list[tuple[str, str]]] = {}
+        self.builtin: set[str] = set()
+        self.builtin_modinfo: dict[str, dict] = {}
+        self.modinfo: dict[str, dict[str, list[str]]] = {}
+        self.firmware: dict[str, list[str]] = {}
+        self.from_cache = False
+        self._dirty = False
+
+        if self.cache_file and self._load_cache():
+            self.from_cache = True
+            return
+
+        self._read_modules_dep()
+        self._read_modules_softdep()
+        self._read_modules_alias()
+        self._read_modules_builtin()
+        self._read_modules_builtin_modinfo()
+        self._dirty = True
+
+    def __contains__(self, module: str) -> bool:
+        return module in self.filenames or module in self.builtin
+
+    def _read_lines(self, file_name: str) -> list[str]:
+        """Reads the lines of a metadata file, skipping comments and blank lines.
+        Returns an empty list if the file does not exist."""
+        try:
+            lines = (self.kmod_dir / file_name).read_text(errors="ignore").splitlines()
+        except FileNotFoundError:
+            return []
+        return [line.strip() for line in lines if line.strip() and not line.startswith("#")]
+
+    def _read_modules_dep(self) -> None:
+        """Reads modules.dep, lines are in the format:
+        <module path>: <dependency path> <dependency path> ...
+        Paths may be relative to the kmod dir or absolute.
+        """
+        for line in self._read_lines("modules.dep"):
+            module_path, _, dependency_paths = line.partition(":")
+            module = get_kmod_name(module_path)
+            self.filenames[module] = str(self.kmod_dir / module_path)
+            self.depends[module] = [get_kmod_name(dep) for dep in dependency_paths.split()]
+
+    def _read_modules_softdep(self) -> None:
+        """Reads modules.softdep, lines are in the format:
+        softdep <module> pre: <module> ... post: <module> ...
+        """
+        for line in self._read_lines("modules.softdep"):
+            parts = line.split()
+            if len(parts) < 3 or parts[0] != "softdep":
+                continue
+            module = parts[1].replace("-", "_")
+            softdeps = self.softdeps.setdefault(module, [])
+            for dep in parts[2:]:
+                if dep in ["pre:", "post:"]:
+                    continue
+                dep = dep.replace("-", "_")
+                if dep not in softdeps:
+                    softdeps.append(dep)
+
+    def _read_modules_alias(self) -> None:
+        """Reads modules.alias, lines are in the format:
+        alias <alias> <module>
+        """
+        for line in self._read_lines("modules.alias"):
+            parts = line.split()
+            if len(parts) != 3 or parts[0] != "alias":
+                continue
+            self.add_alias(parts[1], parts[2])
+
+    def _read_modules_builtin(self) -> None:
+        """Reads modules.builtin, which contains the paths of modules built into the kernel."""
+        for line in self._read_lines("modules.builtin"):
+            self.builtin.add(get_kmod_name(line))
+
+    def _read_modules_builtin_modinfo(self) -> None:
+        """Reads modules.builtin.modinfo, which contains null separated <module>.<parameter>=<value> entries.
+        Aliases are added to the alias index, builtin modules with aliases or firmware are added to builtin_modinfo.
+        """
+        try:
+            entries = (self.kmod_dir / "modules.builtin.modinfo").read_bytes().split(b"\0")
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            entry = entry.decode("utf-8", errors="ignore").strip()
+            name, _, parameter = entry.partition(".")
+            parameter, separator, value = parameter.partition("=")
+            if not name or not separator or parameter not in ["alias", "firmware"]:
+                continue
+            name = name.replace("-", "_")
+            modinfo = self.builtin_modinfo.setdefault(
+                name, {"filename": "(builtin)", "depends": [], "softdep": [], "firmware": []}
+            )
+            if parameter == "firmware":
+                modinfo["firmware"].append(value)
+            else:
+                self.add_alias(value, name)
+
+    def _get_metadata_signature(self) -> dict[str, list[int] | None]:
+        """Returns the mtime and size of each metadata file used by the index, None for missing files."""
+        signature: dict[str, list[int] | None] = {}
+        for file_name in INDEX_METADATA_FILES:
+            try:
+                stat = (self.kmod_dir / file_name).stat()
+                signature[file_name] = [stat.st_mtime_ns, stat.st_size]
+            except FileNotFoundError:
+                signature[file_name] = None
+        return signature
+
+    def _load_cache(self) -> bool:
+        """Loads the index from the cache file, returns False if it is missing, invalid, or out of date."""
+        try:
+            cache = loads(self.cache_file.read_text())  # type: ignore[union-attr]
+            if cache["version"] != INDEX_CACHE_VERSION or cache["kmod_dir"] != str(self.kmod_dir):
+                return False
+            if cache["metadata"] != self._get_metadata_signature():
+                return False
+            self.filenames = cache["filenames"]
+            self.depends = cache["depends"]
+            self.softdeps = cache["softdeps"]
+            self.builtin = set(cache["builtin"])
+            self.builtin_modinfo = cache["builtin_modinfo"]
+            self.firmware = cache["firmware"]
+            for alias, module in cache["aliases"].items():
+                self.add_alias(alias, module)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    def save_cache(self) -> bool:
+        """Writes the index to the cache file if anything was read since it was loaded or last saved.
+        The file is written to a temporary file first, then moved into place.
+
+        Returns True if the cache file was written, raises an OSError if it can't be written.
+        """
+        if not self.cache_file or not self._dirty:
+            return False
+
+        cache = {
+            "version": INDEX_CACHE_VERSION,
+            "kmod_dir": str(self.kmod_dir),
+            "metadata": self._get_metadata_signature(),
+            "filenames": self.filenames,
+            "depends": self.depends,
+            "softdeps": self.softdeps,
+            "aliases": self.aliases,
+            "builtin": sorted(self.builtin),
+            "builtin_modinfo": self.builtin_modinfo,
+            "firmware": self.firmware,
+        }
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        temp_file.write_text(dumps(cache))
+        temp_file.replace(self.cache_file)
+        self._dirty = False
+        return True
+
+    def add_alias(self, alias: str, module: str) -> None:
+        """Adds an alias to the alias index.
+        The first module added for an alias is used, matching the priority order of modules.alias.
+
+        Aliases containing glob wildcards are stored under the literal prefix before the first wildcard.
+        """
+        module = module.replace("-", "_")
+        self.aliases.setdefault(alias, module)
+        wildcard_index = next((i for i, char in enumerate(alias) if char in ALIAS_WILDCARDS), None)
+        if wildcard_index is None:
+            self._alias_names.setdefault(normalize_kmod_alias(alias), module)
+        else:
+            self._alias_patterns.setdefault(alias[:wildcard_index], []).append((alias, module))
+
+    def resolve_alias(self, alias: str) -> str | None:
+        """Resolves an alias to a module name, returns None if the alias is not known.
+
+        Checks exact aliases, then normalized alias names, then wildcard aliases using modules.alias glob semantics.
+        Only wildcard aliases with a literal prefix matching the start of the alias are checked.
+        """
+        if module := self.aliases.get(alias):
+            return module
+        if module := self._alias_names.get(normalize_kmod_alias(alias)):
+            return module
+        for prefix_length in range(len(alias), -1, -1):
+            for pattern, module in self._alias_patterns.get(alias[:prefix_length], []):
+                if fnmatchcase(alias, pattern):
+                    return module
+        return None
+
+    def get_info(self, module: str) -> dict[str, list[str] | str] | None:
+        """Returns the module info for a module in the format used by _kmod_modinfo.
+        Returns None if the module is not in the index.
+
+        Firmware is not stored in the depmod metadata, so it is left as None to be read with get_firmware,
+        unless it was already read or loaded from the cache.
+        """
+        if module in self.filenames:
+            firmware = self.firmware.get(module)
+            return {
+                "filename": self.filenames[module],
+                "depends": self.depends[module].copy(),
+                "softdep": self.softdeps.get(module, []).copy(),
+                "firmware": firmware.copy() if firmware is not None else None,
+            }
+        if module in self.builtin_modinfo:
+            builtin_modinfo = self.builtin_modinfo[module]
+            return {**builtin_modinfo, "firmware": builtin_modinfo["firmware"].copy()}
+        if module in self.builtin:
+            return {"filename": "(builtin)", "depends": [], "softdep": [], "firmware": []}
+        return None
+
+    def get_modinfo(self, module: str) -> dict[str, list[str]]:
+        """Returns the .modinfo section contents of an indexed module, reading it from the module file on first use."""
+        if module not in self.modinfo:
+            self.modinfo[module] = read_kmod_modinfo(self.filenames[module])
+        return self.modinfo[module]
+
+    def get_firmware(self, module: str) -> list[str]:
+        """Returns the firmware files required by an indexed module, read from the .modinfo section on first use."""
+        if module not in self.firmware:
+            self.firmware[module] = self.get_modinfo(module).get("firmware", [])
+            self._dirty = True
+        return self.firmware[module]
+
+
+@lru_cache(maxsize=None)
+def get_kmod_index(kmod_dir: Path, cache_file: Path | None = None) -> KmodIndex:
+    """Returns the KmodIndex for a kmod dir, the index is only built once per kmod dir."""
+    return KmodIndex(kmod_dir, cache_file)
@@ -1,21 +1,21 @@
 __author__ = "desultory"
-__version__ = "4.2.2"
+__version__ = "4.8.3"
 
 
+from errno import EACCES, EPERM, EROFS
 from functools import lru_cache
 from pathlib import Path
 from platform import uname
-from re import search
 from struct import error as StructError
 from struct import unpack
-from subprocess import run
 
+from ugrd.elf_helpers import ELFError
 from ugrd.exceptions import AutodetectError, ValidationError
 from ugrd.kmod import BuiltinModuleError, DependencyResolutionError, IgnoredModuleError, MissingModuleError
+from ugrd.kmod.index import KmodIndex, get_kmod_index
 from zenlib.util import colorize as c_
 from zenlib.util import contains, unset
 
-_KMOD_ALIASES: dict[str, str] = {}
 MODULE_METADATA_FILES = ["modules.order", "modules.builtin", "modules.builtin.modinfo"]
 
 
@@ -25,28 +25,14 @@ def _normalize_kmod_name(module: str) -> str:
     return module.replace("-", "_")
 
 
-def _normalize_kmod_alias(self, alias: str) -> str:
-    """Gets the base alias name from kmod alias info
-    gets data after : and , if present.
-    """
-    if not alias:
-        return ""
-    alias = alias.split(":", 1)[-1]  # Strip bus type
-    alias = alias.split(",", 1)[-1]
-    return _normalize_kmod_name(alias)
-
-
 def _resolve_kmod_alias(self, module: str) -> str:
     """Attempts to resolve a kernel module alias to a module name.
-    Uses  /lib/modules/<kernel_version>/modules.alias to find the module name.
-    normalizes - to _ then replaces _ with [_-] to allow for both _ and - in the module name.
+    Uses the alias index of the kernel module index for the current kernel version,
+    built from /lib/modules/<kernel_version>/modules.alias and modules.builtin.modinfo.
     """
-    module = module.replace("-", "_")
-    module = module.replace("_", "[_-]")  # Allow for both _ and - in the module name
-    for alias, kmod in _KMOD_ALIASES.items():
-        if search(module, alias):
-            self.logger.info(f"Resolved kernel module alias: {c_(alias, 'blue')} -> {c_(kmod, 'cyan')}")
-            return kmod
+    if (kmod_index := _get_kmod_index(self)) and (kmod := kmod_index.resolve_alias(module)):
+        self.logger.info(f"Resolved kernel module alias: {c_(module, 'blue')} -> {c_(kmod, 'cyan')}")
+        return kmod
 
     raise MissingModuleError(f"Failed to resolve kernel module alias: {module}")
 
@@ -98,27 +84,72 @@ def _process__kmod_auto_multi(self, module: str) -> None:
     self["_kmod_auto"].append(module)
 
 
+def _get_kmod_cache_file(self) -> Path | None:
+    """Returns the path of the kernel module index cache file for the current kernel version.
+    Returns None if kmod_cache is disabled or no cache_dir is set.
+    """
+    if not self.get("kmod_cache") or not self.get("cache_dir"):
+        return None
+    return self["cache_dir"] / "kmod" / f"{self['kernel_version']}.json"
+
+
+def _get_kmod_index(self) -> KmodIndex | None:
+    """Returns the kernel module index for the current kernel version.
+    If kmod_cache is enabled, the index is loaded from the cache when the depmod metadata is unchanged.
+    Returns None if the kernel version is not set or the kmod directory does not exist.
+    """
+    kmod_dir = self.get("_kmod_dir")
+    if not self.get("kernel_version") or not kmod_dir or not kmod_dir.is_dir():
+        return None
+    return get_kmod_index(kmod_dir, _get_kmod_cache_file(self))
+
+
 def _get_kmod_info(self, module: str) -> tuple[str, dict]:
     """
-    Runs modinfo on a kernel module, parses the output and stored the results in self['_kmod_modinfo'].
+    Gets the info for a kernel module and stores the results in self['_kmod_modinfo'].
+    Uses the kernel module index when available, falling back to modinfo.
     !!! Should be run after metadata is processed so the kver is set properly !!!
 
     Returns the module info as a dictionary with the following keys:
     - filename: The path to the module file.
     - depends: A list of module dependencies.
     - softdep: A list of soft dependencies.
-    - firmware: A list of firmware files required by the module.
+    - firmware: A list of firmware files required by the module, None if not read yet.
     Raises:
         DependencyResolutionError: If the modinfo command fails, returns no output, or the module name can't be resolved.
     """
     module = _normalize_kmod_name(module)
     if module in self["_kmod_modinfo"]:
         return module, self["_kmod_modinfo"][module]
-    args = ["modinfo", module, "--set-version", self["kernel_version"]]
+
+    if kmod_index := _get_kmod_index(self):
+        if module_info := kmod_index.get_info(module):
+            self.logger.debug("[%s] Indexed module info: %s" % (module, module_info))
+            self["_kmod_modinfo"][module] = module_info
+            return module, module_info
+
+        if resolved_module := kmod_index.resolve_alias(module):
+            self.logger.info(f"Resolved kernel module alias: {c_(module, 'blue')} -> {c_(resolved_module, 'cyan')}")
+            if resolved_module != module:
+                return _get_kmod_info(self, resolved_module)
+
+        self.logger.debug("[%s] Module not found in the kernel module index, falling back to modinfo." % module)
+
+    return _get_modinfo(self, module)
+
+
+def _get_modinfo_args(self, module: str) -> list[str]:
+    return ["modinfo", module, "--set-version", self["kernel_version"]]
+
+
+def _get_modinfo(self, module: str) -> tuple[str, dict]:
+    """Runs modinfo on a kernel module, parses the output and stored the results in self['_kmod_modinfo'].
+    Used when the module cannot be found in the kernel module index.
+    """
+    args = _get_modinfo_args(self, module)
 
     try:
-        self.logger.debug("[%s] Modinfo command: %s" % (module, " ".join(args)))
-        cmd = run(args, capture_output=True)
+        cmd = self._run(args, fail_silent=True, fail_hard=False)
     except RuntimeError as e:
         raise DependencyResolutionError("[%s] Failed to run modinfo command: %s" % (module, " ".join(args))) from e
 
@@ -131,8 +162,13 @@ def _get_kmod_info(self, module: str) -> tuple[str, dict]:
                 "[%s] Modinfo returned no output and the alias name could no be resolved." % module
             )
 
+    return module, _parse_modinfo(self, module, cmd.stdout.decode())
+
+
+def _parse_modinfo(self, module: str, modinfo_output: str) -> dict:
+    """Parses the output of modinfo for a kernel module, stores and returns the module info."""
     module_info: dict[str, list[str] | str] = {"filename": "", "depends": [], "softdep": [], "firmware": []}
-    for line in cmd.stdout.decode().split("\n"):
+    for line in modinfo_output.split("\n"):
         line = line.strip()
         if line.startswith("filename:"):
             module_info["filename"] = line.split()[1]
@@ -153,55 +189,121 @@ def _get_kmod_info(self, module: str) -> tuple[str, dict]:
             module_info["firmware"].extend(line.split()[1:])  # type: ignore[union-attr]  # ignore for now, fixup later
 
     if not module_info.get("filename"):
-        raise DependencyResolutionError("[%s] Failed to process modinfo output: %s" % (module, cmd.stdout.decode()))
+        raise DependencyResolutionError("[%s] Failed to process modinfo output: %s" % (module, modinfo_output))
 
     self.logger.debug("[%s] Module info: %s" % (module, module_info))
     self["_kmod_modinfo"][module] = module_info
-    return module, module_info
+    return module_info
+
+
+def _prefetch_modinfo(self, modules: list[str]) -> None:
+    """Runs modinfo concurrently for modules which are not in the kernel module index, storing the results.
+    Modules which modinfo can't read are left for _get_kmod_info, which resolves aliases and raises errors.
+    """
+    kmod_index = _get_kmod_index(self)
+    missing = []
+    for module in dict.fromkeys(_normalize_kmod_name(module) for module in modules):
+        if module in self["_kmod_modinfo"]:
+            continue
+        if kmod_index and (kmod_index.get_info(module) or kmod_index.resolve_alias(module)):
+            continue
+        missing.append(module)
+
+    if not missing:
+        return
+
+    self.logger.debug("Running modinfo for modules which are not indexed: %s" % missing)
+    commands = [_get_modinfo_args(self, module) for module in missing]
+    try:
+        cmds = self._run_many(commands, fail_silent=True, fail_hard=False)
+    except (OSError, RuntimeError) as e:
+        return self.logger.warning("Failed to run modinfo for modules: %s" % e)
+
+    for module, cmd in zip(missing, cmds):
+        if cmd.stdout:
+            try:
+                _parse_modinfo(self, module, cmd.stdout.decode())
+            except DependencyResolutionError as e:
+                self.logger.debug(e)
+
+
+def _get_kmod_firmware(self, module: str, module_info: dict) -> list[str]:
+    """Returns the firmware files required by a kernel module.
+    The depmod metadata does not contain firmware information, so it is read from the .modinfo section of the module.
+    Falls back to modinfo if the module file cannot be read.
+    """
+    if module_info["firmware"] is not None:
+        return module_info["firmware"]
+
+    if kmod_index := _get_kmod_index(self):
+        try:
+            module_info["firmware"] = kmod_index.get_firmware(module).copy()
+            return module_info["firmware"]
+        except ImportError as e:  # zstd modules can't be read without zstandard or the zstd command
+            self.logger.debug("[%s] Unable to read module info from module file: %s", module, e)
+        except (ELFError, OSError, ValueError) as e:
+            self.logger.warning(f"[{c_(module, 'yellow')}] Unable to read module info from module file: {e}")
+
+    args = ["modinfo", "-F", "firmware", module_info["filename"]]
+    try:
+        cmd = self._run(args, fail_silent=True, fail_hard=False)
+    except FileNotFoundError as e:
+        raise DependencyResolutionError("[%s] modinfo is not available to read module firmware." % module) from e
+    except RuntimeError as e:
+        raise DependencyResolutionError("[%s] Failed to read module firmware: %s" % (module, e)) from e
+
+    if cmd.returncode != 0:
+        raise DependencyResolutionError("[%s] Failed to read module firmware: %s" % (module, cmd.stderr.decode()))
+
+    module_info["firmware"] = cmd.stdout.decode().split()
+    return module_info["firmware"]
 
 
 @unset("no_kmod", "no_kmod is enabled, skipping module alias enumeration.", log_level=30)
 def get_module_aliases(self):
-    """Processes the kernel module aliases from /lib/modules/<kernel_version>/modules.alias."""
+    """Processes the kernel module aliases from /lib/modules/<kernel_version>/modules.alias.
+    The aliases are read into the alias index of the kernel module index for the kernel version."""
     alias_file = Path("/lib/modules") / self["kernel_version"] / "modules.alias"
     if not alias_file.exists():
         self.logger.error(f"Kernel module alias file does not exist: {c_(alias_file, 'red', bold=True)}")
-    else:
-        for line in alias_file.read_text().splitlines():
-            _, alias, module = line.strip().split(" ", 2)
-            _KMOD_ALIASES[_normalize_kmod_alias(self, alias)] = _normalize_kmod_name(module)
+    elif kmod_index := _get_kmod_index(self):
+        if kmod_index.from_cache:
+            self.logger.debug("Loaded kernel module aliases from cache: %s" % kmod_index.cache_file)
+        self.logger.debug("Indexed kernel module aliases: %d" % len(kmod_index.aliases))
 
 
 @unset("no_kmod", "no_kmod is enabled, skipping builtin module enumeration.", log_level=30)
 def get_builtin_module_info(self) -> None:
-    """Gets the kernel module aliases from /lib/modules/<kernel_version>/modules.builtin.modinfo.
-    puts it in _kmod_modinfo.
-    also populates the _KMOD_ALIASES global variable with the aliases.
+    """Gets the kernel module info from /lib/modules/<kernel_version>/modules.builtin.modinfo.
+    The file is read by the kernel module index, which also adds the aliases to the alias index.
+    puts builtin modules with aliases or firmware in _kmod_modinfo.
     """
-
     builtin_modinfo_file = Path("/lib/modules") / self["kernel_version"] / "modules.builtin.modinfo"
     if not builtin_modinfo_file.exists():
         self.logger.error(f"Builtin modinfo file does not exist: {c_(builtin_modinfo_file, 'red', bold=True)}")
-    else:
-        for line in builtin_modinfo_file.read_bytes().split(b"\x00"):
-            """ Lines are in the format <name>.<parameter>=<value>"""
-            line = line.decode("utf-8", errors="ignore").strip()
-            if not line or "." not in line or "=" not in line:
-                continue
-            name, parameter = line.split(".", 1)
-            name = _normalize_kmod_name(name)
-            parameter, value = parameter.split("=", 1)
-            modinfo = self["_kmod_modinfo"].get(
-                name, {"filename": "(builtin)", "depends": [], "softdep": [], "firmware": []}
-            )
-            if parameter == "firmware":
-                modinfo["firmware"].append(value)
-            elif parameter != "alias":
-                continue
+    elif kmod_index := _get_kmod_index(self):
+        for name in kmod_index.builtin_modinfo:
+            if name not in self["_kmod_modinfo"]:
+                self["_kmod_modinfo"][name] = kmod_index.get_info(name)
 
-            alias = _normalize_kmod_alias(self, value)
-            self["_kmod_modinfo"][name] = modinfo
-            _KMOD_ALIASES[alias] = name  # Store the alias in the global aliases dict
+
+@unset("no_kmod", "no_kmod is enabled, skipping kernel module cache update.", log_level=30)
+@contains("kmod_cache", "kmod_cache is disabled, skipping kernel module cache update.")
+def save_kmod_cache(self) -> None:
+    """Saves the kernel module index for the kernel version to the cache, if anything new was read.
+    The cache is enabled by default, so if cache_dir is not writable, such as when running unprivileged,
+    the cache is skipped quietly. Logs a warning if the cache cannot be written for any other reason."""
+    if not (kmod_index := _get_kmod_index(self)):
+        return self.logger.debug("No kernel module index to cache.")
+
+    try:
+        if kmod_index.save_cache():
+            self.logger.info("Saved kernel module cache: %s" % c_(kmod_index.cache_file, "green"))
+    except OSError as e:
+        if e.errno in (EACCES, EPERM, EROFS):
+            return self.logger.debug("cache_dir is not writable, skipping kernel module cache: %s" % e)
+        self.logger.warning("Unable to write kernel module cache: %s" % e)
+        self.logger.info(f"Set {c_('kmod_cache', 'blue')}=false to disable the kernel module cache.")
 
 
 @contains("kmod_autodetect_lspci", "kmod_autodetect_lspci is not enabled, skipping.")
@@ -400,10 +502,27 @@ def process_module_metadata(self) -> None:
 def regen_kmod_metadata(self) -> None:
     """Regenerates kernel module metadata files using depmod."""
     self.logger.info("Regenerating kernel module metadata files.")
+    if self["direct_cpio"]:
+        return _regen_virtual_kmod_metadata(self)
     build_dir = self._get_build_path("/")
     self._run(["depmod", "--basedir", build_dir, self["kernel_version"]])
 
 
+def _regen_virtual_kmod_metadata(self) -> None:
+    """Runs depmod against a temporary copy of the kernel modules in the virtual tree, under tmpdir.
+    Modules read from the host are symlinked, compressed modules are decompressed into the copy.
+    The regenerated metadata files are added back to the virtual tree."""
+    from tempfile import TemporaryDirectory
+
+    kmod_path = Path("lib/modules") / self["kernel_version"]
+    with TemporaryDirectory(prefix="ugrd-depmod-", dir=self["tmpdir"]) as basedir:
+        self.virtual_tree.materialize(kmod_path, Path(basedir))
+        self._run(["depmod", "--basedir", basedir, self["kernel_version"]])
+        for metadata_file in (Path(basedir) / kmod_path).glob("modules.*"):
+            self.logger.debug("Adding regenerated kernel module metadata: %s" % metadata_file.name)
+            self.virtual_tree.add_data(kmod_path / metadata_file.name, metadata_file.read_bytes())
+
+
 def _add_kmod_firmware(self, kmod: str) -> None:
     """Adds firmware files for the specified kernel module to the initramfs.
 
@@ -418,15 +537,16 @@ def _add_kmod_firmware(self, kmod: str) -> None:
             )
         raise DependencyResolutionError("Kernel module info does not exist: %s" % kmod) from e
 
-    if modinfo["firmware"] and not self["kmod_pull_firmware"]:
+    firmware_files = _get_kmod_firmware(self, kmod, modinfo)
+    if firmware_files and not self["kmod_pull_firmware"]:
         # Log a warning if the kernel module has firmware files, but kmod_pull_firmware is not set
         self.logger.warning("[%s] Kernel module has firmware files, but kmod_pull_firmware is not set." % kmod)
 
-    if not modinfo["firmware"] or not self.get("kmod_pull_firmware"):
+    if not firmware_files or not self.get("kmod_pull_firmware"):
         # No firmware files to add, or kmod_pull_firmware is not set
         return
 
-    for firmware in modinfo["firmware"]:
+    for firmware in firmware_files:
         _add_firmware_dep(self, kmod, firmware)
 
 
@@ -598,7 +718,9 @@ def _process_optional_modules(self) -> None:
 
 @unset("no_kmod", "no_kmod is enabled, skipping.", log_level=30)
 def process_modules(self) -> None:
-    """Processes all kernel modules, adding dependencies to the initramfs."""
+    """Processes all kernel modules, adding dependencies to the initramfs.
+    Modules which are not in the kernel module index are read with modinfo concurrently first."""
+    _prefetch_modinfo(self, [*self["kmod_init_optional"], *self["kernel_modules"], *self["_kmod_auto"]])
     _process_optional_modules(self)
     self.logger.debug("Processing kernel modules: %s" % self["kernel_modules"])
     for kmod in self["kernel_modules"].copy():
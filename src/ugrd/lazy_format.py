@@ -0,0 +1,36 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+from typing import Any
+
+from zenlib.util import colorize, pretty_print
+
+
+class lazy_c_:
+    """Colorizes a value when it is converted to a string, rather than when it is created.
+
+    Passed as a logging argument, the value is only colorized if the record is emitted:
+        self.logger.debug("Setting value: %s", lazy_c_(value, "blue"))
+    """
+
+    __slots__ = ("value", "args", "kwargs")
+
+    def __init__(self, value: Any, *args: Any, **kwargs: Any) -> None:
+        self.value = value
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        return colorize(self.value, *self.args, **self.kwargs)
+
+
+class lazy_pretty_print:
+    """Pretty prints a value when it is converted to a string, for logging arguments."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    def __str__(self) -> str:
+        return pretty_print(self.value)
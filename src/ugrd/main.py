@@ -1,18 +1,16 @@
 #!/usr/bin/env python
 
-from pycpio.errors import UnavailableCompression
 from zenlib.util import get_args_n_logger, get_kwargs_from_args
 from zenlib.util import colorize as c_
 
 from ugrd.exceptions import AutodetectError, ValidationError
-from ugrd.kmod import MissingModuleError
-from ugrd.initramfs_generator import InitramfsGenerator
-from ugrd.config_helpers import get_parameters
 
 
 def print_params(hide_internal=True) -> None:
     """ Prints all available config parameters, optionally hiding those which start with an underscore.
     Colors internal modules blue, and external modules magenta. Parameter names are green and types are cyan. """
+    from ugrd.config_helpers import get_parameters
+
     for module, params in get_parameters().items():
         if module.startswith("ugrd"):
             print(f"{c_(module, 'blue', bold=True)}:")
@@ -37,12 +35,17 @@ def main():
         {"flags": ["-c", "--config"], "action": "store", "help": "set the config file location"},
         {"flags": ["-m", "--modules"], "action": "store", "help": "Define config modules to load, comma separated"},
         {"flags": ["--no-kmod"], "action": "store_true", "help": "Allow images to be built without kmods/kernel info"},
-        {"flags": ["--kernel-version", "--kver"], "action": "store", "help": "set the kernel version"},
+        {
+            "flags": ["--kernel-version", "--kver"],
+            "action": "append",
+            "help": "set the kernel version, pass multiple times to build an image for each kernel",
+            "dest": "kernel_version",
+        },
         {"flags": ["--clean"], "action": "store_true", "help": "clean the build directory at runtime"},
         {"flags": ["--no-clean"], "action": "store_false", "help": "disable build directory cleaning", "dest": "clean"},
         {
             "flags": ["--compress"],
-            "help": "compress the final image",
+            "help": "compress the final image, auto benchmarks compression types supported by the kernel",
             "dest": "cpio_compression",
         },
         {
@@ -141,6 +144,13 @@ def main():
             "help": "do not autodetect device mapper volumes",
             "dest": "autodetect_dm",
         },
+        {
+            "flags": ["--profile"],
+            "action": "store",
+            "nargs": "?",
+            "const": "ugrd_profile.json",
+            "help": "profile build hooks and functions, writing a Chrome trace to the file (ugrd_profile.json)",
+        },
         {"flags": ["--print-config"], "action": "store_true", "help": "print the final config dict"},
         {"flags": ["--print-init"], "action": "store_true", "help": "print the final init structure"},
         {"flags": ["--test"], "action": "store_true", "help": "Tests the image with QEMU"},
@@ -166,11 +176,20 @@ def main():
     kwargs.pop("print_config", None)  # This is not a valid kwarg for InitramfsGenerator
     kwargs.pop("print_init", None)  # This is not a valid kwarg for InitramfsGenerator
     test = kwargs.pop("test", False)
+    kernel_versions = kwargs.pop("kernel_version", [])
+    if len(kernel_versions) == 1:
+        kwargs["kernel_version"] = kernel_versions[0]
 
     if parameters:
         print_params()
         exit(0)
 
+    # Imported after arguments are handled, so --help and --parameters don't load the generator
+    from pycpio.errors import UnavailableCompression
+
+    from ugrd.initramfs_generator import InitramfsGenerator
+    from ugrd.kmod import MissingModuleError
+
     if kwargs.get("livecd_label") and "ugrd.fs.livecd" not in kwargs.get("modules", ""):
         kwargs["modules"] = kwargs["modules"] + ",ugrd.fs.livecd" if kwargs.get("modules") else "ugrd.fs.livecd"
 
@@ -188,7 +207,10 @@ def main():
         exit(1)
 
     try:
-        generator.build()
+        if len(kernel_versions) > 1:
+            generator.build_multi(kernel_versions)
+        else:
+            generator.build()
     except ValidationError as e:
         print(generator.config_dict)
         logger.critical(e, exc_info=True)
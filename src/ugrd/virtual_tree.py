@@ -0,0 +1,258 @@
+__author__ = "desultory"
+__version__ = "0.2.1"
+
+from contextlib import contextmanager
+from io import BytesIO
+from os import major, minor, readlink, walk
+from pathlib import Path
+from posixpath import dirname, join, normpath
+from shutil import copyfileobj
+from stat import S_IFCHR, S_IFDIR, S_IFLNK, S_IFREG, S_IMODE, S_ISCHR, S_ISDIR, S_ISLNK, S_ISREG
+from typing import BinaryIO, Callable, Iterator
+
+_MAX_SYMLINK_DEPTH = 40  # Matches the kernel's limit for nested symlinks
+_BUFFER_SIZE = 2**20  # 1 MiB
+
+
+class VirtualEntry:
+    """An entry in the virtual tree.
+
+    Files are stored by source path, with data, or with a source path and decompressor.
+    The mode only contains the permission bits, the file type is in entry_type.
+    If the mode is None for a file with a source, the mode of the source is used.
+    """
+
+    __slots__ = ("entry_type", "mode", "source", "data", "decompressor", "target", "major", "minor")
+
+    def __init__(
+        self,
+        entry_type: int,
+        mode: int | None = None,
+        source: Path | None = None,
+        data: bytes | None = None,
+        decompressor: Callable[[BinaryIO], BinaryIO] | None = None,
+        target: str | None = None,
+        major: int = 0,
+        minor: int = 0,
+    ) -> None:
+        self.entry_type = entry_type
+        self.mode = mode
+        self.source = source
+        self.data = data
+        self.decompressor = decompressor
+        self.target = target
+        self.major = major
+        self.minor = minor
+
+    def __repr__(self) -> str:
+        for name in ("source", "target", "data"):
+            if (value := getattr(self, name)) is not None:
+                return f"<VirtualEntry {self.entry_type:o} {name}={value!r:.64}>"
+        return f"<VirtualEntry {self.entry_type:o}>"
+
+    def get_mode(self) -> int:
+        """Returns the permission bits of the entry, reading them from the source if not set."""
+        if self.mode is None:
+            return S_IMODE(self.source.stat().st_mode) if self.source else 0o644
+        return self.mode
+
+    @contextmanager
+    def open(self) -> Iterator[BinaryIO]:
+        """Opens the file data for reading, decompressing it if a decompressor is set."""
+        if self.data is not None:
+            yield BytesIO(self.data)
+            return
+        if self.source is None:
+            raise ValueError("Entry has no data: %s" % self)
+
+        with self.source.open("rb") as source_file:
+            if not self.decompressor:
+                yield source_file  # type: ignore[misc]
+                return
+            with self.decompressor(source_file) as decompressed:
+                yield decompressed
+
+    def read_bytes(self) -> bytes:
+        """Reads all file data, decompressing it if needed."""
+        if self.data is not None:
+            return self.data
+        with self.open() as data:
+            return data.read()
+
+
+class VirtualTree:
+    """In-memory tree of initramfs contents, used to build CPIO archives without a build directory.
+
+    Entry names are relative to the root of the initramfs, without a leading slash.
+    Symlinked parent directories are resolved within the tree, like they would be in a build directory.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict[str, VirtualEntry] = {}
+
+    def __contains__(self, path: Path | str) -> bool:
+        return self.get(path) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def from_directory(cls, path: Path) -> "VirtualTree":
+        """Creates a tree from the contents of a directory, such as the build directory.
+        Only metadata is read, file data is read from the directory when the archive is written.
+        Raises a ValueError if an unsupported file type is found."""
+        tree = cls()
+        for root, dirs, files in walk(path):
+            for name in dirs + files:
+                entry_path = Path(root, name)
+                entry_name = str(entry_path.relative_to(path))
+                stat = entry_path.lstat()
+                if S_ISLNK(stat.st_mode):
+                    tree.entries[entry_name] = VirtualEntry(S_IFLNK, 0o777, target=readlink(entry_path))
+                elif S_ISDIR(stat.st_mode):
+                    tree.entries[entry_name] = VirtualEntry(S_IFDIR, S_IMODE(stat.st_mode))
+                elif S_ISREG(stat.st_mode):
+                    tree.entries[entry_name] = VirtualEntry(S_IFREG, S_IMODE(stat.st_mode), source=entry_path)
+                elif S_ISCHR(stat.st_mode):
+                    tree.entries[entry_name] = VirtualEntry(
+                        S_IFCHR, S_IMODE(stat.st_mode), major=major(stat.st_rdev), minor=minor(stat.st_rdev)
+                    )
+                else:
+                    raise ValueError("Unsupported file type: %s" % entry_path)
+        return tree
+
+    @staticmethod
+    def normalize(path: Path | str) -> str:
+        """Normalizes a path to an entry name, relative to the root of the tree.
+        Like in a chroot, ".." components cannot leave the root."""
+        name = normpath(join("/", str(path))).lstrip("/")
+        return "" if name == "." else name
+
+    def _follow(self, name: str, depth: int = 0) -> str:
+        """Follows a symlink entry, returning the resolved name of the target."""
+        entry = self.entries[name]
+        if depth > _MAX_SYMLINK_DEPTH:
+            raise OSError("Too many levels of symbolic links: %s" % name)
+        target: str = entry.target  # type: ignore[assignment]
+        if not target.startswith("/"):
+            target = join(dirname(name), target)
+        return self.resolve(target, depth + 1)
+
+    def resolve_parent(self, path: Path | str, depth: int = 0) -> str:
+        """Resolves symlinks in the parent directories of a path, returns the resolved entry name."""
+        parts = self.normalize(path).split("/")
+        resolved = ""
+        for part in parts[:-1]:
+            resolved = join(resolved, part) if resolved else part
+            entry = self.entries.get(resolved)
+            if entry and entry.entry_type == S_IFLNK:
+                resolved = self._follow(resolved, depth)
+        return join(resolved, parts[-1]) if resolved else parts[-1]
+
+    def resolve(self, path: Path | str, depth: int = 0) -> str:
+        """Resolves all symlinks in a path, returns the resolved entry name."""
+        name = self.resolve_parent(path, depth)
+        entry = self.entries.get(name)
+        if entry and entry.entry_type == S_IFLNK:
+            return self._follow(name, depth)
+        return name
+
+    def get(self, path: Path | str) -> VirtualEntry | None:
+        """Returns the entry for a path, resolving parent symlinks, does not follow a final symlink."""
+        return self.entries.get(self.resolve_parent(path))
+
+    def is_dir(self, path: Path | str) -> bool:
+        """Checks if a path is a directory, following symlinks."""
+        name = self.resolve(path)
+        return name == "" or (name in self.entries and self.entries[name].entry_type == S_IFDIR)
+
+    def is_file(self, path: Path | str) -> bool:
+        """Checks if a path is a regular file, following symlinks."""
+        entry = self.entries.get(self.resolve(path))
+        return entry is not None and entry.entry_type == S_IFREG
+
+    def is_symlink(self, path: Path | str) -> bool:
+        """Checks if a path is a symlink."""
+        entry = self.get(path)
+        return entry is not None and entry.entry_type == S_IFLNK
+
+    def mkdir(self, path: Path | str, mode: int = 0o755) -> str:
+        """Creates a directory and its parents, returns the resolved name of the directory.
+        Raises a FileExistsError if the path or a parent exists and is not a directory."""
+        resolved = ""
+        for part in self.normalize(path).split("/"):
+            if not part:
+                continue
+            resolved = self.resolve(join(resolved, part))
+            entry = self.entries.get(resolved)
+            if entry is None:
+                self.entries[resolved] = VirtualEntry(S_IFDIR, mode)
+            elif entry.entry_type != S_IFDIR:
+                raise FileExistsError("Path exists and is not a directory: %s" % resolved)
+        return resolved
+
+    def _add(self, path: Path | str, entry: VirtualEntry) -> str:
+        """Adds an entry to the tree, creating parent directories, returns the resolved entry name."""
+        name = self.resolve_parent(path)
+        if not name:
+            raise ValueError("Cannot replace the root of the tree")
+        if parent := dirname(name):
+            self.mkdir(parent)
+        self.entries[name] = entry
+        return name
+
+    def add_file(self, path: Path | str, source: Path, mode: int | None = None) -> str:
+        """Adds a file which is read from the source path when packed."""
+        return self._add(path, VirtualEntry(S_IFREG, mode, source=source))
+
+    def add_data(self, path: Path | str, data: bytes, mode: int = 0o644) -> str:
+        """Adds a file with the passed contents."""
+        return self._add(path, VirtualEntry(S_IFREG, mode, data=data))
+
+    def add_decompressed(self, path: Path | str, source: Path, decompressor: Callable[[BinaryIO], BinaryIO]) -> str:
+        """Adds a file which is decompressed from the source path when packed.
+        The decompressor takes the compressed file object, and returns a file object for the decompressed data."""
+        return self._add(path, VirtualEntry(S_IFREG, source=source, decompressor=decompressor))
+
+    def add_symlink(self, path: Path | str, target: Path | str) -> str:
+        """Adds a symlink pointing to the target."""
+        return self._add(path, VirtualEntry(S_IFLNK, 0o777, target=str(target)))
+
+    def add_chardev(self, path: Path | str, mode: int, major: int, minor: int) -> str:
+        """Adds a character device node."""
+        return self._add(path, VirtualEntry(S_IFCHR, S_IMODE(mode), major=major, minor=minor))
+
+    def remove(self, path: Path | str) -> None:
+        """Removes an entry, and any entries under it."""
+        name = self.resolve_parent(path)
+        for entry_name in [name] + [n for n in self.entries if n.startswith(name + "/")]:
+            self.entries.pop(entry_name, None)
+
+    def read_bytes(self, path: Path | str) -> bytes:
+        """Reads the contents of a file in the tree, following symlinks."""
+        name = self.resolve(path)
+        if not self.is_file(name):
+            raise FileNotFoundError("File not found in virtual tree: %s" % path)
+        return self.entries[name].read_bytes()
+
+    def materialize(self, path: Path | str, dest: Path) -> None:
+        """Writes the entries under a path in the tree to a directory on disk, such as for running depmod.
+        Entries are written under dest at the passed path, even if it is under a symlink. Device nodes are skipped.
+        Files read from a source are symlinked to it, only files with data, or which are decompressed, are written."""
+        name = self.resolve(path)
+        dest_base = dest / self.normalize(path)
+        for entry_name in sorted(n for n in self.entries if n == name or n.startswith(name + "/")):
+            entry = self.entries[entry_name]
+            entry_path = dest_base / entry_name[len(name) :].lstrip("/")
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            if entry.entry_type == S_IFDIR:
+                entry_path.mkdir(exist_ok=True)
+            elif entry.entry_type == S_IFLNK:
+                entry_path.symlink_to(entry.target)  # type: ignore[arg-type]
+            elif entry.entry_type == S_IFREG:
+                if entry.source and not entry.decompressor:
+                    entry_path.symlink_to(entry.source.absolute())
+                    continue
+                with entry.open() as source_file, entry_path.open("wb") as dest_file:
+                    copyfileobj(source_file, dest_file, _BUFFER_SIZE)
+                entry_path.chmod(entry.get_mode())
@@ -1,6 +1,13 @@
+from io import BytesIO
+from lzma import PRESET_EXTREME
+from lzma import decompress as xz_decompress
+from os import urandom
 from unittest import TestCase, main
+from unittest.mock import patch
 
 from pycpio.errors import UnavailableCompression
+from ugrd.compression import COMPRESSION_EXTENSIONS, XZBlockWriter
+from ugrd.cpio_writer import write_tree
 from ugrd.initramfs_generator import InitramfsGenerator
 from zenlib.logging import loggify
 
@@ -20,6 +27,69 @@ class TestCompression(TestCase):
         except UnavailableCompression as e:
             self.skipTest(f"ZSTD compression is not available: {e}")
 
+    def test_gzip(self):
+        """Test GZIP compression for initramfs."""
+        generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", cpio_compression="gzip")
+        generator.build()
+        self.assertTrue(generator["out_file"].endswith(".gz"))
+
+    def test_auto(self):
+        """Test that auto compression picks a compression type, and uses its extension for the archive name."""
+        generator = InitramfsGenerator(
+            logger=self.logger,
+            config="tests/fullauto.toml",
+            cpio_compression="auto",
+            cpio_compression_objective="build",
+        )
+        generator.build()
+        extension = generator.cpio_out_file.rsplit(".", 1)[-1]
+        self.assertIn(extension, COMPRESSION_EXTENSIONS.values())
+        self.assertTrue(generator._get_out_path(generator.cpio_out_file).exists())
+        self.assertTrue(generator.cpio_out_file.startswith(generator["out_file"]))  # out_file is not changed
+
+    def test_level_zero(self):
+        """Test that a compression level of 0 is used, rather than the default level."""
+        generator = InitramfsGenerator(
+            logger=self.logger, config="tests/fullauto.toml", cpio_compression="gzip", cpio_compression_level=0
+        )
+        with patch("ugrd.fs.cpio.write_tree", wraps=write_tree) as write:
+            generator.build()
+        self.assertEqual(write.call_args.args[-1], 0)
+
+    def test_bad_objective(self):
+        """Test that an unknown cpio_compression_objective is rejected."""
+        with self.assertRaises(ValueError):
+            InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", cpio_compression_objective="fast")
+
+    def test_xz_threads(self):
+        """Test block-parallel XZ compression for initramfs, the image must decompress as a single stream."""
+        generator = InitramfsGenerator(
+            logger=self.logger, config="tests/fullauto.toml", cpio_compression="xz", cpio_compression_threads=4
+        )
+        generator.build()
+        out_file = generator._get_out_path(generator["out_file"])
+        self.assertTrue(xz_decompress(out_file.read_bytes()).startswith(b"070701"))
+
+    def test_xz_blocks(self):
+        """Test that data split across many XZ blocks is decompressed in order."""
+        data = urandom(4096) * 16 + urandom(100000)
+        out_file = BytesIO()
+        with XZBlockWriter(out_file, threads=4, block_size=4096) as writer:
+            for offset in range(0, len(data), 3000):
+                writer.write(data[offset : offset + 3000])
+        self.assertEqual(xz_decompress(out_file.getvalue()), data)
+
+    def test_xz_presets(self):
+        """Test that XZ presets must be 0-9, and may use the extreme flag."""
+        data = urandom(4096) * 4
+        out_file = BytesIO()
+        with XZBlockWriter(out_file, threads=2, preset=0 | PRESET_EXTREME) as writer:
+            writer.write(data)
+        self.assertEqual(xz_decompress(out_file.getvalue()), data)
+        for preset in [10, -1, 10 | PRESET_EXTREME]:
+            with self.assertRaises(ValueError):
+                XZBlockWriter(BytesIO(), threads=2, preset=preset)
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,34 @@
+from os import environ
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase, main
+from logging import getLogger
+from unittest.mock import patch
 
+from ugrd.config_helpers import ModuleConfigCache, get_module_cache, get_module_cache_file, get_module_index
 from ugrd.exceptions import ValidationError
 from ugrd.initramfs_generator import InitramfsConfig
 from zenlib.logging import loggify
+from zenlib.util import colorize, parse_toml
 
 
 @loggify
 class TestConfig(TestCase):
+    def setUp(self):
+        """Uses a temporary module config cache, so tests don't write to /var/cache"""
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.module_cache_file = Path(tmpdir.name) / "modules.json"
+        cache_patch = patch("ugrd.config_helpers.MODULE_CACHE_FILE", self.module_cache_file)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        env_patch = patch.dict(environ)
+        env_patch.start()
+        self.addCleanup(env_patch.stop)
+        environ.pop("UGRD_MODULE_CACHE", None)
+        get_module_cache.cache_clear()
+        self.addCleanup(get_module_cache.cache_clear)
+
     def test_custom_parameter(self):
         """Tests that a custom parameter type can be defined and used"""
         config = InitramfsConfig(logger=self.logger, NO_BASE=True)
@@ -44,6 +66,65 @@ class TestConfig(TestCase):
         with self.assertRaises(ValidationError):
             config["stage"] = "final"
 
+    def test_parameter_handlers(self):
+        """Tests that parameter handlers are compiled once, and again when the parameter type changes"""
+        config = InitramfsConfig(logger=self.logger, NO_BASE=True)
+        config["custom_parameters"] = {"foo": "int"}
+        with patch.object(config, "_compile_handler", wraps=config._compile_handler) as compile_handler:
+            config["foo"] = "1"
+            config["foo"] = "2"
+            self.assertEqual(config["foo"], 2)
+            self.assertEqual(compile_handler.call_count, 1)
+
+            config["custom_parameters"] = {"foo": "str"}
+            config["foo"] = "3"
+            self.assertEqual(config["foo"], "3")
+            self.assertEqual(compile_handler.call_count, 2)
+
+    def test_module_cache(self):
+        """Tests that parsed module configs are cached by file signature, and copied when read"""
+        module_path = get_module_index()["ugrd.base.core"]
+        with TemporaryDirectory() as tmpdir:
+            cache_file = Path(tmpdir) / "modules.json"
+            with patch("ugrd.config_helpers.parse_toml", wraps=parse_toml) as parse:
+                cache = ModuleConfigCache(cache_file)
+                config = cache.read(module_path)
+                config["custom_parameters"].clear()
+                self.assertTrue(cache.save())
+                self.assertFalse(cache.save())
+
+                cache = ModuleConfigCache(cache_file)
+                self.assertEqual(cache.read(module_path), parse_toml(module_path))
+                self.assertEqual(parse.call_count, 1)
+
+    def test_module_cache_file(self):
+        """Tests that the module config cache is saved to MODULE_CACHE_FILE, or the file set in UGRD_MODULE_CACHE"""
+        InitramfsConfig(logger=self.logger, NO_BASE=True)
+        self.assertTrue(self.module_cache_file.exists())
+
+        environ["UGRD_MODULE_CACHE"] = str(self.module_cache_file.with_name("override.json"))
+        get_module_cache.cache_clear()
+        InitramfsConfig(logger=self.logger, NO_BASE=True)
+        self.assertTrue(self.module_cache_file.with_name("override.json").exists())
+
+        environ["UGRD_MODULE_CACHE"] = ""
+        get_module_cache.cache_clear()
+        self.assertIsNone(get_module_cache_file())
+        InitramfsConfig(logger=self.logger, NO_BASE=True)
+        self.assertFalse(get_module_cache().save())
+
+    def test_lazy_log_formatting(self):
+        """Tests that debug messages are only colorized when they are logged"""
+        logger = getLogger("ugrd.test_lazy_log_formatting")
+        with patch("ugrd.lazy_format.colorize", wraps=colorize) as lazy_colorize:
+            logger.setLevel(20)
+            InitramfsConfig(logger=logger, NO_BASE=True)
+            self.assertEqual(lazy_colorize.call_count, 0)
+
+            with self.assertLogs(logger, level=5):
+                InitramfsConfig(logger=logger, NO_BASE=True)
+            self.assertGreater(lazy_colorize.call_count, 0)
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,33 @@
+from gzip import compress as gz_compress
+from json import loads
+from lzma import compress as xz_compress
+from lzma import open as xz_open
 from os import fsdecode
 from pathlib import Path
+from shutil import which
+from struct import pack
 from subprocess import CompletedProcess
 from tempfile import TemporaryDirectory
 from unittest import TestCase, main
-from unittest.mock import Mock
+from unittest.mock import MagicMock, Mock, patch
 
-from ugrd.base.core import LDConfigError, _get_ldconfig
+from ugrd.base.core import LDConfigError, _get_elf_deps, _get_ldconfig, _prefetch_binaries
+from ugrd.cpio_writer import write_tree
+from ugrd.decompressed_store import DecompressedStore
+from ugrd.elf_helpers import (
+    LD_SO_CACHE_MAGIC,
+    LD_SO_CACHE_OLD_MAGIC,
+    ELFError,
+    get_elf_dependencies,
+    get_elf_info,
+    ld_so_cache_libcmp,
+    make_ld_so_cache,
+    read_ld_so_cache,
+    update_elf_info_cache,
+)
+from ugrd.exceptions import AutodetectError
 from ugrd.initramfs_generator import InitramfsGenerator
+from ugrd.virtual_tree import VirtualTree
 from zenlib.logging import loggify
 
 
@@ -45,6 +66,321 @@ class TestCore(TestCase):
 
         self.assertIn(fsdecode(cmd.stderr).strip(), str(error.exception))
 
+    def test_elf_dependencies(self):
+        """Check that ELF dependencies are resolved starting with the binary, then the interpreter, then libraries"""
+        binary = Path(which("sh")).resolve()
+        dependencies = get_elf_dependencies(binary)
+        self.assertEqual(dependencies[0], binary)
+        self.assertEqual(str(dependencies[1]), get_elf_info(binary).interpreter)
+        self.assertEqual(len(dependencies), len(set(dependencies)))
+        for dependency in dependencies:
+            self.assertTrue(dependency.exists())
+            self.assertTrue(get_elf_info(dependency).is_compatible(get_elf_info(binary)))
+
+    def test_elf_dependencies_no_lddtree(self):
+        """Check that an AutodetectError is raised if ELF dependencies can't be resolved and lddtree is not installed"""
+        generator = MagicMock()
+        generator._run.side_effect = FileNotFoundError("lddtree")
+        with patch("ugrd.base.core.get_elf_dependencies", side_effect=ELFError("Invalid ELF class")):
+            with self.assertRaises(AutodetectError) as error:
+                _get_elf_deps(generator, "/usr/bin/foo")
+        self.assertIn("/usr/bin/foo", str(error.exception))
+        self.assertIn("Invalid ELF class", str(error.exception))
+
+    def test_elf_dependencies_script(self):
+        """Check that files which are not ELF files only return themselves as dependencies"""
+        with TemporaryDirectory() as tmpdir:
+            script = Path(tmpdir) / "script.sh"
+            script.write_text("#!/bin/sh\necho test\n")
+            self.assertIsNone(get_elf_info(script))
+            self.assertEqual(get_elf_dependencies(script), [script])
+
+    def test_prefetch_binaries(self):
+        """Check that binary dependencies are resolved by worker processes, and the ELF info is used by this process"""
+        generator = InitramfsGenerator(logger=self.logger, config="tests/no_kmods.toml", max_workers=2)
+        binary = Path(which("sh")).resolve()
+        with patch.dict("ugrd.elf_helpers._ELF_INFO_CACHE", clear=True):
+            with patch("ugrd.base.core.update_elf_info_cache", wraps=update_elf_info_cache) as update:
+                _prefetch_binaries(generator, [str(binary), ["cat", "not-a-binary"]])
+            self.assertEqual(update.call_count, 2)
+            with patch("ugrd.elf_helpers.ELFFile.from_path", side_effect=ELFError("Not prefetched")):
+                self.assertEqual(get_elf_dependencies(binary)[0], binary)
+
+        masks = {"build_pre": "_prefetch_binaries"}
+        generator = InitramfsGenerator(logger=self.logger, config="tests/no_kmods.toml", max_workers=2, masks=masks)
+        with patch("ugrd.base.core.update_elf_info_cache") as update:
+            generator["stage"] = "late"  # Processes the queued binaries
+        update.assert_not_called()
+
+    def test_read_ld_so_cache(self):
+        """Check that old and new format ld.so.cache files are read"""
+        strings = b"libfoo.so.1\0/lib64/libfoo.so.1\0/lib/libfoo.so.1\0"
+        old_entries = [(0x0303, 0, 12), (0x0003, 0, 31)]
+        old_cache = LD_SO_CACHE_OLD_MAGIC + b"\0" + pack("=I", len(old_entries))
+        old_cache += b"".join(pack("=iII", *entry) for entry in old_entries) + strings
+
+        new_strings_offset = 48 + 24 * len(old_entries)
+        new_cache = LD_SO_CACHE_MAGIC + pack("<IIB3xI12x", len(old_entries), len(strings), 2, 0)
+        for flags, key, value in old_entries:
+            new_cache += pack("<iIIIQ", flags, new_strings_offset + key, new_strings_offset + value, 0, 0)
+        new_cache += strings
+
+        with TemporaryDirectory() as tmpdir:
+            for name, data in [("old", old_cache), ("new", new_cache)]:
+                cache_file = Path(tmpdir) / name
+                cache_file.write_bytes(data)
+                self.assertEqual(
+                    read_ld_so_cache(cache_file),
+                    {"libfoo.so.1": [(0x0303, "/lib64/libfoo.so.1"), (0x0003, "/lib/libfoo.so.1")]},
+                )
+
+    def test_make_ld_so_cache(self):
+        """Check that generated ld.so.cache files can be read, and are sorted for the loader's binary search"""
+        libraries = {
+            "libc.so.6": (0x0303, "/lib64/libc.so.6"),
+            "libz.so.1": (0x0303, "/lib64/libz.so.1"),
+            "libcrypto.so.3": (0x0303, "/usr/lib64/libcrypto.so.3"),
+            "libcrypto.so.10": (0x0303, "/usr/lib64/libcrypto.so.10"),
+            "ld-linux-x86-64.so.2": (0x0303, "/lib64/ld-linux-x86-64.so.2"),
+        }
+        self.assertGreater(ld_so_cache_libcmp("libcrypto.so.10", "libcrypto.so.3"), 0)
+        self.assertLess(ld_so_cache_libcmp("libc.so.6", "libcrypto.so.3"), 0)
+
+        with TemporaryDirectory() as tmpdir:
+            cache_file = Path(tmpdir) / "ld.so.cache"
+            cache_file.write_bytes(make_ld_so_cache(libraries))
+            cache = read_ld_so_cache(cache_file)
+            self.assertEqual(cache, {name: [entry] for name, entry in libraries.items()})
+            names = list(cache)
+            for name, next_name in zip(names, names[1:]):
+                self.assertGreater(ld_so_cache_libcmp(name, next_name), 0)
+
+    def test_copy_many(self):
+        """Check that files are copied into the build directory with their contents and permissions"""
+        with TemporaryDirectory() as tmpdir:
+            generator = InitramfsGenerator(
+                logger=self.logger, config="tests/fullauto.toml", build_dir=Path(tmpdir) / "build"
+            )
+            sources = []
+            for index in range(8):
+                source = Path(tmpdir) / "source" / str(index) / "file"
+                source.parent.mkdir(parents=True)
+                source.write_text(f"test file {index}")
+                source.chmod(0o750)
+                sources.append(source)
+
+            generator._copy_many([(source, None) for source in sources] + [(sources[0], "/renamed")])
+            for source in sources:
+                dest = generator._get_build_path(source)
+                self.assertEqual(dest.read_text(), source.read_text())
+                self.assertEqual(dest.stat().st_mode, source.stat().st_mode)
+            self.assertEqual(generator._get_build_path("/renamed").read_text(), "test file 0")
+
+    def test_run_many(self):
+        """Check that commands are run concurrently, returned in order, and recorded in the command log"""
+        generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml")
+        commands = [["sh", "-c", "sleep 0.2; echo first"], ["false"], ["echo", "last"]]
+        results = generator._run_many(commands, fail_silent=True, fail_hard=False)
+        self.assertEqual([result.returncode for result in results], [0, 1, 0])
+        self.assertEqual([result.stdout for result in results], [b"first\n", b"", b"last\n"])
+        self.assertIs(generator.command_log, generator.config_dict.command_log)
+        self.assertEqual(sorted(record.args[0] for record in generator.command_log[-3:]), ["echo", "false", "sh"])
+        durations = {record.args[0]: record.duration for record in generator.command_log[-3:]}
+        self.assertGreaterEqual(durations["sh"], 0.2)
+
+        with self.assertRaises(RuntimeError):
+            generator._run_many(commands, fail_silent=True)
+
+    def test_compressed_dependencies(self):
+        """Check that xz and gzip dependencies are decompressed into the build directory"""
+        with TemporaryDirectory() as tmpdir:
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml")
+            contents = {}
+            for index in range(4):
+                for extension, compress in [("xz", xz_compress), ("gz", gz_compress)]:
+                    dependency = Path(tmpdir) / f"test{index}.bin.{extension}"
+                    contents[dependency.with_suffix("")] = f"{extension} test file {index}".encode() * 1000
+                    dependency.write_bytes(compress(contents[dependency.with_suffix("")]))
+                    generator[f"{extension}_dependencies"] = dependency
+            generator.build()
+            for path, data in contents.items():
+                self.assertEqual(generator._get_build_path(path).read_bytes(), data)
+
+    def test_direct_cpio(self):
+        """Check that direct_cpio writes the archive without populating the build directory"""
+        with TemporaryDirectory() as tmpdir:
+            build_dir = Path(tmpdir) / "build"
+            out_file = Path(tmpdir) / "direct.cpio"
+            generator = InitramfsGenerator(
+                logger=self.logger,
+                config="tests/fullauto.toml",
+                build_dir=build_dir,
+                out_file=out_file,
+                cpio_compression="false",
+                direct_cpio=True,
+            )
+            dependency = Path(tmpdir) / "direct.bin.xz"
+            dependency.write_bytes(xz_compress(b"direct cpio test" * 1000))
+            generator["xz_dependencies"] = dependency
+            generator.build()
+            self.assertFalse(build_dir.exists())
+
+            entries = read_newc(out_file.read_bytes())
+            self.assertEqual(entries[str(dependency.with_suffix("")).lstrip("/")], b"direct cpio test" * 1000)
+            self.assertEqual(entries["init"], generator.virtual_tree.read_bytes("init"))
+            self.assertIn("dev/console", entries)
+
+    def test_virtual_tree_materialize(self):
+        """Check that materialized files with a source are symlinked, and only data and decompressed files are written"""
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "module.ko"
+            source.write_bytes(b"module")
+            compressed = Path(tmpdir) / "compressed.ko.xz"
+            compressed.write_bytes(xz_compress(b"compressed module"))
+            tree = VirtualTree()
+            tree.add_file("lib/modules/test/module.ko", source)
+            tree.add_decompressed("lib/modules/test/compressed.ko", compressed, xz_open)
+            tree.add_data("lib/modules/test/modules.order", b"module.ko\n")
+
+            dest = Path(tmpdir) / "dest"
+            tree.materialize("lib/modules/test", dest)
+            kmod_dir = dest / "lib/modules/test"
+            self.assertEqual((kmod_dir / "module.ko").readlink(), source)
+            self.assertFalse((kmod_dir / "compressed.ko").is_symlink())
+            self.assertEqual((kmod_dir / "compressed.ko").read_bytes(), b"compressed module")
+            self.assertEqual((kmod_dir / "modules.order").read_bytes(), b"module.ko\n")
+
+    def test_cpio_deduplicate(self):
+        """Check that duplicate files are written once as hardlinks, and the index points to each entry header"""
+        with TemporaryDirectory() as tmpdir:
+            build_dir = Path(tmpdir) / "build"
+            for name in ["a", "b", "sub/c"]:
+                (build_dir / name).parent.mkdir(parents=True, exist_ok=True)
+                (build_dir / name).write_bytes(b"duplicate data" * 1000)
+            (build_dir / "link").symlink_to("sub/c")
+            out_file = Path(tmpdir) / "dedup.cpio"
+            index = write_tree(VirtualTree.from_directory(build_dir), out_file, "false", deduplicate=True)
+
+            data = out_file.read_bytes()
+            entries = read_newc(data)
+            self.assertEqual(entries["a"], b"duplicate data" * 1000)
+            self.assertEqual(entries["b"], b"")
+            self.assertEqual(entries["sub/c"], b"")
+            self.assertEqual(entries["link"], b"sub/c")
+            for name, entry in index.items():
+                self.assertEqual(data[entry.offset + 110 : entry.offset + 110 + len(name)], name.encode())
+            self.assertEqual(index["b"].size, 14000)
+            self.assertEqual(index["sub/c"].read_bytes(), b"duplicate data" * 1000)
+
+    def test_image_cache(self):
+        """Check that a second build with the same inputs copies the cached image instead of writing the archive"""
+        with TemporaryDirectory() as cache_dir:
+            kwargs = {"cpio_cache": True, "cache_dir": cache_dir, "test_flag": "image_cache_test"}
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", **kwargs)
+            generator.build()
+            out_file = generator._get_out_path(generator["out_file"])
+            image = out_file.read_bytes()
+
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", **kwargs)
+            with patch("ugrd.fs.cpio.write_tree") as write_tree:
+                generator.build()
+            write_tree.assert_not_called()
+            self.assertEqual(out_file.read_bytes(), image)
+            self.assertEqual(len(list((Path(cache_dir) / "images").iterdir())), 1)
+
+    def test_incremental_build(self):
+        """Check that incremental builds keep unchanged files, and remove files which are no longer deployed"""
+        with TemporaryDirectory() as tmpdir:
+            extra_dep = Path(tmpdir) / "extra_dep"
+            extra_dep.write_text("extra")
+            generator = InitramfsGenerator(
+                logger=self.logger, config="tests/fullauto.toml", incremental_build=True, dependencies=[extra_dep]
+            )
+            generator.build()
+            build_extra_dep = generator._get_build_path(extra_dep)
+            self.assertTrue(build_extra_dep.is_file())
+
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", incremental_build=True)
+            with patch("ugrd.generator_helpers.copy_file") as copy_file:
+                generator.build()
+            copy_file.assert_not_called()
+            self.assertFalse(build_extra_dep.exists())
+
+    def test_decompress_cache(self):
+        """Check that decompressed dependencies are stored and reused, and the store is limited by size"""
+        with TemporaryDirectory() as tmpdir, TemporaryDirectory() as cache_dir:
+            dependency = Path(tmpdir) / "cached.bin.xz"
+            dependency.write_bytes(xz_compress(b"decompress cache test" * 1000))
+            kwargs = {"decompress_cache": True, "cache_dir": cache_dir, "xz_dependencies": [dependency]}
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", **kwargs)
+            generator.build()
+            self.assertEqual(len(generator.decompressed_store.entries), 1)
+
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", **kwargs)
+            with patch("ugrd.decompressed_store.copyfileobj") as copyfileobj:
+                generator.build()
+            copyfileobj.assert_not_called()
+            build_path = generator._get_build_path(dependency.with_suffix(""))
+            self.assertEqual(build_path.read_bytes(), b"decompress cache test" * 1000)
+
+            store = generator.decompressed_store
+            store.max_size, store.used = 0, set()
+            self.assertEqual(len(store.save()), 1)
+            self.assertEqual([path.name for path in store.store_dir.iterdir() if not path.suffix], [])
+
+    def test_decompressed_store_shared(self):
+        """Check that stores sharing a directory merge their indexes, and only evict files when no other is in use"""
+        with TemporaryDirectory() as tmpdir:
+            sources = []
+            for name in ["first", "second"]:
+                sources.append(Path(tmpdir) / f"{name}.xz")
+                sources[-1].write_bytes(xz_compress(name.encode() * 1000))
+            store_dir = Path(tmpdir) / "store"
+            first, second = DecompressedStore(store_dir, 0), DecompressedStore(store_dir, 0)
+            first_path, _ = first.get_path(sources[0], xz_open)
+            second_path, _ = second.get_path(sources[1], xz_open)
+            self.assertEqual(first.save(), [])  # The second store is in use
+            self.assertEqual(second.save(), [])
+            index = loads(first.index_file.read_text())
+            self.assertEqual(set(index["entries"]), {first_path.name, second_path.name})
+
+            orphan = store_dir / ("0" * 64)  # Files missing from the index are evicted
+            orphan.write_bytes(b"orphan")
+            second.close()
+            self.assertCountEqual(first.save(), [second_path.name, orphan.name])
+            self.assertTrue(first_path.is_file())
+
+            first.close()
+            self.assertEqual(DecompressedStore(store_dir, 0).save(), [first_path.name])
+            self.assertEqual([path.name for path in store_dir.iterdir() if not path.suffix], [])
+
+    def test_profile(self):
+        """Check that profiling writes a trace with hooks, functions, and config processing"""
+        with TemporaryDirectory() as tmpdir:
+            trace_file = Path(tmpdir) / "trace.json"
+            generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml", profile=trace_file)
+            generator.build()
+            trace = loads(trace_file.read_text())
+            events = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+            self.assertEqual({event["cat"] for event in events}, {"hook", "function", "config"})
+            self.assertIn("build_deploy", {event["name"] for event in events if event["cat"] == "hook"})
+            self.assertIn("_process_modules", {event["name"] for event in events if event["cat"] == "config"})
+            self.assertTrue(all(event["dur"] >= 0 and "cpu_ms" in event["args"] for event in events))
+
+
+def read_newc(data: bytes) -> dict[str, bytes]:
+    """Reads the names and data of entries in an uncompressed newc CPIO archive"""
+    entries, offset = {}, 0
+    while True:
+        header = data[offset : offset + 110]
+        file_size, name_size = int(header[54:62], 16), int(header[94:102], 16)
+        name = data[offset + 110 : offset + 110 + name_size - 1].decode()
+        offset += 110 + name_size + (-(110 + name_size) % 4)
+        if name == "TRAILER!!!":
+            return entries
+        entries[name] = data[offset : offset + file_size]
+        offset += file_size + (-file_size % 4)
+
 
 if __name__ == "__main__":
     main()
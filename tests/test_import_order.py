@@ -0,0 +1,67 @@
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from ugrd.base.checks import check_init_order
+from ugrd.exceptions import ValidationError
+from ugrd.import_order import ImportOrderError, find_order_violation, get_order_edges, sort_functions
+from ugrd.initramfs_generator import InitramfsGenerator
+from zenlib.logging import loggify
+
+
+@loggify
+class TestImportOrder(TestCase):
+    def test_stable_sort(self):
+        """Check that functions are moved to meet requirements, keeping the original order otherwise"""
+        names = ["a", "b", "c", "d", "e"]
+        edges = get_order_edges(names, {"before": {"d": ["b"]}, "after": {"a": "e", "x": ["a"]}})
+        self.assertEqual(edges, [("e", "a"), ("d", "b")])
+        order = [names[index] for index in sort_functions(names, edges)]
+        self.assertEqual(order, ["e", "a", "d", "b", "c"])
+        self.assertIsNone(find_order_violation(order, edges))
+        self.assertEqual(find_order_violation(names, edges), ("e", "a"))
+
+    def test_cycle(self):
+        """Check that the functions in a cycle are reported"""
+        names = ["a", "b", "c", "d"]
+        edges = get_order_edges(names, {"before": {"b": ["c"], "c": ["d"]}, "after": {"b": ["d"]}})
+        with self.assertRaises(ImportOrderError) as e:
+            sort_functions(names, edges)
+        self.assertEqual(e.exception.cycle, ["b", "c", "d", "b"])
+
+    def test_order_violation(self):
+        """Check that order violations report the hook and the before/after entry which was violated"""
+
+        def foo(): ...
+
+        def bar(): ...
+
+        imports = {"init_main": [foo, bar]}
+        for import_order, message in [
+            ({"before": {"bar": "foo"}}, "[init_main] Function 'bar' must be before: foo (import_order.before)"),
+            ({"after": {"foo": ["bar"]}}, "[init_main] Function 'foo' must be after: bar (import_order.after)"),
+        ]:
+            with self.assertRaises(ValidationError) as e:
+                check_init_order({"imports": imports, "import_order": import_order})
+            self.assertEqual(str(e.exception), message)
+
+    def test_hook_order_cache(self):
+        """Check that hooks are only sorted again when the functions or import order change"""
+        generator = InitramfsGenerator(logger=self.logger, config="tests/fullauto.toml")
+        func_names = [func.__name__ for func in generator["imports"]["build_pre"]]
+        generator["import_order"]["before"][func_names[-1]] = [func_names[0]]
+        with patch("ugrd.generator_helpers.sort_functions", wraps=sort_functions) as sort:
+            generator.sort_hook_functions("build_pre")
+            generator.sort_hook_functions("build_pre")
+            self.assertEqual(sort.call_count, 1)
+            self.assertEqual(generator["imports"]["build_pre"][0].__name__, func_names[-1])
+
+            generator["import_order"]["after"][func_names[-1]] = [func_names[1]]
+            generator.sort_hook_functions("build_pre")
+            self.assertEqual(sort.call_count, 2)
+        sorted_names = [func.__name__ for func in generator["imports"]["build_pre"]]
+        self.assertLess(sorted_names.index(func_names[1]), sorted_names.index(func_names[-1]))
+        self.assertLess(sorted_names.index(func_names[-1]), sorted_names.index(func_names[0]))
+
+
+if __name__ == "__main__":
+    main()
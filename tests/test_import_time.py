@@ -0,0 +1,43 @@
+from os import environ
+from subprocess import run
+from sys import executable
+from unittest import TestCase, main
+
+from zenlib.logging import loggify
+
+# Modules which should only be imported when building, not when starting the CLI
+BUILD_MODULES = ["ugrd.initramfs_config", "ugrd.initramfs_generator", "ugrd.kmod", "pycpio", "multiprocessing"]
+
+
+def get_import_times(code: str) -> dict[str, int]:
+    """Runs code in a new interpreter with -X importtime, returns the cumulative import time of each module in us.
+    The module config cache is disabled, so the interpreter doesn't write to /var/cache."""
+    env = {**environ, "UGRD_MODULE_CACHE": ""}
+    cmd = run([executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True, env=env)
+    import_times = {}
+    for line in cmd.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+@loggify
+class TestImportTime(TestCase):
+    def test_cli_import_time(self):
+        """Checks that importing the CLI does not import the generator, pycpio, or kmod modules"""
+        import_times = get_import_times("import ugrd.main")
+        self.logger.info("ugrd.main import time: %.1fms" % (import_times["ugrd.main"] / 1000))
+        for module in BUILD_MODULES:
+            self.assertNotIn(module, import_times)
+
+    def test_parameters_import_time(self):
+        """Checks that reading module parameters does not import the generator or pycpio"""
+        import_times = get_import_times("from ugrd.config_helpers import get_parameters; get_parameters()")
+        for module in BUILD_MODULES:
+            self.assertNotIn(module, import_times)
+
+
+if __name__ == "__main__":
+    main()
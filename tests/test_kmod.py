@@ -1,9 +1,45 @@
+from errno import EACCES, ENOSPC, EROFS
+from gzip import compress as gzip_compress
+from lzma import compress
+from pathlib import Path
+from shutil import which
+from struct import pack
+from subprocess import run
+from tempfile import TemporaryDirectory
 from unittest import TestCase, main
+from unittest.mock import MagicMock, patch
 
 from ugrd.initramfs_generator import InitramfsGenerator
+from ugrd.kmod.index import KmodIndex, read_kmod_modinfo
+from ugrd.kmod.kmod import save_kmod_cache
 from zenlib.logging import loggify
 
 
+def make_elf(sections: dict[str, bytes]) -> bytes:
+    """Makes a minimal little endian ELF64 file containing the passed sections"""
+    names = [""] + list(sections) + [".shstrtab"]
+    shstrtab = b"\0".join(name.encode() for name in names) + b"\0"
+    contents = [b""] + list(sections.values()) + [shstrtab]
+
+    data = b""
+    offsets = []
+    for content in contents:
+        offsets.append(64 + len(data))
+        data += content
+
+    section_headers = b""
+    for index, name in enumerate(names):
+        name_offset = shstrtab.index(name.encode() + b"\0") if name else 0
+        sh_type = 3 if name == ".shstrtab" else (1 if name else 0)
+        section_headers += pack(
+            "<IIQQQQIIQQ", name_offset, sh_type, 0, 0, offsets[index], len(contents[index]), 0, 0, 1, 0
+        )
+
+    ident = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+    header = ident + pack("<HHIQQQIHHHHHH", 1, 62, 1, 0, 0, 64 + len(data), 0, 64, 0, 0, 64, len(names), len(names) - 1)
+    return header + data + section_headers
+
+
 @loggify
 class TestKmod(TestCase):
     def test_kmod_recursion(self):
@@ -16,6 +52,145 @@ class TestKmod(TestCase):
         generator = InitramfsGenerator(logger=self.logger, config="tests/no_kmods.toml", kernel_version="1.2.0-76-not-real-for-tests-generic")
         generator.build()
 
+    def test_build_multi(self):
+        """Check that an image is built for each kernel version, in separate build directories"""
+        kernel_versions = ["1.2.0-76-not-real-for-tests-generic", "1.2.1-76-not-real-for-tests-generic"]
+        with TemporaryDirectory() as out_dir:
+            generator = InitramfsGenerator(
+                logger=self.logger, config="tests/no_kmods.toml", out_file=f"{out_dir}/ugrd-{{kver}}.cpio"
+            )
+            generator.build_multi(kernel_versions)
+            build_dir = generator._get_build_path("/")
+            for kver in kernel_versions:
+                self.assertTrue((Path(out_dir) / f"ugrd-{kver}.cpio").is_file())
+                self.assertTrue(build_dir.with_name(f"{build_dir.name}-{kver}").is_dir())
+
+            generator = InitramfsGenerator(
+                logger=self.logger, config="tests/no_kmods.toml", out_file=f"{out_dir}/ugrd.cpio"
+            )
+            with self.assertRaises(ValueError):
+                generator.build_multi(kernel_versions)
+
+    def test_kmod_index(self):
+        """Check that depmod metadata files are parsed into the kernel module index"""
+        with TemporaryDirectory() as kmod_dir:
+            kmod_dir = Path(kmod_dir)
+            (kmod_dir / "modules.dep").write_text(
+                "kernel/fs/btrfs/btrfs.ko.zst: kernel/crypto/xor.ko.zst kernel/lib/raid6/raid6_pq.ko.zst\n"
+                "kernel/crypto/xor.ko.zst:\n"
+                "kernel/lib/raid6/raid6_pq.ko.zst:\n"
+            )
+            (kmod_dir / "modules.softdep").write_text("# Soft dependencies\nsoftdep btrfs pre: crc32c post: foo-bar\n")
+            (kmod_dir / "modules.alias").write_text("alias fs-btrfs btrfs\nalias devname:btrfs-control btrfs\n")
+            (kmod_dir / "modules.builtin").write_text("kernel/fs/ext4/ext4.ko\n")
+
+            index = KmodIndex(kmod_dir)
+            btrfs_info = index.get_info("btrfs")
+            self.assertEqual(btrfs_info["filename"], str(kmod_dir / "kernel/fs/btrfs/btrfs.ko.zst"))
+            self.assertEqual(btrfs_info["depends"], ["xor", "raid6_pq"])
+            self.assertEqual(btrfs_info["softdep"], ["crc32c", "foo_bar"])
+            self.assertIsNone(btrfs_info["firmware"])
+            self.assertEqual(index.get_info("ext4")["filename"], "(builtin)")
+            self.assertEqual(index.aliases["fs-btrfs"], "btrfs")
+            self.assertIsNone(index.get_info("not_a_module"))
+
+    def test_kmod_index_cache(self):
+        """Check that the kernel module index is loaded from the cache until the depmod metadata changes"""
+        with TemporaryDirectory() as kmod_dir, TemporaryDirectory() as cache_dir:
+            kmod_dir, cache_file = Path(kmod_dir), Path(cache_dir) / "kmod" / "test.json"
+            (kmod_dir / "modules.dep").write_text("kernel/fs/btrfs/btrfs.ko.zst: kernel/crypto/xor.ko.zst\n")
+            (kmod_dir / "modules.alias").write_text(
+                "alias fs-btrfs btrfs\nalias pci:v00008086d*sv*sd*bc02sc00i* e1000\n"
+            )
+            (kmod_dir / "modules.builtin.modinfo").write_bytes(b"ext4.alias=fs-ext4\0ext4.license=GPL\0")
+
+            index = KmodIndex(kmod_dir, cache_file)
+            self.assertFalse(index.from_cache)
+            index.firmware["btrfs"] = ["foo.bin"]
+            self.assertTrue(index.save_cache())
+            self.assertFalse(index.save_cache())  # Nothing new was read
+
+            cached_index = KmodIndex(kmod_dir, cache_file)
+            self.assertTrue(cached_index.from_cache)
+            self.assertEqual(cached_index.get_info("btrfs"), index.get_info("btrfs"))
+            self.assertEqual(cached_index.get_info("ext4"), index.get_info("ext4"))
+            self.assertEqual(cached_index.resolve_alias("fs-ext4"), "ext4")
+            self.assertEqual(cached_index.resolve_alias("pci:v00008086d000010D3sv0sd0bc02sc00i00"), "e1000")
+            self.assertEqual(cached_index.get_firmware("btrfs"), ["foo.bin"])
+
+            (kmod_dir / "modules.dep").write_text("kernel/fs/btrfs/btrfs.ko.zst:\n")
+            self.assertFalse(KmodIndex(kmod_dir, cache_file).from_cache)
+
+    def test_kmod_cache_not_writable(self):
+        """Check that the kernel module cache is skipped quietly if cache_dir is not writable"""
+        generator, kmod_index = MagicMock(), MagicMock()
+        config = {"kmod_cache": True, "no_kmod": False}
+        generator.get.side_effect, generator.__getitem__.side_effect = config.get, config.__getitem__
+        for error in [PermissionError(EACCES, "Permission denied"), OSError(EROFS, "Read-only file system")]:
+            kmod_index.save_cache.side_effect = error
+            with patch("ugrd.kmod.kmod._get_kmod_index", return_value=kmod_index):
+                save_kmod_cache(generator)
+            generator.logger.warning.assert_not_called()
+        self.assertEqual(generator.logger.debug.call_count, 2)
+
+        kmod_index.save_cache.side_effect = OSError(ENOSPC, "No space left on device")
+        with patch("ugrd.kmod.kmod._get_kmod_index", return_value=kmod_index):
+            save_kmod_cache(generator)
+        generator.logger.warning.assert_called_once()
+
+    def test_kmod_alias_index(self):
+        """Check that exact, normalized and wildcard aliases are resolved by the kernel module index"""
+        with TemporaryDirectory() as kmod_dir:
+            kmod_dir = Path(kmod_dir)
+            (kmod_dir / "modules.alias").write_text(
+                "alias fs-btrfs btrfs\n"
+                "alias devname:btrfs-control btrfs\n"
+                "alias pci:v00008086d000015B8sv*sd*bc*sc*i* e1000e\n"
+                "alias pci:v00008086d*sv*sd*bc02sc00i* e1000\n"
+                "alias usb:v*p*d*dc*dsc*dp*ic08isc06ip50in* usb-storage\n"
+            )
+
+            index = KmodIndex(kmod_dir)
+            index.add_alias("crypto-crc32c", "crc32c_generic")
+            self.assertEqual(index.resolve_alias("fs-btrfs"), "btrfs")
+            self.assertEqual(index.resolve_alias("btrfs_control"), "btrfs")
+            self.assertEqual(index.resolve_alias("crypto-crc32c"), "crc32c_generic")
+            self.assertEqual(index.resolve_alias("pci:v00008086d000015B8sv00001028sd000007A1bc02sc00i00"), "e1000e")
+            self.assertEqual(index.resolve_alias("pci:v00008086d000010D3sv00001028sd000007A1bc02sc00i00"), "e1000")
+            self.assertEqual(index.resolve_alias("usb:v0781p5581d0100dc00dsc00dp00ic08isc06ip50in00"), "usb_storage")
+            self.assertIsNone(index.resolve_alias("pci:v000010ECd00008168sv00001028sd000007A1bc02sc00i00"))
+            self.assertIsNone(index.resolve_alias("not_an_alias"))
+
+    def test_read_kmod_modinfo(self):
+        """Check that firmware and other module info is read from plain and compressed kernel modules"""
+        modinfo = b"license=GPL\0firmware=foo/bar.bin\0firmware=foo/baz.bin\0depends=\0"
+        module = make_elf({".text": b"\0" * 16, ".modinfo": modinfo})
+        with TemporaryDirectory() as kmod_dir:
+            (Path(kmod_dir) / "test.ko").write_bytes(module)
+            (Path(kmod_dir) / "test.ko.xz").write_bytes(compress(module))
+            (Path(kmod_dir) / "test.ko.gz").write_bytes(gzip_compress(module))
+            for kmod_file in ["test.ko", "test.ko.xz", "test.ko.gz"]:
+                kmod_info = read_kmod_modinfo(Path(kmod_dir) / kmod_file)
+                self.assertEqual(kmod_info["firmware"], ["foo/bar.bin", "foo/baz.bin"])
+                self.assertEqual(kmod_info["license"], ["GPL"])
+                self.assertEqual(kmod_info["depends"], [""])
+
+            with patch("ugrd.kmod.index._SPOOL_SIZE", 16):  # Spool the decompressed module to a file
+                self.assertEqual(read_kmod_modinfo(Path(kmod_dir) / "test.ko.xz")["license"], ["GPL"])
+
+    def test_read_zstd_kmod_modinfo(self):
+        """Check that module info is read from zstd kernel modules using the zstd command without zstandard"""
+        if not which("zstd"):
+            self.skipTest("zstd is not available")
+        module = make_elf({".modinfo": b"license=GPL\0firmware=foo/bar.bin\0"})
+        with TemporaryDirectory() as kmod_dir:
+            kmod_path = Path(kmod_dir) / "test.ko.zst"
+            run(["zstd", "-q", "-o", str(kmod_path)], input=module, check=True)
+            with patch("ugrd.kmod.index._has_zstandard", return_value=False):
+                self.assertEqual(read_kmod_modinfo(kmod_path)["firmware"], ["foo/bar.bin"])
+                with patch("shutil.which", return_value=None), self.assertRaises(ImportError):
+                    read_kmod_modinfo(kmod_path)
+
 
 if __name__ == "__main__":
     main()